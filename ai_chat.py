@@ -1,40 +1,142 @@
 import re
 
+# Value rules, shared by the chat extractors below and by the validate_* helpers
+# used for bulk imports, so both accept exactly the same data.
+NAME_VALUE = r'[A-Za-z ]{2,50}'
+AGE_VALUE = r'\d{1,3}'
+GENDER_VALUE = r'male|female|other'
+CONTACT_VALUE = r'\+?\d[\d\s-]{6,}'
+DISEASE_VALUE = r'[A-Za-z0-9 ,.-]{2,100}'
+DOCTOR_VALUE = r'[A-Za-z .]{2,100}'
+ROLE_VALUE = r'[A-Za-z ]{2,50}'
+ID_VALUE = r'\d+'
+DATE_VALUE = r'\d{4}-\d{2}-\d{2}'
+TIME_VALUE = r'\d{1,2}:\d{2}'
+
+# Patterns are compiled once at import; the extractors run on every add/schedule message.
+_NAME = re.compile(r'name\s*[:\-]?\s*(' + NAME_VALUE + ')')
+_AGE = re.compile(r'age\s*[:\-]?\s*(' + AGE_VALUE + ')')
+_GENDER = re.compile(r'gender\s*[:\-]?\s*(' + GENDER_VALUE + ')', re.I)
+_CONTACT = re.compile(r'contact\s*[:\-]?\s*(' + CONTACT_VALUE + ')')
+_DISEASE = re.compile(r'disease\s*[:\-]?\s*(' + DISEASE_VALUE + ')')
+_DOCTOR = re.compile(r'doctor\s*[:\-]?\s*(' + DOCTOR_VALUE + ')')
+_ROLE = re.compile(r'role\s*[:\-]?\s*(' + ROLE_VALUE + ')')
+_PATIENT_ID = re.compile(r'patient_id\s*[:\-]?\s*(' + ID_VALUE + ')')
+_STAFF_ID = re.compile(r'staff_id\s*[:\-]?\s*(' + ID_VALUE + ')')
+_DATE = re.compile(r'date\s*[:\-]?\s*(' + DATE_VALUE + ')')
+_TIME = re.compile(r'time\s*[:\-]?\s*(' + TIME_VALUE + ')')
+_SPACES = re.compile(r'\s+')
+_SLOT_STAFF = re.compile(r'staff(?:_id)?\s*(?:#|:)?\s*(' + ID_VALUE + ')')
+_DATES = re.compile(DATE_VALUE)
+# which counter a statistics question is about; the first mention wins
+_STATS_METRIC = re.compile(r"\b(doctor|disease|diagnos[ie]s|day|date|daily|staff)")
+_STATS_METRICS = {'doctor': 'doctor', 'disease': 'disease', 'diagnoses': 'disease', 'diagnosis': 'disease',
+                  'day': 'day', 'date': 'day', 'daily': 'day', 'staff': 'staff'}
+
 def extract_patient_structured(text):
     data = {'patient_id': None, 'name': None, 'age': None, 'gender': None,
             'contact': None, 'disease': None, 'doctor_assigned': None}
-    m_name = re.search(r'name\s*[:\-]?\s*([A-Za-z ]{2,50})', text)
+    m_name = _NAME.search(text)
     if m_name: data['name'] = m_name.group(1).strip()
-    m_age = re.search(r'age\s*[:\-]?\s*(\d{1,3})', text)
+    m_age = _AGE.search(text)
     if m_age: data['age'] = int(m_age.group(1))
-    m_gender = re.search(r'gender\s*[:\-]?\s*(male|female|other)', text, re.I)
+    m_gender = _GENDER.search(text)
     if m_gender: data['gender'] = m_gender.group(1).capitalize()
-    m_contact = re.search(r'contact\s*[:\-]?\s*(\+?\d[\d\s-]{6,})', text)
-    if m_contact: data['contact'] = re.sub(r'\s+', '', m_contact.group(1))
-    m_disease = re.search(r'disease\s*[:\-]?\s*([A-Za-z0-9 ,.-]{2,100})', text)
+    m_contact = _CONTACT.search(text)
+    if m_contact: data['contact'] = _SPACES.sub('', m_contact.group(1))
+    m_disease = _DISEASE.search(text)
     if m_disease: data['disease'] = m_disease.group(1).strip()
-    m_doc = re.search(r'doctor\s*[:\-]?\s*([A-Za-z .]{2,100})', text)
+    m_doc = _DOCTOR.search(text)
     if m_doc: data['doctor_assigned'] = m_doc.group(1).strip()
     return data
 
 def extract_staff_structured(text):
     data = {'staff_id': None, 'name': None, 'role': None, 'contact': None}
-    m_name = re.search(r'name\s*[:\-]?\s*([A-Za-z ]{2,50})', text)
+    m_name = _NAME.search(text)
     if m_name: data['name'] = m_name.group(1).strip()
-    m_role = re.search(r'role\s*[:\-]?\s*([A-Za-z ]{2,50})', text)
+    m_role = _ROLE.search(text)
     if m_role: data['role'] = m_role.group(1).strip()
-    m_contact = re.search(r'contact\s*[:\-]?\s*(\+?\d[\d\s-]{6,})', text)
-    if m_contact: data['contact'] = re.sub(r'\s+', '', m_contact.group(1))
+    m_contact = _CONTACT.search(text)
+    if m_contact: data['contact'] = _SPACES.sub('', m_contact.group(1))
     return data
 
 def extract_appointment_structured(text):
     data = {'patient_id': None, 'staff_id': None, 'date': None, 'time': None}
-    m_pid = re.search(r'patient_id\s*[:\-]?\s*(\d+)', text)
+    m_pid = _PATIENT_ID.search(text)
     if m_pid: data['patient_id'] = int(m_pid.group(1))
-    m_sid = re.search(r'staff_id\s*[:\-]?\s*(\d+)', text)
+    m_sid = _STAFF_ID.search(text)
     if m_sid: data['staff_id'] = int(m_sid.group(1))
-    m_date = re.search(r'date\s*[:\-]?\s*(\d{4}-\d{2}-\d{2})', text)
+    m_date = _DATE.search(text)
     if m_date: data['date'] = m_date.group(1)
-    m_time = re.search(r'time\s*[:\-]?\s*(\d{1,2}:\d{2})', text)
+    m_time = _TIME.search(text)
     if m_time: data['time'] = m_time.group(1)
     return data
+
+def extract_free_slots_structured(text):
+    # "free slots for staff 3 between 2026-11-02 and 2026-11-06"; one date means that day
+    data = {'staff_id': None, 'from': None, 'to': None}
+    m_sid = _SLOT_STAFF.search(text)
+    if m_sid: data['staff_id'] = int(m_sid.group(1))
+    dates = _DATES.findall(text)
+    if dates:
+        data['from'] = dates[0]
+        data['to'] = dates[1] if len(dates) > 1 else dates[0]
+    return data
+
+
+def extract_stats_structured(text):
+    # "patients per doctor", "appointments per day between 2026-11-02 and 2026-11-06";
+    # no metric means the overall census
+    data = {'metric': None, 'from': None, 'to': None}
+    m_metric = _STATS_METRIC.search(text)
+    if m_metric: data['metric'] = _STATS_METRICS[m_metric.group(1)]
+    dates = _DATES.findall(text)
+    if dates:
+        data['metric'] = 'day'
+        data['from'] = dates[0]
+        data['to'] = dates[1] if len(dates) > 1 else dates[0]
+    return data
+
+
+# ---------- Validation of already-split records ----------
+# Each rule: (pattern, converter). A value must match the pattern in full.
+_RULES = {
+    'name': (re.compile(NAME_VALUE), str.strip),
+    'age': (re.compile(AGE_VALUE), int),
+    'gender': (re.compile(GENDER_VALUE, re.I), str.capitalize),
+    'contact': (re.compile(CONTACT_VALUE), lambda v: _SPACES.sub('', v)),
+    'disease': (re.compile(DISEASE_VALUE), str.strip),
+    'doctor_assigned': (re.compile(DOCTOR_VALUE), str.strip),
+    'role': (re.compile(ROLE_VALUE), str.strip),
+    'patient_id': (re.compile(ID_VALUE), int),
+    'staff_id': (re.compile(ID_VALUE), int),
+    'date': (re.compile(DATE_VALUE), str),
+    'time': (re.compile(TIME_VALUE), str),
+}
+
+def _validate(record, fields, required):
+    data = {}; errors = []
+    for field in fields:
+        raw = record.get(field)
+        raw = '' if raw is None else str(raw).strip()
+        if not raw:
+            data[field] = None
+            if field in required:
+                errors.append(f'{field} is required')
+            continue
+        pattern, convert = _RULES[field]
+        if not pattern.fullmatch(raw):
+            errors.append(f'invalid {field}: {raw[:40]!r}')
+            continue
+        data[field] = convert(raw)
+    return data, errors
+
+def validate_patient(record):
+    return _validate(record, ('name', 'age', 'gender', 'contact', 'disease', 'doctor_assigned'), ('name',))
+
+def validate_staff(record):
+    return _validate(record, ('name', 'role', 'contact'), ('name',))
+
+def validate_appointment(record):
+    fields = ('patient_id', 'staff_id', 'date', 'time')
+    return _validate(record, fields, fields)
@@ -1,39 +1,678 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, g, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from ai_chat import (
     extract_patient_structured,
     extract_staff_structured,
-    extract_appointment_structured
+    extract_appointment_structured,
+    extract_free_slots_structured,
+    extract_stats_structured
 )
-import re, os
+import re, os, base64, csv, io, json, datetime, heapq, itertools
 OPENAI_AVAILABLE = False
-from db import get_connection
-import mysql.connector, os
+import db
+import intents
+from db import run_query
+from intents import normalize_field_name
+from name_search import search_names, fetch_by_ids
+from record_cache import records
+import bulk_import
+import response_format
+import chat_history
+import scheduling
+import metrics
+import change_feed
+import hospital_stats
+from llm_gateway import gateway as llm
 
 app = Flask(__name__, static_folder='static', static_url_path='')
 
+
+class TimedJSONProvider(DefaultJSONProvider):
+    # response bodies count towards the request's 'serialize' phase; written
+    # with orjson when it is installed
+    def dumps(self, obj, **kwargs):
+        with metrics.span('serialize'):
+            if response_format.orjson is None:
+                return super().dumps(obj, **kwargs)
+            return response_format.dumps(obj, kwargs.get('default', self.default),
+                                         kwargs.get('sort_keys', self.sort_keys), kwargs.get('indent'))
+
+
+app.json = TimedJSONProvider(app)
+
 @app.route('/')
 def home():
     return send_from_directory('static', 'index.html')
 
 
 # ---------- DB Helper ----------
-def run_query(query, params=None, fetch=False):
+# Every run_query call made while handling one request shares a single pooled
+# connection; it goes back to the pool when the request ends.
+# With read replicas, the time of a client's last write travels in a cookie
+# so its next requests don't read from a replica that hasn't caught up.
+# With shards the request names its hospital in X-Hospital (or ?hospital=)
+# and works in that hospital's database; without one it gets DB_HOSPITAL_ID.
+# "all" is for the show patients/staff/appointments listings, which then
+# ask every hospital at once.
+LAST_WRITE_COOKIE = 'hms_last_write'
+ALL_HOSPITALS = 'all'
+
+
+@app.before_request
+def _open_db_scope():
     try:
-        conn = get_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(query, params or ())
-        if fetch:
-            rows = cursor.fetchall()
-            cursor.close(); conn.close()
-            return rows
-        conn.commit()
-        cursor.close(); conn.close()
-        return True
-    except mysql.connector.Error as err:
-        return str(err)
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, ''))
+    except ValueError:
+        last_write = None
+    hospital = request.headers.get('X-Hospital') or request.args.get('hospital')
+    g.all_hospitals = hospital == ALL_HOSPITALS
+    if g.all_hospitals:
+        if request.endpoint != 'chat_api':
+            return jsonify({'type': 'error', 'message': 'X-Hospital: all only works for /api/chat listings.'}), 400
+        hospital = None
+    elif hospital is not None:
+        try:
+            hospital = int(hospital)
+        except ValueError:
+            return jsonify({'type': 'error', 'message': 'X-Hospital must be a hospital id or "all".'}), 400
+        if db.DB_SHARDS:
+            try:
+                db.locate(hospital)
+            except db.HospitalUnavailable as err:
+                return jsonify({'type': 'error', 'message': str(err)}), 404
+            except db.Error as err:
+                # the shard map has never been read: the home database is down
+                return jsonify({'type': 'error', 'message': str(err)}), 503
+    g.db_scope = db.begin_scope(last_write, hospital)
+
+
+@app.after_request
+def _remember_write(response):
+    scope = g.get('db_scope')
+    if scope and scope[0].wrote and db.get_replicas():
+        response.set_cookie(LAST_WRITE_COOKIE, f"{scope[0].last_write:.3f}",
+                            max_age=int(db.READ_YOUR_WRITES_SECONDS) + 1, httponly=True, samesite='Lax')
+    return response
+
+
+@app.teardown_request
+def _close_db_scope(exc):
+    scope = g.pop('db_scope', None)
+    if scope:
+        db.end_scope(*scope)
+
+
+# ---------- Metrics ----------
+@app.before_request
+def _start_trace():
+    metrics.start_request()
+
+
+@app.after_request
+def _finish_trace(response):
+    metrics.finish_request(request.endpoint, response.status_code)
+    return response
+
+
+@app.after_request
+def _compress(response):
+    return response_format.compress_response(response, request.accept_encodings)
+
+
+@app.route('/metrics')
+def metrics_api():
+    gauges = {'hms_db_pool': db.pool_stats(), 'hms_record_cache': records.stats(),
+              'hms_llm': llm.stats(), 'hms_history': chat_history.writer.stats(),
+              'hms_change_feed': change_feed.stats(),
+              'hms_db_replica': {f"{r['name']}/{k}": int(v) if isinstance(v, bool) else v
+                                 for r in db.replica_stats() for k, v in r.items()},
+              'hms_db_shard': {f"{s['hospital']}/{k}": s[k] for s in db.shard_stats() for k in ('open', 'in_use')}}
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/health')
+def health():
+    return jsonify({'status': 'ok', 'db_backend': db.DB_BACKEND, 'db_pool': db.pool_stats(), 'db_replicas': db.replica_stats(), 'db_shards': db.shard_stats(), 'record_cache': records.stats(), 'llm': llm.stats(), 'history': chat_history.writer.stats(), 'change_feed': change_feed.stats()})
 
 
 # ---------- Chat API ----------
+PATIENT_FIELDS = {'name','age','gender','contact','disease','doctor_assigned','admitted_date','discharge_date'}
+STAFF_FIELDS = {'name','role','contact'}
+
+
+def _present(result, fmt):
+    # table results leave the handlers as raw rows and are shaped here, once
+    body, status = result if isinstance(result, tuple) else (result, None)
+    if body.get('type') == 'table':
+        with metrics.span('serialize'):
+            body = response_format.shape_table(body, fmt)
+    return (body, status) if status else body
+
+
+def _response_format(data):
+    fmt = data.get('format') or 'rows'
+    return fmt if fmt in response_format.FORMATS else None
+
+
+def _record_text(row):
+    # Format all available fields into a clear multiline text response
+    return '\n'.join(f"{k}: {v if v is not None else 'N/A'}" for k, v in row.items())
+
+
+def _record_changed(kind, rec_id, op, fields=()):
+    # every chat write path: drop the cached copy and tell the change feed
+    records.invalidate(kind, rec_id)
+    change_feed.publish(kind, op, rec_id)
+    if 'name' in fields and kind in _NAMED_IN and change_feed.CHANGE_FEED:
+        # the appointments listing shows patient and staff names
+        rows = run_query(f"SELECT appointment_id FROM appointments WHERE {_NAMED_IN[kind]} = %s", (rec_id,), fetch=True)
+        if isinstance(rows, str):
+            change_feed.publish('appointment', 'reset')
+            return
+        for row in rows:
+            change_feed.publish('appointment', 'update', row['appointment_id'])
+
+
+_NAMED_IN = {'patient': 'patient_id', 'staff': 'staff_id'}
+
+
+_TABLES = {'patient': ('patients', 'patient_id'), 'staff': ('staff', 'staff_id')}
+STAFF_INSERT = "INSERT INTO staff (name, role, contact) VALUES (%s, %s, %s)"
+PATIENT_INSERT = """INSERT INTO patients (name, age, gender, contact, disease, doctor_assigned)
+                    VALUES (%s, %s, %s, %s, %s, %s)"""
+
+
+def _update_record(role, rec_id, updates):
+    # UPDATE one patient/staff row from {field: value}; True or an error string.
+    # Patient rows move the statistics counters in the same transaction.
+    table, idcol = _TABLES[role]
+    set_clause = ', '.join([f"{k} = %s" for k in updates.keys()])
+    query = f"UPDATE {table} SET {set_clause} WHERE {idcol} = %s"
+    params = tuple(updates.values()) + (rec_id,)
+    if role not in hospital_stats.TRACKED:
+        return run_query(query, params)
+    try:
+        with db.transaction() as cursor:
+            before = hospital_stats.rows(cursor, role, rec_id, lock=True)
+            cursor.execute(query, params)
+            hospital_stats.changed(cursor, role, rec_id, before=before)
+    except db.Error as err:
+        return str(err)
+    return True
+
+
+def _insert_patient(vals):
+    # the new patient's id, or an error string
+    try:
+        with db.transaction() as cursor:
+            cursor.execute(PATIENT_INSERT, vals)
+            new_id = cursor.lastrowid
+            hospital_stats.changed(cursor, 'patient', new_id)
+    except db.Error as err:
+        return str(err)
+    return new_id
+
+
+def _resolve_name(name):
+    # One indexed lookup across patients and staff; a unique patient match wins,
+    # then a unique staff match. Returns (role, id) or (None, None).
+    if not name: return None, None
+    found = search_names(name)
+    if isinstance(found, str):
+        return None, None
+    for role in ('patient', 'staff'):
+        if len(found[role]) == 1:
+            return role, found[role][0]['id']
+    return None, None
+
+
+# ---- Natural conversational update patterns ----
+# Multi-field natural updates and name-based resolution
+def _handle_update_fields(msg, route, opts):
+    role = None; rec_id = None
+    if route.patient_id:
+        role = 'patient'; rec_id = route.patient_id
+    elif route.staff_id:
+        role = 'staff'; rec_id = route.staff_id
+    elif route.update_name:
+        role, rec_id = _resolve_name(route.update_name)
+    if not (role and rec_id and route.update_pairs):
+        return None
+    allowed = PATIENT_FIELDS if role == 'patient' else STAFF_FIELDS
+    updates = {k: v for k, v in route.update_pairs if k in allowed}
+    if not updates:
+        return None
+    r = _update_record(role, rec_id, updates)
+    if isinstance(r, str):
+        return {'type':'error','message':r}, 500
+    _record_changed(role, rec_id, 'update', updates)
+    return {'type':'success','message':f"{role.capitalize()} {rec_id} updated ({len(updates)} fields)."}
+
+
+# Handle phrases like: "update the age of patient_id 1 to 45" or "change patient 2 contact to +91..."
+def _handle_update_field(msg, route, opts):
+    role, rec_id, raw_field, raw_value = route.field_update
+    if not raw_field or not raw_value:
+        return None
+    field = normalize_field_name(raw_field)
+    # trim trailing punctuation
+    raw_value = raw_value.rstrip('.;')
+    allowed = PATIENT_FIELDS if role == 'patient' else STAFF_FIELDS
+    if field not in allowed:
+        # not a recognized field for this role, skip to normal handlers
+        return None
+    # convert value types
+    val = raw_value
+    if field == 'age':
+        # extract first integer
+        iv = re.search(r"(\d{1,3})", val)
+        if iv:
+            val = int(iv.group(1))
+        else:
+            # invalid age
+            return {'type':'text','message':'Could not parse numeric age from your message.'}
+
+    res = _update_record(role, rec_id, {field: val})
+    if isinstance(res, str):
+        return {'type':'error','message':res}, 500
+    _record_changed(role, rec_id, 'update', (field,))
+    return {'type':'success','message':f'{role.capitalize()} {rec_id} updated: {field} -> {val}.'}
+
+
+# If OpenAI key is available, try to parse/answer more complex natural language like ChatGPT
+def _handle_llm(msg, route, opts):
+    if not llm.enabled():
+        return None
+    try:
+        parsed = llm.parse(msg)
+        if not parsed:
+            return None
+        action = parsed.get('action')
+        if action == 'show' and parsed.get('target') in ('patient','staff'):
+            if parsed.get('id'):
+                r = records.get(parsed['target'], int(parsed['id']))
+                if isinstance(r, str):
+                    return {'type':'error','message':r},500
+                if not r:
+                    return {'type':'text','message':'No record found.'}
+                # Ask OpenAI to create a friendly summary if desired
+                summary = llm.summarize(r)
+                if summary:
+                    return {'type':'text','message':summary}
+                return {'type':'text','message':_record_text(r)}
+
+        if action == 'update' and parsed.get('target') in ('patient','staff'):
+            rid = parsed.get('id')
+            fields = parsed.get('fields') or {}
+            if not rid:
+                # If no id, ask user to specify id
+                return {'type':'text','message':'Please specify the record id to update (e.g., patient_id 1).'}
+            allowed = PATIENT_FIELDS if parsed['target']=='patient' else STAFF_FIELDS
+            updates = {k:v for k,v in fields.items() if normalize_field_name(k) in allowed}
+            if not updates:
+                return {'type':'text','message':'No valid fields detected to update.'}
+            # normalize keys
+            updates_norm = { normalize_field_name(k): v for k,v in updates.items() }
+            resu = _update_record(parsed['target'], int(rid), updates_norm)
+            if isinstance(resu, str):
+                return {'type':'error','message':resu},500
+            _record_changed(parsed['target'], int(rid), 'update', updates_norm)
+            return {'type':'success','message':f"{parsed['target'].capitalize()} {rid} updated ({len(updates_norm)} fields)."}
+
+        if action == 'add' and parsed.get('target') in ('patient','staff'):
+            fields = parsed.get('fields') or {}
+            if parsed.get('target')=='patient':
+                vals = (fields.get('name'), fields.get('age'), fields.get('gender'), fields.get('contact'), fields.get('disease'), fields.get('doctor_assigned'))
+                new_id = _insert_patient(vals)
+                if isinstance(new_id, str):
+                    return {'type':'error','message':new_id},500
+                _record_changed('patient', new_id, 'insert')
+                return {'type':'success','message':'Patient added.'}
+            else:
+                vals = (fields.get('name'), fields.get('role'), fields.get('contact'))
+                resu = run_query(STAFF_INSERT, vals)
+                if isinstance(resu, str):
+                    return {'type':'error','message':resu},500
+                _record_changed('staff', db.last_insert_id(), 'insert')
+                return {'type':'success','message':'Staff added.'}
+
+        if action == 'text' and parsed.get('response'):
+            return {'type':'text','message': parsed.get('response')}
+
+    except Exception:
+        # If any error occurs with OpenAI parsing, ignore and continue to default handlers
+        pass
+    return None
+
+
+# --- Add patient ---
+def _handle_add_patient(msg, route, opts):
+    parsed = extract_patient_structured(msg)
+    if not parsed.get('name'):
+        return {'type': 'error', 'message': 'Please include name, age, gender, disease, and doctor.'}, 400
+    new_id = _insert_patient((parsed['name'], parsed['age'], parsed['gender'], parsed['contact'],
+                              parsed['disease'], parsed['doctor_assigned']))
+    if isinstance(new_id, str):
+        return {'type': 'error', 'message': new_id}, 500
+    _record_changed('patient', new_id, 'insert')
+    return {'type': 'success', 'message': f"Patient '{parsed['name']}' added successfully."}
+
+
+# --- Add staff ---
+def _handle_add_staff(msg, route, opts):
+    parsed = extract_staff_structured(msg)
+    if not parsed.get('name'):
+        return {'type': 'error', 'message': 'Please include name, role, and contact.'}, 400
+    result = run_query(STAFF_INSERT, (parsed['name'], parsed['role'], parsed['contact']))
+    if isinstance(result, str):
+        return {'type': 'error', 'message': result}, 500
+    _record_changed('staff', db.last_insert_id(), 'insert')
+    return {'type': 'success', 'message': f"Staff '{parsed['name']}' added successfully."}
+
+
+# --- Schedule appointment ---
+def _handle_schedule_appointment(msg, route, opts):
+    parsed = extract_appointment_structured(msg)
+    if not all([parsed.get('patient_id'), parsed.get('staff_id'), parsed.get('date'), parsed.get('time')]):
+        return {'type': 'error', 'message': 'Provide patient_id, staff_id, date, and time.'}, 400
+    status, value = scheduling.book_appointment(parsed['patient_id'], parsed['staff_id'], parsed['date'], parsed['time'])
+    if status == 'conflict':
+        return {'type': 'error', 'message': f"Staff {parsed['staff_id']} already has an appointment at {value} on {parsed['date']}."}, 409
+    if status == 'no_staff':
+        return {'type': 'error', 'message': f"No staff found with id {parsed['staff_id']}."}, 404
+    if status == 'error':
+        return {'type': 'error', 'message': value}, 500
+    _record_changed('appointment', value, 'insert')
+    return {'type': 'success', 'message': 'Appointment scheduled successfully.'}
+
+
+def _handle_free_slots(msg, route, opts):
+    parsed = extract_free_slots_structured(msg)
+    if not (parsed['staff_id'] and parsed['from']):
+        return {'type': 'error', 'message': 'Use: free slots for staff <id> between YYYY-MM-DD and YYYY-MM-DD.'}, 400
+    try:
+        start = datetime.date.fromisoformat(parsed['from'])
+        end = datetime.date.fromisoformat(parsed['to'])
+    except ValueError:
+        return {'type': 'error', 'message': 'Dates must be valid YYYY-MM-DD.'}, 400
+    if end < start:
+        start, end = end, start
+    if (end - start).days >= scheduling.FREE_SLOTS_MAX_DAYS:
+        return {'type': 'error', 'message': f'Ask for at most {scheduling.FREE_SLOTS_MAX_DAYS} days at a time.'}, 400
+    days = scheduling.free_slots(parsed['staff_id'], start, end)
+    if isinstance(days, str):
+        return {'type': 'error', 'message': days}, 500
+    rows = [{'date': d.isoformat(), 'free': len(slots), 'slots': ', '.join(slots)} for d, slots in days]
+    return {'type': 'table', 'data': rows}
+
+
+# --- Statistics, read from the hospital_stats counters ---
+_STATS_COLUMNS = {'doctor': ('doctor', 'patients'), 'disease': ('disease', 'patients'),
+                  'day': ('date', 'appointments'), 'staff': ('staff_id', 'appointments')}
+
+
+def _handle_stats(msg, route, opts):
+    parsed = extract_stats_structured(msg)
+    metric = parsed['metric']
+    if metric is None:
+        patients = hospital_stats.total('patients')
+        appointments = hospital_stats.total('appointments')
+        for r in (patients, appointments):
+            if isinstance(r, str):
+                return {'type': 'error', 'message': r}, 500
+        return {'type': 'text', 'message': f"{patients} patients, {appointments} appointments."}
+    if parsed['from']:
+        start, end = sorted((parsed['from'], parsed['to']))
+        found = hospital_stats.counts(metric, start, end)
+    else:
+        found = hospital_stats.counts(metric)
+    if isinstance(found, str):
+        return {'type': 'error', 'message': found}, 500
+    label, counted = _STATS_COLUMNS[metric]
+    if metric == 'day':
+        found.sort()
+    else:
+        found.sort(key=lambda bn: (-bn[1], bn[0]))
+    if metric != 'staff':
+        return {'type': 'table', 'data': [{label: b or 'unassigned', counted: n} for b, n in found]}
+    staff = fetch_by_ids('staff', [int(b) for b, _ in found if b.isdigit()])
+    if isinstance(staff, str):
+        return {'type': 'error', 'message': staff}, 500
+    names = {str(r['staff_id']): r['name'] for r in staff}
+    return {'type': 'table', 'data': [{label: b or 'unassigned', 'name': names.get(b), counted: n} for b, n in found]}
+
+
+# --- Show patients / staff / appointments ---
+# Without page_size/cursor the whole table is returned as before. With them the
+# listing is keyset-paginated on the primary key (newest first) and the reply
+# carries an opaque next_cursor for the following page.
+PAGE_SIZE_DEFAULT = int(os.getenv('PAGE_SIZE_DEFAULT', 50))
+PAGE_SIZE_MAX = int(os.getenv('PAGE_SIZE_MAX', 500))
+
+LISTINGS = {
+    'patients': ("SELECT * FROM patients {where} ORDER BY patient_id DESC", 'patient_id', 'patient_id'),
+    'staff': ("SELECT * FROM staff {where} ORDER BY staff_id DESC", 'staff_id', 'staff_id'),
+    'appointments': ("""
+        SELECT a.appointment_id, p.name AS patient_name, s.name AS staff_name,
+               a.appointment_date, a.appointment_time
+        FROM appointments a
+        LEFT JOIN patients p ON a.patient_id = p.patient_id
+        LEFT JOIN staff s ON a.staff_id = s.staff_id
+        {where}
+        ORDER BY a.appointment_id DESC
+    """, 'a.appointment_id', 'appointment_id'),
+}
+# the paged statements per listing: (first page, page after a cursor)
+_PAGES = {kind: (query.format(where='') + " LIMIT %s",
+                 query.format(where=f"WHERE {key_col} < %s") + " LIMIT %s")
+          for kind, (query, key_col, _) in LISTINGS.items()}
+
+
+def encode_cursor(kind, last_id):
+    return base64.urlsafe_b64encode(f"{kind}:{last_id}".encode()).decode().rstrip('=')
+
+
+def decode_cursor(kind, cursor, convert=int):
+    # returns the last key seen, or None if the cursor is not one of ours
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        ckind, last_key = raw.split(':', 1)
+        if ckind == kind:
+            return convert(last_key)
+    except (ValueError, UnicodeDecodeError):
+        pass
+    return None
+
+
+def _listing(kind, opts):
+    query, _, key_field = LISTINGS[kind]
+    page_size = opts.get('page_size')
+    cursor = opts.get('cursor')
+    network = g.get('all_hospitals')
+    # the page may subscribe to the change feed for this listing; the feed
+    # follows one hospital
+    live = change_feed.CHANGE_FEED and not network
+    if page_size is None and not cursor:
+        if network:
+            rows = _network_rows(kind, query.format(where=''))
+        else:
+            rows = run_query(query.format(where=''), fetch=True)
+        if isinstance(rows, str):
+            return {'type': 'error', 'message': rows}, 500
+        return {'type': 'table', 'data': rows or [], 'live': live}
+
+    try:
+        page_size = min(max(int(page_size or PAGE_SIZE_DEFAULT), 1), PAGE_SIZE_MAX)
+    except (TypeError, ValueError):
+        return {'type': 'error', 'message': 'page_size must be a number.'}, 400
+    last = None
+    if cursor:
+        last = decode_cursor(kind + '@all' if network else kind, str(cursor), _network_key if network else int)
+        if last is None:
+            return {'type': 'error', 'message': 'Invalid cursor.'}, 400
+    # one extra row tells us whether another page exists
+    if network:
+        rows = _network_rows(kind, _PAGES[kind][0], (page_size + 1,), last)
+    else:
+        params = ([last] if cursor else []) + [page_size + 1]
+        rows = run_query(_PAGES[kind][1 if cursor else 0], tuple(params), fetch=True)
+    if isinstance(rows, str):
+        return {'type': 'error', 'message': rows}, 500
+    rows = rows or []
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        if network:
+            next_cursor = encode_cursor(kind + '@all', f"{rows[-1][key_field]}.{rows[-1]['hospital_id']}")
+        else:
+            next_cursor = encode_cursor(kind, rows[-1][key_field])
+    return {'type': 'table', 'data': rows, 'next_cursor': next_cursor, 'live': live}
+
+
+def _network_rows(kind, query, params=(), after=None):
+    # The listing from every hospital's database at once, merged newest first.
+    # Each hospital numbers its own records, so ties on the key go to the
+    # higher hospital id and a page cursor is (key, hospital).
+    _, _, key_field = LISTINGS[kind]
+    limit = params[-1] if params else None
+    if after is not None:
+        key, hospital = after
+        # hospitals below the cursor's may still have rows with its key
+        query, params = _PAGES[kind][1], lambda h: (key + 1 if h < hospital else key, limit)
+    found = db.scatter_query(query, params)
+    if isinstance(found, str):
+        return found
+    # rows carry their hospital_id column; the appointments listing gets it here
+    pages = [[dict(r, hospital_id=h) for r in rows] for h, rows in found.items()]
+    merged = heapq.merge(*pages, key=lambda r: (r[key_field], r['hospital_id']), reverse=True)
+    return list(itertools.islice(merged, limit))
+
+
+def _network_key(raw):
+    key, hospital = raw.split('.')
+    return int(key), int(hospital)
+
+
+def _handle_show_patients(msg, route, opts):
+    return _listing('patients', opts)
+
+
+def _handle_show_staff(msg, route, opts):
+    return _listing('staff', opts)
+
+
+def _handle_show_appointments(msg, route, opts):
+    return _listing('appointments', opts)
+
+
+# --- Natural language record lookup (ChatGPT-like answers) ---
+# Explicit patterns like 'patient_id 1' or 'patient 1' should return full records
+def _handle_patient_by_id(msg, route, opts):
+    pid = route.patient_id
+    row = records.get('patient', pid)
+    if isinstance(row, str):
+        return {'type': 'error', 'message': row}, 500
+    if not row:
+        return {'type': 'text', 'message': f'No patient found with id {pid}.'}
+    return {'type': 'text', 'message': _record_text(row)}
+
+
+def _handle_staff_by_id(msg, route, opts):
+    sid = route.staff_id
+    row = records.get('staff', sid)
+    if isinstance(row, str):
+        return {'type': 'error', 'message': row}, 500
+    if not row:
+        return {'type': 'text', 'message': f'No staff found with id {sid}.'}
+    return {'type': 'text', 'message': _record_text(row)}
+
+
+# Examples that will be handled: "tell me about John Doe", "who is alice", "info on staff Dr Smith"
+def _handle_name_lookup(msg, route, opts):
+    found = search_names(route.lookup_name)
+    if isinstance(found, str):
+        return {'type': 'error', 'message': found}, 500
+
+    # patients first
+    rows = fetch_by_ids('patient', [c['id'] for c in found['patient']])
+    if isinstance(rows, str):
+        return {'type': 'error', 'message': rows}, 500
+    if rows and len(rows) == 1:
+        r = rows[0]
+        text = f"Patient {r.get('name')} (ID: {r.get('patient_id')}) is {r.get('age')}-year-old {r.get('gender')}. Contact: {r.get('contact') or 'N/A'}. Diagnosis: {r.get('disease') or 'N/A'}. Assigned doctor: {r.get('doctor_assigned') or 'N/A'}."
+        # Optionally, enhance phrasing with OpenAI if an API key is provided
+        text = llm.describe_patient(r) or text
+        return {'type': 'text', 'message': text}
+    if rows and len(rows) > 1:
+        return {'type': 'table', 'data': rows}
+
+    # then staff
+    rows = fetch_by_ids('staff', [c['id'] for c in found['staff']])
+    if isinstance(rows, str):
+        return {'type': 'error', 'message': rows}, 500
+    if rows and len(rows) == 1:
+        r = rows[0]
+        text = f"Staff {r.get('name')} (ID: {r.get('staff_id')}) is a {r.get('role') or 'N/A'}. Contact: {r.get('contact') or 'N/A'}."
+        return {'type': 'text', 'message': text}
+    if rows and len(rows) > 1:
+        return {'type': 'table', 'data': rows}
+    return None
+
+
+HANDLERS = {
+    intents.UPDATE_FIELDS: _handle_update_fields,
+    intents.UPDATE_FIELD: _handle_update_field,
+    intents.LLM: _handle_llm,
+    intents.ADD_PATIENT: _handle_add_patient,
+    intents.ADD_STAFF: _handle_add_staff,
+    intents.SCHEDULE_APPOINTMENT: _handle_schedule_appointment,
+    intents.FREE_SLOTS: _handle_free_slots,
+    intents.STATS: _handle_stats,
+    intents.SHOW_PATIENTS: _handle_show_patients,
+    intents.SHOW_STAFF: _handle_show_staff,
+    intents.SHOW_APPOINTMENTS: _handle_show_appointments,
+    intents.PATIENT_BY_ID: _handle_patient_by_id,
+    intents.STAFF_BY_ID: _handle_staff_by_id,
+    intents.NAME_LOOKUP: _handle_name_lookup,
+}
+
+
+NETWORK_INTENTS = {intents.SHOW_PATIENTS, intents.SHOW_STAFF, intents.SHOW_APPOINTMENTS}
+
+
+def dispatch(msg, opts=None):
+    # Try each candidate intent in priority order; a handler returns None to pass.
+    # opts carries the other request fields (page_size, cursor, ...).
+    with metrics.span('intent'):
+        route = intents.classify(msg)
+    candidates = route.intents
+    if g.get('all_hospitals'):
+        # only the listings can answer for every hospital at once
+        candidates = [i for i in candidates if i in NETWORK_INTENTS]
+        if not candidates:
+            return {'type': 'error', 'message': 'Across all hospitals only show patients/staff/appointments work; '
+                                                'name one hospital in X-Hospital.'}, 400
+    for intent in candidates:
+        result = HANDLERS[intent](msg, route, opts or {})
+        if result is not None:
+            metrics.set_intent(intent)
+            return result
+    metrics.set_intent('fallback')
+    return {'type': 'text', 'message': 'Use: add/show patient/staff or schedule appointment.'}
+
+
+def _user_id(data):
+    return str(data.get('user_id') or request.headers.get('X-User-Id') or 'anonymous')[:100]
+
+
+def _reply_text(result):
+    # what goes into user_history for a bot turn
+    body = result[0] if isinstance(result, tuple) else result
+    if body.get('type') == 'table':
+        return f"[table: {len(body.get('data') or [])} rows]"
+    return body.get('message') or ''
+
+
 @app.route('/api/chat', methods=['POST'])
 def chat_api():
     data = request.get_json() or {}
@@ -41,470 +680,270 @@ def chat_api():
 
     if not msg:
         return jsonify({'type': 'error', 'message': 'Empty message'}), 400
+    fmt = _response_format(data)
+    if fmt is None:
+        return jsonify({'type': 'error', 'message': 'format must be rows or columns.'}), 400
 
-    # ---- Natural conversational update patterns ----
-    # Handle phrases like: "update the age of patient_id 1 to 45" or "change patient 2 contact to +91..."
-    def _normalize_field_name(name):
-        n = name.lower().strip()
-        synonyms = {
-            'phone': 'contact', 'phone number': 'contact', 'mobile': 'contact',
-            'contact number': 'contact', 'doc': 'doctor_assigned', 'doctor': 'doctor_assigned',
-            'assigned doctor': 'doctor_assigned', 'admitted date': 'admitted_date', 'discharge date': 'discharge_date',
-            'age': 'age', 'name': 'name', 'disease': 'disease', 'gender': 'gender', 'role': 'role'
-        }
-        n = re.sub(r"[^a-z0-9 _]", '', n)
-        return synonyms.get(n, n.replace(' ', '_'))
-
-    # two common patterns: field before role/id, or role/id before field
-    p1 = re.compile(r"(?:update|change|set)\s+(?:the\s+)?(?P<field>[a-zA-Z _]+?)\s+(?:of\s+)?(?P<role>patient|staff)(?:_?id)?\s*(?:id\s*)?(?:#|:)?\s*(?P<id>\d+)\s*(?:to|=|as|become)?\s*(?P<value>.+)", re.I)
-    p2 = re.compile(r"(?:update|change|set)\s+(?P<role>patient|staff)(?:_?id)?\s*(?:id\s*)?(?:#|:)?\s*(?P<id>\d+)\s*(?:set\s+)?(?P<field>[a-zA-Z _]+?)\s*(?:to|=|as|become)?\s*(?P<value>.+)", re.I)
-
-    # Helper: extract field->value pairs from a sentence (handles 'and' / commas)
-    def _extract_field_value_pairs(text):
-        parts = re.split(r"\band\b|,|;", text)
-        pairs = {}
-        for p in parts:
-            p = p.strip()
-            # look for patterns like 'age to 45', 'set age to 45', 'contact +91...'
-            m = re.search(r"(?:set|change|update)?\s*(?P<field>[a-zA-Z ]{2,30}?)\s*(?:to|=|as)?\s*(?P<value>.+)$", p, re.I)
-            if m:
-                f = m.group('field').strip()
-                v = m.group('value').strip()
-                if f and v:
-                    pairs[_normalize_field_name(f)] = v
-        return pairs
-
-    # Helper: try to find a name mentioned in text (possessive or following keywords)
-    def _find_name_in_msg(text):
-        # possessive: "john doe's"
-        m = re.search(r"([a-z]+(?:\s+[a-z]+){0,2})'s", text, re.I)
-        if m:
-            return m.group(1).strip()
-        # 'for john doe' or 'of john doe' or 'named john doe'
-        m = re.search(r"(?:for|of|named|called|about)\s+([a-z][a-z\s]{1,80})", text, re.I)
-        if m:
-            return m.group(1).strip()
-        # 'change john doe' pattern
-        m = re.search(r"(?:change|update|set)\s+([a-z][a-z\s]{1,80})\s+(?:'s|\b)", text, re.I)
-        if m:
-            return m.group(1).strip()
-        return None
+    result = dispatch(msg, data)
+    if not g.all_hospitals:
+        chat_history.writer.record(_user_id(data), data.get('message', '').strip(), _reply_text(result))
+    return _present(result, fmt)
 
-    def _resolve_name_to_id(role, name):
-        # Try exact or LIKE match; return id if unique, else None
-        if not name: return None
-        if role == 'patient':
-            rows = run_query("SELECT * FROM patients WHERE name LIKE %s", (f"%{name}%",), fetch=True)
-            if isinstance(rows, list) and len(rows) == 1:
-                return rows[0].get('patient_id')
-        else:
-            rows = run_query("SELECT * FROM staff WHERE name LIKE %s", (f"%{name}%",), fetch=True)
-            if isinstance(rows, list) and len(rows) == 1:
-                return rows[0].get('staff_id')
-        return None
 
-    # Multi-field natural updates and name-based resolution
-    if any(w in msg for w in ('update', 'change', 'set')):
-        # Attempt to determine role and id
-        pid = _extract_id_for_role(msg, 'patient')
-        sid = _extract_id_for_role(msg, 'staff')
-        role = None; rec_id = None
-        if pid:
-            role = 'patient'; rec_id = pid
-        elif sid:
-            role = 'staff'; rec_id = sid
-        else:
-            name = _find_name_in_msg(msg)
-            if name:
-                # prefer patient
-                r = _resolve_name_to_id('patient', name)
-                if r: role = 'patient'; rec_id = r
-                else:
-                    r2 = _resolve_name_to_id('staff', name)
-                    if r2: role = 'staff'; rec_id = r2
-        if role and rec_id:
-            candidates = _extract_field_value_pairs(msg)
-            if candidates:
-                if role == 'patient':
-                    allowed = {'name','age','gender','contact','disease','doctor_assigned','admitted_date','discharge_date'}
-                    table = 'patients'; idcol = 'patient_id'
-                else:
-                    allowed = {'name','role','contact'}
-                    table = 'staff'; idcol = 'staff_id'
-                updates = {k:v for k,v in candidates.items() if k in allowed}
-                if updates:
-                    set_clause = ', '.join([f"{k} = %s" for k in updates.keys()])
-                    params = list(updates.values()) + [rec_id]
-                    q = f"UPDATE {table} SET {set_clause} WHERE {idcol} = %s"
-                    r = run_query(q, tuple(params))
-                    if isinstance(r, str):
-                        return jsonify({'type':'error','message':r}), 500
-                    return jsonify({'type':'success','message':f"{role.capitalize()} {rec_id} updated ({len(updates)} fields)."})
-
-    for m in (p1.search(msg), p2.search(msg)):
-        if m:
-            role = m.group('role').lower()
-            rec_id = int(m.group('id'))
-            raw_field = (m.groupdict().get('field') or '').strip()
-            raw_value = (m.groupdict().get('value') or '').strip()
-            if not raw_field or not raw_value:
-                break
-            field = _normalize_field_name(raw_field)
-            # trim trailing punctuation
-            raw_value = raw_value.rstrip('.;')
-            # allowed columns per role
-            allowed_patient = {'name','age','gender','contact','disease','doctor_assigned','admitted_date','discharge_date'}
-            allowed_staff = {'name','role','contact'}
-            allowed = allowed_patient if role == 'patient' else allowed_staff
-            if field not in allowed:
-                # not a recognized field for this role, skip to normal handlers
-                break
-            # convert value types
-            val = raw_value
-            if field == 'age':
-                # extract first integer
-                iv = re.search(r"(\d{1,3})", val)
-                if iv:
-                    val = int(iv.group(1))
-                else:
-                    # invalid age
-                    return jsonify({'type':'text','message':'Could not parse numeric age from your message.'})
-
-            # Build query
-            if role == 'patient':
-                q = f"UPDATE patients SET {field} = %s WHERE patient_id = %s"
-                params = (val, rec_id)
-            else:
-                q = f"UPDATE staff SET {field} = %s WHERE staff_id = %s"
-                params = (val, rec_id)
-            res = run_query(q, params)
-            if isinstance(res, str):
-                return jsonify({'type':'error','message':res}), 500
-            return jsonify({'type':'success','message':f'{role.capitalize()} {rec_id} updated: {field} -> {val}.'})
-
-    # If OpenAI key is available, try to parse/answer more complex natural language like ChatGPT
-    if os.getenv('OPENAI_API_KEY'):
-        try:
-            import openai, json
-            openai.api_key = os.getenv('OPENAI_API_KEY')
-
-            def _call_openai_parsing(user_text):
-                # Instruct model to return JSON only with a fixed schema
-                system = (
-                    "You are a strict JSON-only parser for a hospital chatbot. "
-                    "When given a user message, output valid JSON with one of the following structures (no extra text):\n"
-                    "1) {\"action\": \"show\", \"target\": \"patient\"|\"staff\", \"id\": <int>|null, \"name\": <string>|null }\n"
-                    "2) {\"action\": \"update\", \"target\": \"patient\"|\"staff\", \"id\": <int>|null, \"fields\": {<field>: <value>, ...} }\n"
-                    "3) {\"action\": \"add\", \"target\": \"patient\"|\"staff\", \"fields\": {<field>: <value>, ...} }\n"
-                    "4) {\"action\": \"text\", \"response\": <string> }\n"
-                    "Only output JSON. If the user asks for an update but no id is provided, try to extract a name and set id to null. Do not include any explanatory text.")
-
-                resp = openai.ChatCompletion.create(
-                    model='gpt-3.5-turbo',
-                    messages=[
-                        {"role":"system","content":system},
-                        {"role":"user","content": user_text}
-                    ],
-                    max_tokens=300,
-                    temperature=0.0
-                )
-                out = resp.choices[0].message.content.strip()
-                # Attempt to extract JSON block
-                try:
-                    return json.loads(out)
-                except Exception:
-                    # Try to find first {...}
-                    m = re.search(r"\{[\s\S]*\}", out)
-                    if m:
-                        try:
-                            return json.loads(m.group(0))
-                        except Exception:
-                            return None
-                    return None
-
-            parsed = _call_openai_parsing(msg)
-            if parsed and isinstance(parsed, dict):
-                action = parsed.get('action')
-                if action == 'show' and parsed.get('target') in ('patient','staff'):
-                    if parsed.get('id'):
-                        if parsed['target']=='patient':
-                            rows = run_query("SELECT * FROM patients WHERE patient_id = %s", (int(parsed['id']),), fetch=True)
-                        else:
-                            rows = run_query("SELECT * FROM staff WHERE staff_id = %s", (int(parsed['id']),), fetch=True)
-                        if isinstance(rows, str):
-                            return jsonify({'type':'error','message':rows}),500
-                        if not rows:
-                            return jsonify({'type':'text','message':'No record found.'})
-                        r = rows[0]
-                        # Ask OpenAI to create a friendly summary if desired
-                        if os.getenv('OPENAI_API_KEY'):
-                            try:
-                                prompt = f"Produce a concise, factual summary for this record: {r}"
-                                resp2 = openai.ChatCompletion.create(model='gpt-3.5-turbo', messages=[{"role":"user","content":prompt}], max_tokens=200, temperature=0.3)
-                                summary = resp2.choices[0].message.content.strip()
-                                return jsonify({'type':'text','message':summary})
-                            except Exception:
-                                pass
-                        parts = [f"{k}: {v if v is not None else 'N/A'}" for k,v in r.items()]
-                        return jsonify({'type':'text','message':'\n'.join(parts)})
-
-                if action == 'update' and parsed.get('target') in ('patient','staff'):
-                    rid = parsed.get('id')
-                    fields = parsed.get('fields') or {}
-                    if not rid:
-                        # If no id, ask user to specify id
-                        return jsonify({'type':'text','message':'Please specify the record id to update (e.g., patient_id 1).'})
-                    allowed_patient = {'name','age','gender','contact','disease','doctor_assigned','admitted_date','discharge_date'}
-                    allowed_staff = {'name','role','contact'}
-                    allowed = allowed_patient if parsed['target']=='patient' else allowed_staff
-                    updates = {k:v for k,v in fields.items() if _normalize_field_name(k) in allowed}
-                    if not updates:
-                        return jsonify({'type':'text','message':'No valid fields detected to update.'})
-                    # normalize keys
-                    updates_norm = { _normalize_field_name(k): v for k,v in updates.items() }
-                    set_clause = ', '.join([f"{k} = %s" for k in updates_norm.keys()])
-                    params = list(updates_norm.values()) + [int(rid)]
-                    if parsed['target']=='patient':
-                        q = f"UPDATE patients SET {set_clause} WHERE patient_id = %s"
-                    else:
-                        q = f"UPDATE staff SET {set_clause} WHERE staff_id = %s"
-                    resu = run_query(q, tuple(params))
-                    if isinstance(resu, str):
-                        return jsonify({'type':'error','message':resu}),500
-                    return jsonify({'type':'success','message':f"{parsed['target'].capitalize()} {rid} updated ({len(updates_norm)} fields)."})
-
-                if action == 'add' and parsed.get('target') in ('patient','staff'):
-                    fields = parsed.get('fields') or {}
-                    if parsed.get('target')=='patient':
-                        q = """INSERT INTO patients (name, age, gender, contact, disease, doctor_assigned) VALUES (%s,%s,%s,%s,%s,%s)"""
-                        vals = (fields.get('name'), fields.get('age'), fields.get('gender'), fields.get('contact'), fields.get('disease'), fields.get('doctor_assigned'))
-                        run_query(q, vals)
-                        return jsonify({'type':'success','message':'Patient added.'})
-                    else:
-                        q = "INSERT INTO staff (name, role, contact) VALUES (%s,%s,%s)"
-                        vals = (fields.get('name'), fields.get('role'), fields.get('contact'))
-                        run_query(q, vals)
-                        return jsonify({'type':'success','message':'Staff added.'})
-
-                if action == 'text' and parsed.get('response'):
-                    return jsonify({'type':'text','message': parsed.get('response')})
-
-        except Exception:
-            # If any error occurs with OpenAI parsing, ignore and continue to default handlers
-            pass
-
-    # --- Add patient ---
-    if 'add patient' in msg:
-        parsed = extract_patient_structured(msg)
-        if not parsed.get('name'):
-            return jsonify({'type': 'error', 'message': 'Please include name, age, gender, disease, and doctor.'}), 400
-        q = """INSERT INTO patients (name, age, gender, contact, disease, doctor_assigned)
-               VALUES (%s, %s, %s, %s, %s, %s)"""
-        run_query(q, (parsed['name'], parsed['age'], parsed['gender'], parsed['contact'],
-                      parsed['disease'], parsed['doctor_assigned']))
-        return jsonify({'type': 'success', 'message': f"Patient '{parsed['name']}' added successfully."})
-
-    # --- Add staff ---
-    if 'add staff' in msg:
-        parsed = extract_staff_structured(msg)
-        if not parsed.get('name'):
-            return jsonify({'type': 'error', 'message': 'Please include name, role, and contact.'}), 400
-        q = "INSERT INTO staff (name, role, contact) VALUES (%s, %s, %s)"
-        run_query(q, (parsed['name'], parsed['role'], parsed['contact']))
-        return jsonify({'type': 'success', 'message': f"Staff '{parsed['name']}' added successfully."})
-
-    # --- Schedule appointment ---
-    if 'schedule appointment' in msg:
-        parsed = extract_appointment_structured(msg)
-        if not all([parsed.get('patient_id'), parsed.get('staff_id'), parsed.get('date'), parsed.get('time')]):
-            return jsonify({'type': 'error', 'message': 'Provide patient_id, staff_id, date, and time.'}), 400
-        q = """INSERT INTO appointments (patient_id, staff_id, appointment_date, appointment_time)
-               VALUES (%s, %s, %s, %s)"""
-        run_query(q, (parsed['patient_id'], parsed['staff_id'], parsed['date'], parsed['time']))
-        return jsonify({'type': 'success', 'message': 'Appointment scheduled successfully.'})
-
-    # --- Show patients ---
-    if 'show patients' in msg:
-        rows = run_query("SELECT * FROM patients ORDER BY patient_id DESC", fetch=True)
-        if isinstance(rows, str):
-            return jsonify({'type': 'error', 'message': rows}), 500
-        rows = rows or []
-        safe_rows = [{k: (str(v) if not isinstance(v, (int, float, str, type(None))) else v) for k, v in r.items()} for r in rows]
-        return jsonify({'type': 'table', 'data': safe_rows})
-
-    # --- Show staff ---
-    if 'show staff' in msg:
-        rows = run_query("SELECT * FROM staff ORDER BY staff_id DESC", fetch=True)
-        if isinstance(rows, str):
-            return jsonify({'type': 'error', 'message': rows}), 500
-        rows = rows or []
-        safe_rows = [{k: (str(v) if not isinstance(v, (int, float, str, type(None))) else v) for k, v in r.items()} for r in rows]
-        return jsonify({'type': 'table', 'data': safe_rows})
-
-    # --- Show appointments ---
-    if 'show appointments' in msg:
-        rows = run_query("""
-            SELECT a.appointment_id, p.name AS patient_name, s.name AS staff_name,
-                   a.appointment_date, a.appointment_time
-            FROM appointments a
-            LEFT JOIN patients p ON a.patient_id = p.patient_id
-            LEFT JOIN staff s ON a.staff_id = s.staff_id
-            ORDER BY a.appointment_id DESC
-        """, fetch=True)
-        if isinstance(rows, str):
-            return jsonify({'type': 'error', 'message': rows}), 500
-        rows = rows or []
-        safe_rows = [{k: (str(v) if not isinstance(v, (int, float, str, type(None))) else v) for k, v in r.items()} for r in rows]
-        return jsonify({'type': 'table', 'data': safe_rows})
-
-    # --- Natural language record lookup (ChatGPT-like answers) ---
-    # Examples that will be handled: "tell me about John Doe", "who is patient 5", "info on staff Dr Smith"
-    def _extract_name_after_keywords(text):
-        m = re.search(r"(?:tell me about|who is|info on|information about|details for|details of)\s+([a-zA-Z.\- ]{2,80})", text)
-        if m:
-            return m.group(1).strip()
-        return None
+# ---------- Batch chat ----------
+# Runs many chat commands through the same handlers on one connection and in
+# one transaction. mode=atomic (default) commits only if every command
+# succeeds. mode=best_effort wraps each command in a savepoint and undoes
+# just the ones that fail. Results come back in request order.
+BATCH_MAX_MESSAGES = int(os.getenv('BATCH_MAX_MESSAGES', 500))
 
-    def _extract_id_for_role(text, role):
-        # look for 'patient 5' or 'patient id 5' or 'staff 3'
-        m = re.search(rf"{role}[^0-9\n\r]*(?:id\s*)?(?:#|:)?\s*(\d+)", text)
-        if m:
-            return int(m.group(1))
-        return None
 
-    # try patient id first
-    # Explicit patterns like 'patient_id 1' or 'patient 1' should return full records
-    pid = _extract_id_for_role(msg, 'patient')
-    if pid:
-        rows = run_query("SELECT * FROM patients WHERE patient_id = %s", (pid,), fetch=True)
-        if isinstance(rows, str):
-            return jsonify({'type': 'error', 'message': rows}), 500
-        if not rows:
-            return jsonify({'type': 'text', 'message': f'No patient found with id {pid}.'})
-        row = rows[0]
-        # Format all available fields into a clear multiline text response
-        parts = []
-        for k, v in row.items():
-            parts.append(f"{k}: {v if v is not None else 'N/A'}")
-        text = "\n".join(parts)
-        return jsonify({'type': 'text', 'message': text})
-
-    # try staff id
-    sid = _extract_id_for_role(msg, 'staff')
-    if sid:
-        rows = run_query("SELECT * FROM staff WHERE staff_id = %s", (sid,), fetch=True)
-        if isinstance(rows, str):
-            return jsonify({'type': 'error', 'message': rows}), 500
-        if not rows:
-            return jsonify({'type': 'text', 'message': f'No staff found with id {sid}.'})
-        row = rows[0]
-        parts = []
-        for k, v in row.items():
-            parts.append(f"{k}: {v if v is not None else 'N/A'}")
-        text = "\n".join(parts)
-        return jsonify({'type': 'text', 'message': text})
-
-    # try name queries (generic)
-    name = _extract_name_after_keywords(msg)
-    if name:
-        # search patients first
-        rows = run_query("SELECT * FROM patients WHERE name LIKE %s", (f"%{name}%",), fetch=True)
-        if isinstance(rows, str):
-            return jsonify({'type': 'error', 'message': rows}), 500
-        if rows and len(rows) == 1:
-            r = rows[0]
-            text = f"Patient {r.get('name')} (ID: {r.get('patient_id')}) is {r.get('age')}-year-old {r.get('gender')}. Contact: {r.get('contact') or 'N/A'}. Diagnosis: {r.get('disease') or 'N/A'}. Assigned doctor: {r.get('doctor_assigned') or 'N/A'}."
-            # Optionally, enhance phrasing with OpenAI if an API key is provided
-            if os.getenv('OPENAI_API_KEY'):
-                try:
-                    import openai
-                    openai.api_key = os.getenv('OPENAI_API_KEY')
-                    prompt = f"Convert this patient record into a clear, friendly paragraph for a doctor or staff member:\n{str(r)}"
-                    resp = openai.Completion.create(engine='text-davinci-003', prompt=prompt, max_tokens=180, temperature=0.3)
-                    nice = resp.choices[0].text.strip()
-                    if nice:
-                        text = nice
-                except Exception:
-                    # If openai isn't installed or the call fails, silently continue with the basic text
-                    pass
-            return jsonify({'type': 'text', 'message': text})
-        if rows and len(rows) > 1:
-            safe_rows = [{k: (str(v) if not isinstance(v, (int, float, str, type(None))) else v) for k, v in r.items()} for r in rows]
-            return jsonify({'type': 'table', 'data': safe_rows})
-
-        # search staff
-        rows = run_query("SELECT * FROM staff WHERE name LIKE %s", (f"%{name}%",), fetch=True)
-        if isinstance(rows, str):
-            return jsonify({'type': 'error', 'message': rows}), 500
-        if rows and len(rows) == 1:
-            r = rows[0]
-            text = f"Staff {r.get('name')} (ID: {r.get('staff_id')}) is a {r.get('role') or 'N/A'}. Contact: {r.get('contact') or 'N/A'}."
-            return jsonify({'type': 'text', 'message': text})
-        if rows and len(rows) > 1:
-            safe_rows = [{k: (str(v) if not isinstance(v, (int, float, str, type(None))) else v) for k, v in r.items()} for r in rows]
-            return jsonify({'type': 'table', 'data': safe_rows})
-
-    return jsonify({'type': 'text', 'message': 'Use: add/show patient/staff or schedule appointment.'})
-
-    # --- Conversational updates ---
-    # Examples: "update patient 1 set age 30 contact +911234567" or "update staff 2 role Nurse contact +..."
-    def _parse_field_pairs(text):
-        # parse pairs like 'age 30', 'contact +9111', 'role Nurse', 'name John Doe'
-        tokens = text.split()
-        pairs = {}
-        i = 0
-        while i < len(tokens):
-            key = tokens[i]
-            # if token looks like 'patient' or 'staff' or 'update' skip
-            if key.lower() in ('update', 'patient', 'staff', 'set', 'id'):
-                i += 1; continue
-            # value may be multiple tokens until next token that looks like a key (letters only) or end
-            j = i + 1
-            vals = []
-            while j < len(tokens) and not re.match(r'^[a-zA-Z_]+$', tokens[j]):
-                vals.append(tokens[j]); j += 1
-            if not vals and j < len(tokens):
-                # take single-word value
-                vals.append(tokens[j]); j += 1
-            pairs[key.lower()] = ' '.join(vals).strip()
-            i = j
-        return pairs
-
-    # update patient
-    if msg.startswith('update patient') or re.search(r'update patient\s+\d+', msg):
-        pid = _extract_id_for_role(msg, 'patient')
-        if not pid:
-            return jsonify({'type': 'text', 'message': 'Please specify the patient id to update (e.g., "update patient 1 ...").'})
-        fields = _parse_field_pairs(msg)
-        allowed = {'name','age','gender','contact','disease','doctor_assigned'}
-        updates = {k: v for k, v in fields.items() if k in allowed and v}
-        if not updates:
-            return jsonify({'type': 'text', 'message': 'No valid fields to update. Allowed: ' + ', '.join(sorted(allowed))})
-        set_clause = ', '.join([f"{k} = %s" for k in updates.keys()])
-        params = list(updates.values()) + [pid]
-        q = f"UPDATE patients SET {set_clause} WHERE patient_id = %s"
-        res = run_query(q, tuple(params))
-        if isinstance(res, str):
-            return jsonify({'type': 'error', 'message': res}), 500
-        return jsonify({'type': 'success', 'message': f'Patient {pid} updated ({len(updates)} fields).'} )
-
-    # update staff
-    if msg.startswith('update staff') or re.search(r'update staff\s+\d+', msg):
-        sid = _extract_id_for_role(msg, 'staff')
-        if not sid:
-            return jsonify({'type': 'text', 'message': 'Please specify the staff id to update (e.g., "update staff 2 role Nurse").'})
-        fields = _parse_field_pairs(msg)
-        allowed = {'name','role','contact'}
-        updates = {k: v for k, v in fields.items() if k in allowed and v}
-        if not updates:
-            return jsonify({'type': 'text', 'message': 'No valid fields to update. Allowed: ' + ', '.join(sorted(allowed))})
-        set_clause = ', '.join([f"{k} = %s" for k in updates.keys()])
-        params = list(updates.values()) + [sid]
-        q = f"UPDATE staff SET {set_clause} WHERE staff_id = %s"
-        res = run_query(q, tuple(params))
-        if isinstance(res, str):
-            return jsonify({'type': 'error', 'message': res}), 500
-        return jsonify({'type': 'success', 'message': f'Staff {sid} updated ({len(updates)} fields).'} )
+class _BatchAborted(Exception):
+    pass
+
+
+def _batch_item(item):
+    # items are plain strings or objects with 'message' plus per-command fields
+    if isinstance(item, dict):
+        return str(item.get('message') or ''), item
+    return str(item or ''), {}
+
+
+def _run_batch_item(raw, opts):
+    msg = raw.lower().strip()
+    if not msg:
+        return {'type': 'error', 'message': 'Empty message'}, 400
+    try:
+        result = dispatch(msg, opts)
+    except Exception as err:
+        app.logger.exception('batch command failed')
+        return {'type': 'error', 'message': f'Command failed: {err}'}, 500
+    return result if isinstance(result, tuple) else (result, 200)
+
+
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch_api():
+    data = request.get_json() or {}
+    items = data.get('messages')
+    mode = data.get('mode', 'atomic')
+    if not isinstance(items, list) or not items:
+        return jsonify({'type': 'error', 'message': 'messages must be a non-empty list.'}), 400
+    if len(items) > BATCH_MAX_MESSAGES:
+        return jsonify({'type': 'error', 'message': f'At most {BATCH_MAX_MESSAGES} messages per batch.'}), 400
+    if mode not in ('atomic', 'best_effort'):
+        return jsonify({'type': 'error', 'message': 'mode must be atomic or best_effort.'}), 400
+    fmt = _response_format(data)
+    if fmt is None:
+        return jsonify({'type': 'error', 'message': 'format must be rows or columns.'}), 400
+
+    results = []
+    failed_at = None
+    try:
+        with db.batch() as tx:
+            for raw, opts in map(_batch_item, items):
+                if mode == 'best_effort':
+                    tx.savepoint()
+                body, status = _run_batch_item(raw, opts)
+                ok = status < 400
+                results.append({'ok': ok, 'status': status, 'result': body})
+                if ok:
+                    if mode == 'best_effort':
+                        tx.release()
+                    continue
+                if mode == 'atomic':
+                    failed_at = len(results) - 1
+                    raise _BatchAborted()
+                tx.rollback_to()
+    except _BatchAborted:
+        pass
+    except db.Error as err:
+        # the transaction itself failed (commit, deadlock, lost connection)
+        return jsonify({'type': 'error', 'message': str(err), 'committed': False,
+                        'results': [dict(r, ok=False, state='rolled_back') for r in results]}), 500
+
+    committed = failed_at is None
+    for r in results:
+        r['state'] = 'committed' if committed and r['ok'] else 'rolled_back'
+    # commands after the one that aborted an atomic batch never ran
+    results += [{'ok': False, 'status': None, 'result': None, 'state': 'skipped'}
+                for _ in items[len(results):]]
+    user_id = _user_id(data)
+    for (raw, _), r in zip(map(_batch_item, items), results):
+        if r['result'] is not None:
+            chat_history.writer.record(user_id, raw.strip(), _reply_text(r['result']))
+    for r in results:
+        if r['result'] is not None:
+            r['result'] = _present(r['result'], fmt)
+    status = 200 if committed else results[failed_at]['status']
+    return jsonify({'type': 'batch', 'mode': mode, 'committed': committed, 'results': results}), status
+
+
+# ---------- Chat history ----------
+@app.route('/api/history')
+def history_api():
+    user_id = request.args.get('user_id') or request.headers.get('X-User-Id')
+    if not user_id:
+        return jsonify({'type': 'error', 'message': 'user_id is required.'}), 400
+    try:
+        page_size = min(max(int(request.args.get('page_size', PAGE_SIZE_DEFAULT)), 1), PAGE_SIZE_MAX)
+    except ValueError:
+        return jsonify({'type': 'error', 'message': 'page_size must be a number.'}), 400
+    before = None
+    if request.args.get('cursor'):
+        before = decode_cursor('history', request.args['cursor'], _history_key)
+        if before is None:
+            return jsonify({'type': 'error', 'message': 'Invalid cursor.'}), 400
+    rows = chat_history.read_history(user_id, page_size + 1, before)
+    if isinstance(rows, str):
+        return jsonify({'type': 'error', 'message': rows}), 500
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor('history', f"{last['timestamp'].isoformat()}|{last['history_id']}")
+    return _present({'type': 'table', 'data': rows, 'next_cursor': next_cursor}, _response_format(request.args) or 'rows')
+
+
+def _history_key(raw):
+    ts, history_id = raw.rsplit('|', 1)
+    return datetime.datetime.fromisoformat(ts), int(history_id)
+
+
+# ---------- Change feed ----------
+# Server-sent events: one snapshot per topic, then a 'change' event for every
+# committed insert or update (the row as "show ..." lists it) and a 'reset'
+# when a bulk import changed too much to send row by row. EventSource resends
+# the last event id on reconnect and the stream resumes from there.
+@app.route('/api/changes')
+def changes_api():
+    if not change_feed.CHANGE_FEED:
+        return jsonify({'type': 'error', 'message': 'The change feed is disabled.'}), 404
+    topics = [t for t in (request.args.get('topics') or ','.join(change_feed.TOPICS)).split(',') if t]
+    unknown = [t for t in topics if t not in change_feed.TOPICS]
+    if unknown:
+        return jsonify({'type': 'error', 'message': f"Unknown topic {unknown[0]!r}."}), 400
+    fmt = _response_format(request.args)
+    if fmt is None:
+        return jsonify({'type': 'error', 'message': 'format must be rows or columns.'}), 400
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_id is not None:
+        try:
+            last_id = int(last_id)
+        except ValueError:
+            return jsonify({'type': 'error', 'message': 'Last-Event-ID must be a number.'}), 400
+    opened = change_feed.open_stream(topics, last_id, request.args.get('snapshot', '1') != '0', fmt)
+    if isinstance(opened, str):
+        return jsonify({'type': 'error', 'message': opened}), 500
+    return Response(change_feed.stream(*opened), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# ---------- Export ----------
+# Streams a whole table as NDJSON or CSV straight off an unbuffered cursor.
+# Appointments can be filtered with ?from=YYYY-MM-DD&to=YYYY-MM-DD.
+EXPORT_BATCH = int(os.getenv('EXPORT_BATCH', 1000))
+
+EXPORTS = {
+    'patients': "SELECT * FROM patients {where} ORDER BY patient_id",
+    'staff': "SELECT * FROM staff {where} ORDER BY staff_id",
+    'appointments': """
+        SELECT a.appointment_id, a.patient_id, p.name AS patient_name,
+               a.staff_id, s.name AS staff_name,
+               a.appointment_date, a.appointment_time
+        FROM appointments a
+        LEFT JOIN patients p ON a.patient_id = p.patient_id
+        LEFT JOIN staff s ON a.staff_id = s.staff_id
+        {where}
+        ORDER BY a.appointment_id
+    """,
+}
+
+
+def _export_value(v):
+    return v if isinstance(v, (int, float, str, type(None))) else str(v)
+
+
+def _ndjson_lines(rows):
+    chunk = []; size = 0
+    for r in rows:
+        line = json.dumps({k: _export_value(v) for k, v in r.items()}) + '\n'
+        chunk.append(line); size += len(line)
+        # flush roughly every few KB rather than per row
+        if size > 8192:
+            yield ''.join(chunk)
+            chunk = []; size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _csv_lines(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    header = False
+    for r in rows:
+        if not header:
+            writer.writerow(r.keys())
+            header = True
+        writer.writerow(['' if v is None else _export_value(v) for v in r.values()])
+        # flush roughly every few KB rather than per row
+        if buf.tell() > 8192:
+            yield buf.getvalue()
+            buf.seek(0); buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+@app.route('/api/export/<table>')
+def export_table(table):
+    if table not in EXPORTS:
+        return jsonify({'type': 'error', 'message': f'Unknown table {table!r}.'}), 404
+    fmt = request.args.get('format', 'ndjson').lower()
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({'type': 'error', 'message': 'format must be ndjson or csv.'}), 400
+
+    clauses = []; params = []
+    for arg, op in (('from', '>='), ('to', '<=')):
+        value = request.args.get(arg)
+        if not value:
+            continue
+        if table != 'appointments':
+            return jsonify({'type': 'error', 'message': 'Date filters apply to appointments only.'}), 400
+        try:
+            params.append(datetime.date.fromisoformat(value))
+        except ValueError:
+            return jsonify({'type': 'error', 'message': f'{arg} must be a date (YYYY-MM-DD).'}), 400
+        clauses.append(f"a.appointment_date {op} %s")
+    where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+
+    rows = db.stream_query(EXPORTS[table].format(where=where), tuple(params), EXPORT_BATCH)
+    if fmt == 'csv':
+        body, mimetype = _csv_lines(rows), 'text/csv'
+    else:
+        body, mimetype = _ndjson_lines(rows), 'application/x-ndjson'
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={table}.{fmt}'})
+
+
+# ---------- Bulk import ----------
+# POST /api/import/<table> with a CSV (header row) or JSONL upload, either as
+# a multipart "file" field or as the raw request body.
+@app.route('/api/import/<table>', methods=['POST'])
+def import_table(table):
+    if table not in bulk_import.IMPORTS:
+        return jsonify({'type': 'error', 'message': f'Unknown table {table!r}.'}), 404
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    filename = (upload.filename or '') if upload else ''
+    fmt = request.args.get('format') or ('csv' if filename.endswith('.csv') or 'csv' in (request.mimetype or '') else 'jsonl')
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'type': 'error', 'message': 'format must be csv or jsonl.'}), 400
+
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if fmt == 'csv' else None)
+    try:
+        report = bulk_import.import_records(table, bulk_import.read_records(text, fmt))
+    except db.Error as err:
+        return jsonify({'type': 'error', 'message': str(err)}), 500
+    return jsonify({'type': 'success', **report.as_dict()})
 
 
 if __name__ == '__main__':
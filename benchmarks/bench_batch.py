@@ -0,0 +1,98 @@
+"""/api/chat/batch on the SQLite stand-in: atomicity check, then throughput.
+
+    python benchmarks/bench_batch.py [--messages 200] [--rounds 5] [--db-delay-ms 0]
+
+An atomic batch whose last command fails must leave the database as it
+found it, so the run fails if the patients count moves. A best_effort batch
+must keep the commands that succeeded.
+
+Then --messages 'add patient' commands run --rounds times, once as one
+atomic batch and once as separate /api/chat requests, through Flask's test
+client (no HTTP). Every statement sleeps --db-delay-ms, standing in for a
+MySQL round-trip. The report is commands per second, best round of each.
+"""
+import argparse, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import standin_db
+
+ADD = ('add patient name: batch patient {i} age: 40 gender: female contact: 98{i:08d} '
+       'disease: flu doctor: dr rao')
+
+
+def setup(delay=0.0):
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_batch_'), 'hospital.db')
+    conn = standin_db.connect(path)
+    standin_db.create_schema(conn)
+    conn.close()
+    import db
+    db._pool = db.ConnectionPool(connect=lambda: standin_db.connect(path, delay))
+    db._pool_pid = os.getpid()
+
+
+def patients():
+    import db
+    with db.request_scope():
+        return db.run_query("SELECT COUNT(*) AS n FROM patients", fetch=True)[0]['n']
+
+
+def check_atomic(client):
+    bad = []
+    before = patients()
+    # the empty message answers 400 after two adds have run
+    body = client.post('/api/chat/batch', json={'mode': 'atomic', 'messages': [ADD.format(i=1), ADD.format(i=2), '']}).get_json()
+    if body['committed'] or patients() != before:
+        bad.append(f"atomic batch with a failing last command: committed={body['committed']}, "
+                   f"patients {before} -> {patients()}")
+    before = patients()
+    body = client.post('/api/chat/batch', json={'mode': 'best_effort', 'messages': [ADD.format(i=3), '', ADD.format(i=4)]}).get_json()
+    if patients() != before + 2:
+        bad.append(f"best_effort batch with one failing command: patients {before} -> {patients()}, expected +2")
+    return bad
+
+
+def _rate(run, n, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        run()
+        took = time.perf_counter() - start
+        best = took if best is None else min(best, took)
+    return n / best
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--messages', type=int, default=200)
+    ap.add_argument('--rounds', type=int, default=5)
+    ap.add_argument('--db-delay-ms', type=float, default=0)
+    args = ap.parse_args()
+    setup(args.db_delay_ms / 1000.0)
+    from app import app
+    client = app.test_client()
+    bad = check_atomic(client)
+    if bad:
+        raise SystemExit("batch atomicity broken:\n  " + '\n  '.join(bad))
+    print("batches commit all or nothing")
+
+    messages = [ADD.format(i=i) for i in range(args.messages)]
+
+    def one_batch():
+        body = client.post('/api/chat/batch', json={'mode': 'atomic', 'messages': messages}).get_json()
+        assert body['committed'], body
+
+    def separate():
+        for msg in messages:
+            assert client.post('/api/chat', json={'message': msg}).status_code == 200
+
+    batched = _rate(one_batch, args.messages, args.rounds)
+    single = _rate(separate, args.messages, args.rounds)
+    print(f"{args.messages} add patient commands, db delay {args.db_delay_ms:g} ms")
+    print(f"  one atomic batch:   {batched:>8.0f}/s")
+    print(f"  separate requests:  {single:>8.0f}/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Per-message intent classification cost: old if-chain vs intents.classify.
+
+    python benchmarks/bench_intents.py [--rounds 2000]
+
+The "before" row replays the cascade chat_api used to run for every
+message (patterns rebuilt per request, every update pattern tried before
+the show/add checks). All rows but the last see each message once, made
+unique with an inert suffix; the last repeats the same few messages, which
+is the only case the memo helps. No database is touched; only routing is
+measured.
+First, every message in ROUTES must reach its intent, or the run fails.
+"""
+import argparse, os, re, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import intents
+
+MESSAGES = [
+    'show patients', 'show staff', 'show appointments',
+    'add patient name: john doe age: 45 gender: male contact: +919876543210 disease: flu doctor: dr smith',
+    'add staff name: alice role: nurse contact: 9876543210',
+    'schedule appointment patient_id 1 staff_id 2 date 2024-05-01 time 10:30',
+    'patient 5', 'staff 2', 'tell me about john doe', 'who is alice',
+    'update the age of patient 4 to 45', 'change the contact of staff 2 to +911234567',
+    'hello there',
+]
+
+# message -> the intent that should answer it; the listings must win over the
+# broad statistics triggers ("by day", "by doctor", "how many")
+ROUTES = {
+    'show patients': intents.SHOW_PATIENTS,
+    'show appointments by day': intents.SHOW_APPOINTMENTS,
+    'show appointments by date': intents.SHOW_APPOINTMENTS,
+    'show patients by doctor': intents.SHOW_PATIENTS,
+    'show patients by disease': intents.SHOW_PATIENTS,
+    'show staff by staff': intents.SHOW_STAFF,
+    'show patients breakdown': intents.SHOW_PATIENTS,
+    'appointments per day': intents.STATS,
+    'patients by doctor': intents.STATS,
+    'how many patients per disease': intents.STATS,
+    'disease breakdown': intents.STATS,
+    'staff load': intents.STATS,
+    'add patient name: amit by day age: 40': intents.ADD_PATIENT,
+    'free slots for staff 3 between 2026-01-05 and 2026-01-07': intents.FREE_SLOTS,
+    'patient 5': intents.PATIENT_BY_ID,
+    'update the age of patient 4 to 45': intents.UPDATE_FIELDS,
+}
+
+
+def check_routes():
+    return [f"{msg!r}: {intents.primary_intent(intents._classify(msg))}, expected {want}"
+            for msg, want in ROUTES.items() if intents.primary_intent(intents._classify(msg)) != want]
+
+
+def legacy_classify(msg):
+    p1 = re.compile(r"(?:update|change|set)\s+(?:the\s+)?(?P<field>[a-zA-Z _]+?)\s+(?:of\s+)?(?P<role>patient|staff)(?:_?id)?\s*(?:id\s*)?(?:#|:)?\s*(?P<id>\d+)\s*(?:to|=|as|become)?\s*(?P<value>.+)", re.I)
+    p2 = re.compile(r"(?:update|change|set)\s+(?P<role>patient|staff)(?:_?id)?\s*(?:id\s*)?(?:#|:)?\s*(?P<id>\d+)\s*(?:set\s+)?(?P<field>[a-zA-Z _]+?)\s*(?:to|=|as|become)?\s*(?P<value>.+)", re.I)
+
+    def _extract_id_for_role(text, role):
+        m = re.search(rf"{role}[^0-9\n\r]*(?:id\s*)?(?:#|:)?\s*(\d+)", text)
+        return int(m.group(1)) if m else None
+
+    if any(w in msg for w in ('update', 'change', 'set')):
+        if _extract_id_for_role(msg, 'patient') or _extract_id_for_role(msg, 'staff'):
+            for p in re.split(r"\band\b|,|;", msg):
+                re.search(r"(?:set|change|update)?\s*(?P<field>[a-zA-Z ]{2,30}?)\s*(?:to|=|as)?\s*(?P<value>.+)$", p.strip(), re.I)
+    for m in (p1.search(msg), p2.search(msg)):
+        if m:
+            return 'update_field'
+    for key in ('add patient', 'add staff', 'schedule appointment',
+                'show patients', 'show staff', 'show appointments'):
+        if key in msg:
+            return key.replace(' ', '_')
+    if _extract_id_for_role(msg, 'patient'):
+        return 'patient_by_id'
+    if _extract_id_for_role(msg, 'staff'):
+        return 'staff_by_id'
+    if re.search(r"(?:tell me about|who is|info on|information about|details for|details of)\s+([a-zA-Z.\- ]{2,80})", msg):
+        return 'name_lookup'
+    return 'fallback'
+
+
+def _time(fn, messages):
+    start = time.perf_counter()
+    for m in messages:
+        fn(m)
+    return (time.perf_counter() - start) / len(messages) * 1e6
+
+
+def _unique(n):
+    # a tail of letters no trigger or extractor reacts to, spelling n in base 4
+    tail = ''
+    while True:
+        n, digit = divmod(n, 4)
+        tail += 'qzjk'[digit]
+        if not n:
+            return ' ' + tail
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--rounds', type=int, default=2000)
+    args = ap.parse_args()
+    wrong = check_routes()
+    if wrong:
+        raise SystemExit("misrouted:\n  " + '\n  '.join(wrong))
+
+    repeated = MESSAGES * args.rounds
+    unique = [m + _unique(n) for n, m in enumerate(repeated)]
+    before = _time(legacy_classify, unique)
+    cold = _time(intents._classify, unique)
+    intents.classify.cache_clear()
+    missed = _time(intents.classify, unique)
+    intents.classify.cache_clear()
+    warm = _time(intents.classify, repeated)
+    # the memo only pays off for repeated messages; every row but the last
+    # sees each message once
+    print(f"{'path':<34}{'us/message':>12}")
+    print(f"{'before (if-chain)':<34}{before:>12.2f}")
+    print(f"{'after (one pass, no memo)':<34}{cold:>12.2f}")
+    print(f"{'after (memoized, unique messages)':<34}{missed:>12.2f}")
+    print(f"{'after (memoized, repeated)':<34}{warm:>12.2f}")
+    print(f"memo: {intents.classify.cache_info()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Name lookup latency: LIKE '%name%' scan vs name_search (ngram FULLTEXT).
+
+    python benchmarks/bench_name_search.py [--sizes 10000,100000,1000000] [--lookups 50]
+
+Needs a MySQL server (DB_HOST/DB_USER/DB_PASS/DB_PORT as for the app). Data
+is generated into a scratch database (BENCH_DB_NAME, default hospital_bench)
+which is dropped and recreated, so it never touches the real tables.
+
+Before timing, every first name and surname is looked up through the index
+alone and through LIKE. A name the index misses (a stopword bigram such as
+the "a" in "amit") fails the run, since name_search would then be paying for
+its LIKE fallback.
+"""
+import argparse, os, random, statistics, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+BENCH_DB = os.getenv('BENCH_DB_NAME', 'hospital_bench')
+os.environ['DB_NAME'] = BENCH_DB
+
+import mysql.connector
+import db, migrate, name_search
+
+FIRST = ['john', 'jane', 'amit', 'priya', 'rahul', 'sneha', 'arjun', 'kavya', 'rohan', 'meera',
+         'vikram', 'anita', 'suresh', 'pooja', 'karan', 'divya', 'manoj', 'neha', 'ravi', 'asha']
+LAST = ['doe', 'smith', 'sharma', 'patel', 'pardeshi', 'iyer', 'reddy', 'nair', 'gupta', 'joshi',
+        'kulkarni', 'deshmukh', 'menon', 'rao', 'singh', 'verma', 'bose', 'das', 'shah', 'mehta']
+
+
+def _name(rng):
+    # a numeric suffix keeps most names rare, like real registries
+    return f"{rng.choice(FIRST)} {rng.choice(LAST)} {rng.randrange(100000):05d}"
+
+
+def _prepare(size, rng):
+    admin = mysql.connector.connect(host=os.getenv('DB_HOST', 'localhost'), user=os.getenv('DB_USER', 'root'),
+                                    password=os.getenv('DB_PASS', 'Yash@2005'), port=int(os.getenv('DB_PORT', 3306)))
+    cur = admin.cursor()
+    cur.execute(f"DROP DATABASE IF EXISTS {BENCH_DB}")
+    cur.execute(f"CREATE DATABASE {BENCH_DB}")
+    cur.execute(f"USE {BENCH_DB}")
+    cur.execute("""CREATE TABLE patients (patient_id INT AUTO_INCREMENT PRIMARY KEY, name VARCHAR(100),
+                   age INT, gender VARCHAR(10), contact VARCHAR(20), disease VARCHAR(100), doctor_assigned VARCHAR(100))""")
+    cur.execute("CREATE TABLE staff (staff_id INT AUTO_INCREMENT PRIMARY KEY, name VARCHAR(100), role VARCHAR(50), contact VARCHAR(20))")
+    names = []
+    for start in range(0, size, 10000):
+        batch = [(_name(rng), rng.randrange(1, 90)) for _ in range(min(10000, size - start))]
+        names += [n for n, _ in batch[:10]]
+        cur.executemany("INSERT INTO patients (name, age) VALUES (%s, %s)", batch)
+        admin.commit()
+    cur.executemany("INSERT INTO staff (name, role) VALUES (%s, 'doctor')", [(_name(rng),) for _ in range(max(size // 100, 10))])
+    # indexes built after loading by the app's own migrations, as on an existing table
+    for name in ('0003_name_fulltext.sql', '0009_name_fulltext_stopwords.sql'):
+        with open(os.path.join(migrate.MIGRATIONS_DIR, name)) as fh:
+            for stmt in migrate.statements(fh.read()):
+                cur.execute(stmt)
+    admin.commit(); admin.close()
+    return names
+
+
+def _timed(fn, queries):
+    samples = []
+    for q in queries:
+        start = time.perf_counter()
+        fn(q)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def check_index(limit=100):
+    """Names whose index lookup returns other rows than LIKE does (both capped at limit)."""
+    bad = []
+    for word in FIRST + LAST:
+        for kind, (table, idcol) in name_search._TABLES.items():
+            indexed = db.run_query(name_search._branch(kind, True), (f'"{word}"', f'"{word}"', f"%{word}%", limit), fetch=True)
+            like = db.run_query(f"SELECT {idcol} AS id FROM {table} WHERE name LIKE %s LIMIT %s", (f"%{word}%", limit), fetch=True)
+            if isinstance(indexed, str) or isinstance(like, str):
+                raise SystemExit(indexed if isinstance(indexed, str) else like)
+            if len(indexed) != len(like):
+                bad.append(f"{kind} {word!r}: index {len(indexed)}, LIKE {len(like)}")
+    return bad
+
+
+def _like(name):
+    # what the chat handlers used to do: two leading-wildcard scans
+    db.run_query("SELECT * FROM patients WHERE name LIKE %s", (f"%{name}%",), fetch=True)
+    db.run_query("SELECT * FROM staff WHERE name LIKE %s", (f"%{name}%",), fetch=True)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--sizes', default='10000,100000,1000000')
+    ap.add_argument('--lookups', type=int, default=50)
+    args = ap.parse_args()
+    rng = random.Random(7)
+
+    print(f"{'patients':>10} {'LIKE p50':>10} {'LIKE p95':>10} {'index p50':>10} {'index p95':>10}  (ms)")
+    for size in [int(s) for s in args.sizes.split(',')]:
+        names = _prepare(size, rng)
+        db.get_pool().close_all()
+        bad = check_index()
+        if bad:
+            raise SystemExit("index misses names LIKE finds:\n  " + '\n  '.join(bad))
+        queries = [rng.choice(names).split(' ', 1)[1] for _ in range(args.lookups)]
+        like = _timed(_like, queries)
+        indexed = _timed(name_search.search_names, queries)
+        print(f"{size:>10} {like[0]:>10.2f} {like[1]:>10.2f} {indexed[0]:>10.2f} {indexed[1]:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""Replay a chat message mix against the Flask app and report latency per intent.
+
+    python benchmarks/chat_replay.py [--db standin|mysql] [--patients 10000] [--staff 200]
+        [--appointments 20000] [--requests 3000] [--concurrency 1] [--messages requests.jsonl]
+        [--mix show_patients=1,patient_by_id=5,...] [--page-size 50]
+        [--json out.json] [--baseline benchmarks/baseline.json] [--save-baseline FILE]
+
+Messages come from synthetic generators (one per intent chat_api handles)
+plus, with --messages, recorded lines from a JSONL file (the "message" field,
+or "title" for backlog-style files). Requests go through Flask's test client,
+so the numbers cover routing, handlers, SQL and JSON but not the HTTP server.
+
+--db standin (default) runs on an embedded SQLite stand-in built fresh in a
+temp directory; --db mysql loads a scratch database (BENCH_DB_NAME, default
+hospital_bench, dropped and rebuilt by migrate.py) on the server given by DB_HOST etc.
+--replicas N adds N stand-in read replicas, refreshed from the primary every
+--replicate-every seconds; with --db mysql, replicas come from DB_REPLICAS.
+OPENAI_API_KEY is ignored unless --llm is passed.
+
+With --baseline the run is compared per intent against a saved report: an
+intent regresses when its p95 grows by more than --tolerance (and by more
+than --min-delta-ms), or overall throughput drops by more than --tolerance.
+Any regression makes the exit status 1. Baselines are only comparable on the
+same machine, database and data sizes; the config is stored with them.
+"""
+import argparse, json, math, os, random, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+BENCH_DB = os.getenv('BENCH_DB_NAME', 'hospital_bench')
+
+import standin_db
+
+DEFAULT_MIX = {
+    'show_patients': 1, 'show_staff': 1, 'show_appointments': 1,
+    'patient_by_id': 5, 'staff_by_id': 3, 'name_lookup': 3,
+    'update_field': 1, 'update_fields': 1,
+    'add_patient': 1, 'add_staff': 1, 'schedule_appointment': 1, 'free_slots': 1,
+    'stats': 1, 'fallback': 1, 'replay': 2,
+}
+
+
+# ---------- Message generators ----------
+# Each takes (rng, world) and returns (message, extra request fields).
+def _show(kind):
+    def gen(rng, world):
+        return f"show {kind}", ({'page_size': world['page_size']} if world['page_size'] else {})
+    return gen
+
+
+GENERATORS = {
+    'show_patients': _show('patients'),
+    'show_staff': _show('staff'),
+    'show_appointments': _show('appointments'),
+    'patient_by_id': lambda rng, w: (f"patient {rng.randrange(1, w['patients'] + 1)}", {}),
+    'staff_by_id': lambda rng, w: (f"staff {rng.randrange(1, w['staff'] + 1)}", {}),
+    'name_lookup': lambda rng, w: (f"tell me about {rng.choice(w['names'])}", {}),
+    'update_field': lambda rng, w: (
+        f"update the age of patient {rng.randrange(1, w['patients'] + 1)} to {rng.randrange(1, 95)}", {}),
+    'update_fields': lambda rng, w: (
+        f"update patient {rng.randrange(1, w['patients'] + 1)} age to {rng.randrange(1, 95)} "
+        f"and contact to 98{rng.randrange(10**8):08d}", {}),
+    'add_patient': lambda rng, w: (
+        f"add patient name: {standin_db.fake_name(rng)} age: {rng.randrange(1, 95)} gender: female "
+        f"contact: 98{rng.randrange(10**8):08d} disease: {rng.choice(standin_db.DISEASES)} doctor: dr rao", {}),
+    'add_staff': lambda rng, w: (
+        f"add staff name: {standin_db.fake_name(rng)} role: {rng.choice(standin_db.ROLES)} "
+        f"contact: 97{rng.randrange(10**8):08d}", {}),
+    'schedule_appointment': lambda rng, w: (
+        f"schedule appointment patient_id: {rng.randrange(1, w['patients'] + 1)} "
+        f"staff_id: {rng.randrange(1, w['staff'] + 1)} date: 2026-{rng.randrange(1, 13):02d}-"
+        f"{rng.randrange(1, 29):02d} time: {rng.randrange(8, 18)}:{rng.choice(['00', '30'])}", {}),
+    'free_slots': lambda rng, w: (
+        "free slots for staff {} between 2026-{m:02d}-01 and 2026-{m:02d}-07".format(
+            rng.randrange(1, w['staff'] + 1), m=rng.randrange(1, 13)), {}),
+    'stats': lambda rng, w: (rng.choice([
+        'how many patients per doctor', 'disease breakdown', 'appointments per day',
+        'staff load', 'hospital census']), {}),
+    'fallback': lambda rng, w: (rng.choice(['hello there', 'what can you do', 'thanks']), {}),
+}
+
+
+def load_messages(path):
+    out = []
+    with open(path, encoding='utf-8') as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            text = item.get('message') or item.get('title')
+            if text:
+                out.append(text)
+    return out
+
+
+def parse_mix(spec):
+    mix = dict(DEFAULT_MIX)
+    for part in filter(None, (spec or '').split(',')):
+        name, _, weight = part.partition('=')
+        if name not in mix:
+            raise SystemExit(f"unknown intent in --mix: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+def build_workload(args, world, recorded):
+    import intents
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    if not recorded:
+        mix.pop('replay')
+    names = [n for n, w in mix.items() if w > 0]
+    weights = [mix[n] for n in names]
+    work = []
+    for _ in range(args.requests):
+        name = rng.choices(names, weights)[0]
+        if name == 'replay':
+            msg = rng.choice(recorded)
+            # recorded lines are labelled by what the router makes of them
+            work.append((f"replay:{intents.primary_intent(intents.classify(msg.lower().strip()))}", msg, {}))
+        else:
+            msg, extra = GENERATORS[name](rng, world)
+            work.append((name, msg, extra))
+    return work
+
+
+# ---------- Database setup ----------
+def setup_standin(args):
+    path = os.path.join(tempfile.mkdtemp(prefix='chat_replay_'), 'hospital.db')
+    conn = standin_db.connect(path)
+    standin_db.create_schema(conn)
+    names = standin_db.populate(conn, args.patients, args.staff, args.appointments, args.seed)
+    conn.close()
+    import db
+    # the app's pool hands out stand-in connections instead of MySQL ones
+    db._pool = db.ConnectionPool(size=args.concurrency + 2, connect=lambda: standin_db.connect(path))
+    db._pool_pid = os.getpid()
+    replicas = [os.path.join(os.path.dirname(path), f'replica{i}.db') for i in range(getattr(args, 'replicas', 0))]
+    if replicas:
+        for replica in replicas:
+            standin_db.replicate(path, replica)
+        db._replicas = [db.Replica(f'standin-replica{i}', db.ConnectionPool(
+            size=args.concurrency + 2, connect=lambda replica=replica: standin_db.connect(replica)))
+            for i, replica in enumerate(replicas)]
+        db._replicas_pid = os.getpid()
+        threading.Thread(target=_replicate, args=(path, replicas, args.replicate_every), daemon=True).start()
+    return names
+
+
+def _replicate(path, replicas, interval):
+    while True:
+        time.sleep(interval)
+        for replica in replicas:
+            standin_db.replicate(path, replica)
+
+
+def setup_mysql(args):
+    import db, migrate
+    admin = db._connect(database=None)
+    cur = admin.cursor()
+    cur.execute(f"DROP DATABASE IF EXISTS {BENCH_DB}")
+    cur.close()
+    admin.close()
+    migrate.migrate(out=lambda line: None)
+    conn = db._connect()
+    names = standin_db.populate(conn, args.patients, args.staff, args.appointments, args.seed)
+    conn.close()
+    return names
+
+
+# ---------- Run ----------
+def percentile(sorted_ms, pct):
+    # nearest-rank, so p99 of 100 samples is the 99th value
+    if not sorted_ms:
+        return 0.0
+    rank = max(math.ceil(pct / 100.0 * len(sorted_ms)) - 1, 0)
+    return sorted_ms[rank]
+
+
+def run(app, work, concurrency, warmup):
+    samples = []  # (label, ms, status)
+    lock = threading.Lock()
+    position = [0]
+
+    def worker():
+        # no cookie jar: each request is its own session, as with many users
+        client = app.test_client(use_cookies=False)
+        while True:
+            with lock:
+                i = position[0]
+                position[0] += 1
+            if i >= len(work):
+                return
+            label, msg, extra = work[i]
+            body = dict(extra, message=msg, user_id=f"bench-{i % 50}")
+            start = time.perf_counter()
+            resp = client.post('/api/chat', json=body)
+            resp.get_data()
+            ms = (time.perf_counter() - start) * 1000
+            if i >= warmup:
+                with lock:
+                    samples.append((label, ms, resp.status_code))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, time.perf_counter() - start
+
+
+def summarize(samples, wall, config):
+    by_intent = {}
+    for label, ms, status in samples:
+        by_intent.setdefault(label, []).append((ms, status))
+
+    def stats(items):
+        ms = sorted(m for m, _ in items)
+        return {'count': len(ms), 'errors': sum(1 for _, s in items if s >= 500),
+                'p50': round(percentile(ms, 50), 3), 'p95': round(percentile(ms, 95), 3),
+                'p99': round(percentile(ms, 99), 3), 'mean': round(sum(ms) / len(ms), 3),
+                'rps': round(len(ms) / wall, 1)}
+
+    report = {'config': config, 'wall_seconds': round(wall, 3),
+              'overall': stats([(m, s) for _, m, s in samples]),
+              'intents': {k: stats(v) for k, v in sorted(by_intent.items())}}
+    return report
+
+
+def print_report(report):
+    print(f"{'intent':<34}{'count':>7}{'err':>5}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}")
+    rows = list(report['intents'].items()) + [('OVERALL', report['overall'])]
+    for name, s in rows:
+        print(f"{name:<34}{s['count']:>7}{s['errors']:>5}{s['p50']:>9.2f}{s['p95']:>9.2f}{s['p99']:>9.2f}{s['rps']:>9.1f}")
+
+
+def compare(report, baseline, tolerance, min_delta):
+    """Regression messages, empty when the run is within tolerance of the baseline."""
+    problems = []
+    if baseline.get('config') != report['config']:
+        print("warning: baseline was recorded with a different config; comparison is approximate")
+    for name, base in baseline.get('intents', {}).items():
+        cur = report['intents'].get(name)
+        if cur is None:
+            continue
+        limit = max(base['p95'] * (1 + tolerance), base['p95'] + min_delta)
+        if cur['p95'] > limit:
+            problems.append(f"{name}: p95 {cur['p95']:.2f}ms vs baseline {base['p95']:.2f}ms")
+        if cur['errors'] > base['errors']:
+            problems.append(f"{name}: {cur['errors']} errors vs baseline {base['errors']}")
+    base_rps = baseline.get('overall', {}).get('rps')
+    if base_rps and report['overall']['rps'] < base_rps * (1 - tolerance):
+        problems.append(f"throughput {report['overall']['rps']:.1f} req/s vs baseline {base_rps:.1f}")
+    return problems
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--db', choices=('standin', 'mysql'), default='standin')
+    ap.add_argument('--patients', type=int, default=10000)
+    ap.add_argument('--staff', type=int, default=200)
+    ap.add_argument('--appointments', type=int, default=20000)
+    ap.add_argument('--requests', type=int, default=3000)
+    ap.add_argument('--warmup', type=int, default=100)
+    ap.add_argument('--concurrency', type=int, default=1, help='client threads; above 1 mostly measures GIL and lock contention')
+    ap.add_argument('--messages', help='JSONL file of recorded messages to mix in')
+    ap.add_argument('--mix', help='intent=weight overrides, comma separated')
+    ap.add_argument('--page-size', type=int, default=50, help='page_size for show intents; 0 lists whole tables')
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--replicas', type=int, default=0, help='stand-in read replicas')
+    ap.add_argument('--replicate-every', type=float, default=0.5, help='seconds between stand-in replica refreshes')
+    ap.add_argument('--llm', action='store_true', help='keep OPENAI_API_KEY (e.g. pointed at tools/stub_llm.py)')
+    ap.add_argument('--json', help='write the report here')
+    ap.add_argument('--baseline', help='compare against this report')
+    ap.add_argument('--save-baseline', help='write the report as a new baseline')
+    ap.add_argument('--tolerance', type=float, default=0.3)
+    ap.add_argument('--min-delta-ms', type=float, default=1.0)
+    args = ap.parse_args()
+
+    if not args.llm:
+        os.environ.pop('OPENAI_API_KEY', None)
+    if args.db == 'mysql':
+        os.environ['DB_NAME'] = BENCH_DB
+    os.environ.setdefault('DB_POOL_SIZE', str(args.concurrency + 2))
+
+    names = setup_standin(args) if args.db == 'standin' else setup_mysql(args)
+    from app import app
+    import chat_history
+
+    recorded = load_messages(args.messages) if args.messages else []
+    world = {'patients': args.patients, 'staff': args.staff, 'names': names, 'page_size': args.page_size}
+    work = build_workload(args, world, recorded)
+    samples, wall = run(app, work, args.concurrency, args.warmup)
+    chat_history.writer.close()
+
+    config = {'db': args.db, 'patients': args.patients, 'staff': args.staff, 'appointments': args.appointments,
+              'requests': args.requests, 'warmup': args.warmup, 'concurrency': args.concurrency,
+              'page_size': args.page_size, 'mix': parse_mix(args.mix), 'messages': len(recorded), 'seed': args.seed}
+    if args.replicas:
+        config['replicas'] = args.replicas
+    report = summarize(samples, wall, config)
+    print_report(report)
+    import db
+    for r in db.replica_stats():
+        print(f"replica {r['name']}: {r['reads']} reads, healthy={r['healthy']}, lag={r['lag']}, ejections={r['ejections']}")
+
+    for path in filter(None, (args.json, args.save_baseline)):
+        with open(path, 'w') as fh:
+            json.dump(report, fh, indent=2)
+            fh.write('\n')
+    if args.baseline:
+        with open(args.baseline) as fh:
+            problems = compare(report, json.load(fh), args.tolerance, args.min_delta_ms)
+        for p in problems:
+            print(f"REGRESSION {p}")
+        if problems:
+            sys.exit(1)
+        print("no regressions against baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Compare gunicorn worker modes under many concurrent chats with slow I/O.
+
+    python benchmarks/serve_bench.py [--modes sync,gevent] [--workers 3] [--concurrency 200]
+        [--requests 2000] [--llm-delay-ms 300] [--db-delay-ms 5] [--patients 5000] [--json out.json]
+
+Each mode gets a real gunicorn server (using the project's gunicorn.conf.py)
+in front of the app on the SQLite stand-in. Every statement sleeps
+--db-delay-ms, like a round-trip to MySQL. OPENAI_API_BASE points at
+tools/stub_llm.py, which answers after --llm-delay-ms. Client threads keep
+--concurrency chats open and post the chat_replay message mix over HTTP.
+The report gives throughput and latency per mode. Timings are only
+comparable between modes of the same run.
+"""
+import argparse, json, os, socket, subprocess, sys, tempfile, threading, time, urllib.error, urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+import standin_db
+import chat_replay
+import stub_llm
+
+# LLM-answerable lookups dominate; writes stay in so locks and commits are exercised
+BENCH_MIX = ('show_patients=1,show_staff=0,show_appointments=0,patient_by_id=5,staff_by_id=3,name_lookup=3,'
+             'update_field=1,update_fields=0,add_patient=1,add_staff=0,schedule_appointment=1,free_slots=1,stats=1,fallback=1')
+
+
+def standin_app():
+    # gunicorn app factory (runs in each worker): the real app on the stand-in database
+    import db
+    from app import app
+    path = os.environ['STANDIN_DB']
+    delay = float(os.getenv('STANDIN_DELAY_MS', 0)) / 1000.0
+    db._pool = db.ConnectionPool(connect=lambda: standin_db.connect(path, delay))
+    db._pool_pid = os.getpid()
+    return app
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(url, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"gunicorn exited with status {proc.returncode}")
+        try:
+            urllib.request.urlopen(url + '/api/health', timeout=2).read()
+            return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    raise SystemExit('gunicorn did not come up in time')
+
+
+def serve(mode, args, db_path, llm_base):
+    port = _free_port()
+    env = dict(os.environ, STANDIN_DB=db_path, STANDIN_DELAY_MS=str(args.db_delay_ms),
+               OPENAI_API_KEY='stub', OPENAI_API_BASE=llm_base, GUNICORN_WORKER_CLASS=mode,
+               METRICS_DIR=os.path.join(os.path.dirname(db_path), f'metrics-{mode}'))
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+                             '--workers', str(args.workers), '--bind', f'127.0.0.1:{port}',
+                             '--timeout', '120', '--backlog', '4096', '--log-level', 'warning',
+                             '--pythonpath', f'{ROOT},{HERE}', 'serve_bench:standin_app()'],
+                            cwd=ROOT, env=env)
+    url = f'http://127.0.0.1:{port}'
+    _wait_ready(url, proc)
+    return proc, url
+
+
+def run(url, work, concurrency):
+    samples = []  # (label, ms, status)
+    lock = threading.Lock()
+    position = [0]
+
+    def worker():
+        while True:
+            with lock:
+                i = position[0]
+                position[0] += 1
+            if i >= len(work):
+                return
+            label, msg, extra = work[i]
+            body = json.dumps(dict(extra, message=msg, user_id=f"bench-{i % 50}")).encode()
+            req = urllib.request.Request(url + '/api/chat', data=body, headers={'Content-Type': 'application/json'})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(req, timeout=120) as resp:
+                    resp.read()
+                    status = resp.status
+            except urllib.error.HTTPError as err:
+                err.read()
+                status = err.code
+            except OSError:
+                status = 599
+            ms = (time.perf_counter() - start) * 1000
+            with lock:
+                samples.append((label, ms, status))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, time.perf_counter() - start
+
+
+def summarize(samples, wall):
+    ms = sorted(m for _, m, _ in samples)
+    return {'count': len(ms), 'errors': sum(1 for _, _, s in samples if s >= 500),
+            'p50': round(chat_replay.percentile(ms, 50), 1), 'p95': round(chat_replay.percentile(ms, 95), 1),
+            'p99': round(chat_replay.percentile(ms, 99), 1), 'max': round(ms[-1], 1) if ms else 0.0,
+            'rps': round(len(ms) / wall, 1)}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--modes', default='sync,gevent')
+    ap.add_argument('--workers', type=int, default=3)
+    ap.add_argument('--concurrency', type=int, default=200)
+    ap.add_argument('--requests', type=int, default=2000)
+    ap.add_argument('--llm-delay-ms', type=float, default=300)
+    ap.add_argument('--db-delay-ms', type=float, default=5)
+    ap.add_argument('--patients', type=int, default=5000)
+    ap.add_argument('--staff', type=int, default=200)
+    ap.add_argument('--appointments', type=int, default=10000)
+    ap.add_argument('--mix', default=BENCH_MIX)
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--json', help='write the report here')
+    args = ap.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix='serve_bench_'), 'hospital.db')
+    conn = standin_db.connect(db_path)
+    standin_db.create_schema(conn)
+    names = standin_db.populate(conn, args.patients, args.staff, args.appointments, args.seed)
+    conn.close()
+
+    llm_port = _free_port()
+    llm_server = stub_llm.serve(llm_port, args.llm_delay_ms)
+    threading.Thread(target=llm_server.serve_forever, daemon=True).start()
+    llm_base = f'http://127.0.0.1:{llm_port}/v1'
+
+    world = {'patients': args.patients, 'staff': args.staff, 'names': names, 'page_size': 50}
+    work = chat_replay.build_workload(args, world, [])
+
+    report = {'config': {k: v for k, v in vars(args).items() if k != 'json'}, 'modes': {}}
+    print(f"{'mode':<10}{'count':>7}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'req/s':>9}")
+    for mode in filter(None, args.modes.split(',')):
+        proc, url = serve(mode, args, db_path, llm_base)
+        try:
+            samples, wall = run(url, work, args.concurrency)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+        s = report['modes'][mode] = summarize(samples, wall)
+        print(f"{mode:<10}{s['count']:>7}{s['errors']:>5}{s['p50']:>10.1f}{s['p95']:>10.1f}"
+              f"{s['p99']:>10.1f}{s['max']:>10.1f}{s['rps']:>9.1f}")
+    llm_server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(report, fh, indent=2)
+            fh.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Embedded stand-in for MySQL, used by the benchmarks when no server is around.
+
+The app's SQLite backend (sqlite_backend.py) with two additions for
+benchmarking. A per-statement delay stands in for the network round-trip
+and server time of a real MySQL query. Read replicas are separate files
+brought up to date with replicate(). Timings are only comparable with other
+stand-in runs, never with MySQL.
+
+Each replica answers SHOW REPLICA STATUS: Seconds_Behind_Source is 0 until
+its source is written to again, then the seconds since the last
+replicate(). A file never replicated into reports no status, like a server
+that isn't a replica.
+"""
+import os, random, re, sqlite3, time
+import sqlite_backend
+from sqlite_backend import SCHEMA, create_schema
+
+_REPLICA_STATUS = re.compile(r"^\s*SHOW\s+(?:REPLICA|SLAVE)\s+STATUS\s*$", re.I)
+
+
+def _replica_status(cur):
+    exists = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'standin_replication'").fetchone()
+    if not exists:
+        return "SELECT NULL AS Seconds_Behind_Source WHERE 0", ()
+    source, synced_at = cur.execute("SELECT source, synced_at FROM standin_replication").fetchone()
+    # caught up until the source is written to again, then behind since the last sync
+    changed = max((os.path.getmtime(p) for p in (source, source + '-wal') if os.path.exists(p)), default=0)
+    lag = 0 if changed <= synced_at else int(time.time() - synced_at)
+    return "SELECT %s AS Seconds_Behind_Source", (lag,)
+
+
+class StandinCursor(sqlite_backend.Cursor):
+    def execute(self, query, params=()):
+        if self._conn.delay:
+            time.sleep(self._conn.delay)
+        if _REPLICA_STATUS.match(query):
+            query, params = _replica_status(self._cur)
+        super().execute(query, params)
+
+    def executemany(self, query, seq):
+        if self._conn.delay:
+            time.sleep(self._conn.delay)
+        super().executemany(query, seq)
+
+
+class StandinConnection(sqlite_backend.Connection):
+    cursor_class = StandinCursor
+
+    def __init__(self, path, delay=0.0):
+        # delay: seconds added to every statement, standing in for the network
+        # round-trip and server time of a real MySQL query
+        super().__init__(path)
+        self.delay = delay
+
+    def commit(self):
+        # COMMIT is a round-trip of its own on MySQL
+        if self.delay:
+            time.sleep(self.delay)
+        super().commit()
+
+
+def connect(path, delay=0.0):
+    return StandinConnection(path, delay)
+
+
+def replicate(source_path, replica_path):
+    """Bring a replica file up to date with its source, as a replica applying the source's log would."""
+    src = sqlite3.connect(source_path, timeout=10)
+    dst = sqlite3.connect(replica_path, timeout=10)
+    try:
+        synced_at = time.time()
+        src.backup(dst)
+        dst.execute("CREATE TABLE IF NOT EXISTS standin_replication (source TEXT, synced_at REAL)")
+        dst.execute("DELETE FROM standin_replication")
+        dst.execute("INSERT INTO standin_replication VALUES (?, ?)", (os.path.abspath(source_path), synced_at))
+        dst.commit()
+    finally:
+        src.close()
+        dst.close()
+
+
+# ---------- Synthetic data ----------
+FIRST = ['john', 'jane', 'amit', 'priya', 'rahul', 'sneha', 'arjun', 'kavya', 'rohan', 'meera',
+         'vikram', 'anita', 'suresh', 'pooja', 'karan', 'divya', 'manoj', 'neha', 'ravi', 'asha']
+LAST = ['doe', 'smith', 'sharma', 'patel', 'pardeshi', 'iyer', 'reddy', 'nair', 'gupta', 'joshi',
+        'kulkarni', 'deshmukh', 'menon', 'rao', 'singh', 'verma', 'bose', 'das', 'shah', 'mehta']
+DISEASES = ['flu', 'fever', 'diabetes', 'asthma', 'fracture', 'migraine', 'covid', 'malaria']
+ROLES = ['doctor', 'nurse', 'surgeon', 'technician', 'receptionist']
+
+
+def fake_name(rng):
+    # letters only, so the chat extractors accept it back as a name value
+    suffix = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(5))
+    return f"{rng.choice(FIRST)} {rng.choice(LAST)} {suffix}"
+
+
+def populate(conn, patients, staff, appointments, seed=0, chunk=5000):
+    """Fill an empty schema; returns a sample of the generated names for lookups."""
+    rng = random.Random(seed)
+    cur = conn.cursor()
+    names = []
+    for start in range(0, patients, chunk):
+        rows = [(fake_name(rng), rng.randrange(1, 95), rng.choice(['Male', 'Female']),
+                 f"98{rng.randrange(10**8):08d}", rng.choice(DISEASES), f"dr {rng.choice(LAST)}")
+                for _ in range(min(chunk, patients - start))]
+        names += [r[0] for r in rows[:20]]
+        cur.executemany("INSERT INTO patients (name, age, gender, contact, disease, doctor_assigned) "
+                        "VALUES (%s, %s, %s, %s, %s, %s)", rows)
+        conn.commit()
+    rows = [(fake_name(rng), rng.choice(ROLES), f"97{rng.randrange(10**8):08d}") for _ in range(staff)]
+    names += [r[0] for r in rows[:20]]
+    cur.executemany("INSERT INTO staff (name, role, contact) VALUES (%s, %s, %s)", rows)
+    conn.commit()
+    for start in range(0, appointments, chunk):
+        rows = [(rng.randrange(1, patients + 1), rng.randrange(1, staff + 1),
+                 f"2026-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}",
+                 f"{rng.randrange(8, 18):02d}:{rng.choice(['00', '15', '30', '45'])}:00")
+                for _ in range(min(chunk, appointments - start))]
+        cur.executemany("INSERT INTO appointments (patient_id, staff_id, appointment_date, appointment_time) "
+                        "VALUES (%s, %s, %s, %s)", rows)
+        conn.commit()
+    # the statistics counters start out matching the rows, as after migration 0007
+    import hospital_stats
+    for metric in hospital_stats.METRICS:
+        counted = hospital_stats.recount(cur, metric)
+        cur.executemany("INSERT INTO hospital_stats (metric, bucket, n) VALUES (%s, %s, %s)",
+                        [(metric, b, n) for b, n in counted.items()])
+    conn.commit()
+    cur.close()
+    return names
@@ -0,0 +1,135 @@
+import csv, json, os
+import db
+from ai_chat import validate_patient, validate_staff, validate_appointment
+from intents import normalize_field_name
+from record_cache import records
+import change_feed
+import hospital_stats
+
+# ---------- Bulk import ----------
+# Rows are validated with the same rules the chat extractors use, then
+# inserted IMPORT_CHUNK at a time with executemany, one transaction per
+# chunk. A chunk the database rejects (bad foreign key, ...) is rolled back
+# and replayed row by row behind savepoints so only the offending rows fail.
+IMPORT_CHUNK = int(os.getenv('IMPORT_CHUNK', 1000))
+# per-row errors beyond this are counted but not listed
+MAX_REPORTED_ERRORS = 1000
+
+IMPORTS = {
+    'patients': (validate_patient, 'patient',
+                 "INSERT INTO patients (name, age, gender, contact, disease, doctor_assigned) VALUES (%s, %s, %s, %s, %s, %s)",
+                 ('name', 'age', 'gender', 'contact', 'disease', 'doctor_assigned')),
+    'staff': (validate_staff, 'staff',
+              "INSERT INTO staff (name, role, contact) VALUES (%s, %s, %s)",
+              ('name', 'role', 'contact')),
+    'appointments': (validate_appointment, 'appointment',
+                     "INSERT INTO appointments (patient_id, staff_id, appointment_date, appointment_time) VALUES (%s, %s, %s, %s)",
+                     ('patient_id', 'staff_id', 'date', 'time')),
+}
+
+# column headings accepted in addition to the field names themselves
+_ALIASES = {'appointment_date': 'date', 'appointment_time': 'time'}
+
+
+def _normalize_keys(record):
+    out = {}
+    for k, v in record.items():
+        if k is None:
+            continue
+        key = normalize_field_name(str(k))
+        out[_ALIASES.get(key, key)] = v
+    return out
+
+
+def read_records(stream, fmt):
+    """Yields (row number, record dict or None if unparseable) from a text stream."""
+    if fmt == 'csv':
+        for n, record in enumerate(csv.DictReader(stream), 1):
+            yield n, _normalize_keys(record)
+        return
+    for n, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield n, None
+            continue
+        yield n, _normalize_keys(record) if isinstance(record, dict) else None
+
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def fail(self, row, messages):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'errors': messages})
+
+    def as_dict(self):
+        return {'inserted': self.inserted, 'failed': self.failed, 'errors': self.errors,
+                'errors_truncated': self.failed > len(self.errors)}
+
+
+def _insert_chunk(kind, query, chunk, report):
+    values = [v for _, v in chunk]
+    try:
+        with db.transaction() as cursor:
+            cursor.executemany(query, values)
+            first_id = cursor.lastrowid
+            # counts the id range, as _invalidate_range does; reconcile covers the rest
+            hospital_stats.changed(cursor, kind, first_id, len(values))
+        report.inserted += len(values)
+        _invalidate_range(kind, first_id, len(values))
+        return
+    except db.Error:
+        pass
+    # isolate the bad rows; the good ones still commit together
+    with db.transaction() as cursor:
+        for row, vals in chunk:
+            cursor.execute("SAVEPOINT import_row")
+            try:
+                cursor.execute(query, vals)
+            except db.Error as err:
+                cursor.execute("ROLLBACK TO SAVEPOINT import_row")
+                report.fail(row, [err.msg])
+                continue
+            report.inserted += 1
+            records.invalidate(kind, cursor.lastrowid)
+            hospital_stats.changed(cursor, kind, cursor.lastrowid)
+
+
+def _invalidate_range(kind, first_id, count):
+    # a multi-row INSERT hands out consecutive ids (innodb_autoinc_lock_mode
+    # <= 1); with interleaved mode any stale negative entry ages out by TTL
+    if first_id:
+        for rec_id in range(first_id, first_id + count):
+            records.invalidate(kind, rec_id)
+
+
+def import_records(table, numbered_records, chunk_size=None):
+    validate, kind, query, columns = IMPORTS[table]
+    chunk_size = chunk_size or IMPORT_CHUNK
+    report = ImportReport()
+    chunk = []
+    for row, record in numbered_records:
+        if record is None:
+            report.fail(row, ['not a JSON object'])
+            continue
+        data, errors = validate(record)
+        if errors:
+            report.fail(row, errors)
+            continue
+        chunk.append((row, tuple(data[c] for c in columns)))
+        if len(chunk) >= chunk_size:
+            _insert_chunk(kind, query, chunk, report)
+            chunk = []
+    if chunk:
+        _insert_chunk(kind, query, chunk, report)
+    if report.inserted:
+        # too many rows to stream one by one; change feed clients reload the table
+        change_feed.publish(kind, 'reset')
+    return report
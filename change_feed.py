@@ -0,0 +1,320 @@
+import json, os, queue, sqlite3, tempfile, threading, time
+import db
+import response_format
+
+# ---------- Change feed ----------
+# Write paths publish (topic, op, id) after their commit. Events go to an
+# append-only SQLite log (WAL mode) that every worker on the host shares,
+# a local stand-in for a message broker. The log's event_id is the SSE event
+# id. In each worker one poller thread tails the log, loads each changed row
+# once and writes the SSE frame once, then hands the same frame to every
+# subscriber of that topic in the process. A client that reconnects with
+# Last-Event-ID gets the events it missed from the log, or a fresh snapshot
+# when those events have been trimmed. Open streams hold a request each, so
+# the feed is off unless the workers are gevent (gunicorn.conf.py turns it on
+# for GUNICORN_WORKER_CLASS=gevent); a sync worker would be tied up by every
+# open listing. Events are logged per hospital ("patients@3"), and a client
+# hears only the hospital its request was for.
+CHANGE_FEED = os.getenv('CHANGE_FEED', '0') != '0'
+CHANGE_FEED_LOG = os.getenv('CHANGE_FEED_LOG', os.path.join(tempfile.gettempdir(), 'hms-changes.db'))
+CHANGE_FEED_RETENTION = int(os.getenv('CHANGE_FEED_RETENTION', 10000))
+CHANGE_FEED_POLL_INTERVAL = float(os.getenv('CHANGE_FEED_POLL_INTERVAL', 0.2))
+CHANGE_FEED_HEARTBEAT = float(os.getenv('CHANGE_FEED_HEARTBEAT', 15))
+CHANGE_FEED_CLIENT_BUFFER = int(os.getenv('CHANGE_FEED_CLIENT_BUFFER', 1000))
+
+# topic -> (record cache kind, query with a {where} slot, key column). Rows
+# have the same columns as the matching "show ..." listing.
+TOPICS = {
+    'patients': ('patient', "SELECT * FROM patients {where} ORDER BY patient_id", 'patient_id'),
+    'staff': ('staff', "SELECT * FROM staff {where} ORDER BY staff_id", 'staff_id'),
+    'appointments': ('appointment', """
+        SELECT a.appointment_id, p.name AS patient_name, s.name AS staff_name,
+               a.appointment_date, a.appointment_time
+        FROM appointments a
+        LEFT JOIN patients p ON a.patient_id = p.patient_id
+        LEFT JOIN staff s ON a.staff_id = s.staff_id
+        {where}
+        ORDER BY a.appointment_id
+    """, 'a.appointment_id'),
+}
+_TOPIC_OF = {kind: topic for topic, (kind, _, _) in TOPICS.items()}
+
+
+def log_topic(topic, hospital):
+    return f"{topic}@{hospital}"
+
+
+def _split(logged):
+    topic, _, hospital = logged.partition('@')
+    return topic, int(hospital) if hospital else db.DB_HOSPITAL_ID
+
+
+class EventLog:
+    def __init__(self, path, retention):
+        self.path = path
+        self.retention = retention
+        self._local = threading.local()
+        self._appends = 0
+        self._conn().execute("""CREATE TABLE IF NOT EXISTS change_events (
+            event_id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, op TEXT, rec_id INTEGER, created REAL)""")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def append(self, topic, op, rec_id):
+        conn = self._conn()
+        event_id = conn.execute("INSERT INTO change_events (topic, op, rec_id, created) VALUES (?, ?, ?, ?)",
+                                (topic, op, rec_id, time.time())).lastrowid
+        self._appends += 1
+        if self._appends % 500 == 0:
+            conn.execute("DELETE FROM change_events WHERE event_id <= ?", (event_id - self.retention,))
+        return event_id
+
+    def read(self, after, upto=None, limit=1000):
+        """[(event_id, topic, op, rec_id), ...] with after < event_id <= upto, oldest first."""
+        query = "SELECT event_id, topic, op, rec_id FROM change_events WHERE event_id > ?"
+        params = [after]
+        if upto is not None:
+            query += " AND event_id <= ?"
+            params.append(upto)
+        return self._conn().execute(query + " ORDER BY event_id LIMIT ?", params + [limit]).fetchall()
+
+    def last_id(self):
+        return self._conn().execute("SELECT COALESCE(MAX(event_id), 0) FROM change_events").fetchone()[0]
+
+    def covers(self, after, upto):
+        # True when every event in (after, upto] is still in the log
+        if after > upto:
+            return False  # the log was recreated since the client last saw it
+        if after == upto:
+            return True
+        first = self._conn().execute("SELECT MIN(event_id) FROM change_events").fetchone()[0]
+        return first is not None and first <= after + 1
+
+
+log = EventLog(CHANGE_FEED_LOG, CHANGE_FEED_RETENTION) if CHANGE_FEED else None
+
+
+def publish(kind, op, rec_id=None):
+    """Record a change to a patient/staff/appointment once the current transaction commits.
+
+    op is 'insert', 'update' or 'reset' (many rows changed; clients reload the topic).
+    """
+    if log is None or (rec_id is None and op != 'reset'):
+        return
+    topic = log_topic(_TOPIC_OF[kind], db.hospital())
+    db.after_commit(lambda: _append(topic, op, rec_id))
+
+
+def _append(topic, op, rec_id):
+    try:
+        log.append(topic, op, rec_id)
+        hub.count('published')
+    except sqlite3.Error:
+        hub.count('errors')
+
+
+# ---------- Frames ----------
+def _frame(event_id, event, payload):
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
+
+
+def load_rows(topic, ids=None):
+    """Rows of a topic (all of them, or just ids) as {key: row}, or an error string."""
+    _, query, key_col = TOPICS[topic]
+    where, params = '', ()
+    if ids is not None:
+        ids = sorted(set(ids))
+        where = f"WHERE {key_col} IN ({', '.join(['%s'] * len(ids))})"
+        params = tuple(ids)
+    # from the primary: the events are for commits a replica may not have yet
+    rows = db.run_query(query.format(where=where), params, fetch=True, primary=True)
+    if isinstance(rows, str):
+        return rows
+    field = key_col.split('.')[-1]
+    return {r[field]: r for r in rows}
+
+
+def change_frames(events):
+    """{logged topic: [(event_id, frame), ...]} for a run of log events, or an error string.
+
+    Repeated changes to one record collapse into its last event.
+    """
+    last = {}
+    for event_id, topic, op, rec_id in events:
+        if _split(topic)[0] not in TOPICS:
+            continue
+        key = (topic, rec_id if op != 'reset' else ('reset', event_id))
+        # an insert followed by updates is still an insert to the client
+        last[key] = (event_id, last[key][1] if key in last else op)
+    wanted = {}
+    for (topic, rec_id), (_, op) in last.items():
+        if op != 'reset':
+            wanted.setdefault(topic, []).append(rec_id)
+    loaded = {}
+    for topic, ids in wanted.items():
+        name, hospital = _split(topic)
+        with db.request_scope(hospital=hospital):
+            rows = load_rows(name, ids)
+        if isinstance(rows, str):
+            return rows
+        loaded[topic] = rows
+    out = {}
+    for (topic, rec_id), (event_id, op) in sorted(last.items(), key=lambda item: item[1][0]):
+        if op == 'reset':
+            frame = _frame(event_id, 'reset', {'topic': _split(topic)[0]})
+        else:
+            row = loaded[topic].get(rec_id)
+            payload = {'topic': _split(topic)[0], 'op': op if row is not None else 'delete', 'id': rec_id,
+                       'row': response_format.safe_rows([row])[0] if row is not None else None}
+            frame = _frame(event_id, 'change', payload)
+        out.setdefault(topic, []).append((event_id, frame))
+    return out
+
+
+def snapshot_frames(topics, event_id, fmt):
+    frames = []
+    for topic in topics:
+        rows = load_rows(topic)
+        if isinstance(rows, str):
+            return rows
+        body = response_format.shape_table({'data': list(rows.values())}, fmt)
+        frames.append(_frame(event_id, 'snapshot', dict(body, topic=topic)))
+    return frames
+
+
+# ---------- Fan-out ----------
+class Subscriber:
+    def __init__(self, topics):
+        self.topics = set(topics)
+        self.queue = queue.Queue(maxsize=CHANGE_FEED_CLIENT_BUFFER)
+        self.overflowed = False
+        self.since = 0  # events up to here are answered by the snapshot / replay
+
+
+class Hub:
+    def __init__(self):
+        self._subs = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.position = 0
+        self._stats = {'published': 0, 'delivered': 0, 'overflows': 0, 'errors': 0, 'polls': 0}
+
+    def count(self, name, n=1):
+        self._stats[name] += n
+
+    def subscribe(self, topics):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                # one poller per worker, started on its first subscriber
+                self._subs = set()
+                self._pid = os.getpid()
+                self.position = log.last_id()
+                self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+                self._thread.start()
+            sub = Subscriber(topics)
+            sub.since = self.position
+            self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs.discard(sub)
+
+    def _run(self):
+        while True:
+            time.sleep(CHANGE_FEED_POLL_INTERVAL)
+            try:
+                self.poll()
+            except Exception:
+                self.count('errors')
+
+    def poll(self):
+        self.count('polls')
+        events = log.read(self.position)
+        if not events:
+            return
+        frames = change_frames(events)
+        if isinstance(frames, str):
+            # leave the position alone; the next poll tries these events again
+            self.count('errors')
+            return
+        with self._lock:
+            self.position = events[-1][0]
+            subs = list(self._subs)
+        for sub in subs:
+            for topic in sub.topics & frames.keys():
+                for _, frame in frames[topic]:
+                    self._deliver(sub, frame)
+
+    def _deliver(self, sub, frame):
+        if sub.overflowed:
+            return
+        try:
+            sub.queue.put_nowait(frame)
+            self.count('delivered')
+        except queue.Full:
+            # a stalled client; it resumes from the log when it reconnects
+            sub.overflowed = True
+            self.count('overflows')
+
+    def stats(self):
+        out = dict(self._stats)
+        out.update(subscribers=len(self._subs), position=self.position)
+        return out
+
+
+hub = Hub()
+
+
+def open_stream(topics, last_event_id=None, snapshot=True, fmt='rows'):
+    """(subscriber, first frames) for a new client, or an error string.
+
+    A client resuming from last_event_id gets the events it missed; anyone
+    else (or a client too far behind) gets one snapshot per topic.
+    """
+    sub = hub.subscribe([log_topic(t, db.hospital()) for t in topics])
+    try:
+        if last_event_id is not None and log.covers(last_event_id, sub.since):
+            frames = change_frames(log.read(last_event_id, sub.since, limit=CHANGE_FEED_RETENTION))
+            if isinstance(frames, str):
+                first = frames
+            else:
+                first = [f for _, f in sorted(x for t in sub.topics & frames.keys() for x in frames[t])]
+        elif snapshot or last_event_id is not None:
+            first = snapshot_frames(topics, sub.since, fmt)
+        else:
+            first = []
+    except sqlite3.Error as err:
+        first = str(err)
+    if isinstance(first, str):
+        hub.unsubscribe(sub)
+        return first
+    return sub, first
+
+
+def stream(sub, first):
+    try:
+        yield "retry: 2000\n\n"
+        yield from first
+        while not sub.overflowed:
+            try:
+                yield sub.queue.get(timeout=CHANGE_FEED_HEARTBEAT)
+            except queue.Empty:
+                # keeps proxies from closing an idle stream and notices gone clients
+                yield ": keepalive\n\n"
+    finally:
+        hub.unsubscribe(sub)
+
+
+def stats():
+    out = hub.stats()
+    out['enabled'] = log is not None
+    return out
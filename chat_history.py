@@ -0,0 +1,129 @@
+import atexit, datetime, os, queue, threading, time
+import db
+
+# ---------- Chat history (write-behind) ----------
+# /api/chat only enqueues its turns; a background thread per worker writes
+# them to user_history in multi-row INSERTs once HISTORY_BATCH_SIZE rows are
+# waiting or HISTORY_FLUSH_INTERVAL seconds have passed. close() drains the
+# queue and runs at interpreter exit and from gunicorn's worker_exit hook.
+# Turns go to the database of the hospital the request was for.
+HISTORY_ENABLED = os.getenv('HISTORY_ENABLED', '1') != '0'
+HISTORY_BATCH_SIZE = int(os.getenv('HISTORY_BATCH_SIZE', 200))
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', 2))
+HISTORY_QUEUE_MAX = int(os.getenv('HISTORY_QUEUE_MAX', 50000))
+
+INSERT = "INSERT INTO user_history (user_id, message, is_user, timestamp) VALUES (%s, %s, %s, %s)"
+
+
+class HistoryWriter:
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=HISTORY_QUEUE_MAX)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._stats = {'queued': 0, 'written': 0, 'dropped': 0, 'flushes': 0, 'errors': 0}
+
+    def _ensure_thread(self):
+        # started lazily so each forked gunicorn worker gets its own thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._stop.clear()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+                self._thread.start()
+
+    def record(self, user_id, user_message, bot_reply):
+        if not HISTORY_ENABLED:
+            return
+        self._ensure_thread()
+        now = datetime.datetime.now().replace(microsecond=0)
+        hospital = db.hospital()
+        for row in ((hospital, (user_id, user_message, True, now)), (hospital, (user_id, bot_reply, False, now))):
+            try:
+                self._queue.put_nowait(row)
+                self._stats['queued'] += 1
+            except queue.Full:
+                # the database is far behind; shed history rather than block chats
+                self._stats['dropped'] += 1
+
+    def _take_batch(self, timeout):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+            while len(batch) < HISTORY_BATCH_SIZE:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        pending = []
+        flush_at = None
+        while not self._stop.is_set():
+            timeout = HISTORY_FLUSH_INTERVAL if flush_at is None else max(flush_at - time.monotonic(), 0.01)
+            pending += self._take_batch(timeout)
+            if pending and flush_at is None:
+                flush_at = time.monotonic() + HISTORY_FLUSH_INTERVAL
+            if pending and (len(pending) >= HISTORY_BATCH_SIZE or time.monotonic() >= flush_at):
+                self._write(pending)
+                pending = []; flush_at = None
+        if pending:
+            self._write(pending)
+
+    def _write(self, rows):
+        by_hospital = {}
+        for hospital, row in rows:
+            by_hospital.setdefault(hospital, []).append(row)
+        for hospital, batch in by_hospital.items():
+            try:
+                with db.request_scope(hospital=hospital), db.transaction() as cursor:
+                    cursor.executemany(INSERT, batch)
+                self._stats['written'] += len(batch)
+                self._stats['flushes'] += 1
+            except db.Error:
+                self._stats['errors'] += 1
+                self._stats['dropped'] += len(batch)
+
+    def flush(self):
+        # write everything queued so far from the calling thread
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(rows) >= HISTORY_BATCH_SIZE:
+                self._write(rows); rows = []
+        if rows:
+            self._write(rows)
+
+    def close(self, timeout=5):
+        if self._thread is not None and self._pid == os.getpid():
+            self._stop.set()
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        out = dict(self._stats)
+        out['backlog'] = self._queue.qsize()
+        return out
+
+
+def read_history(user_id, limit, before=None):
+    """Newest-first turns for user_id; before=(timestamp, history_id) continues a page."""
+    query = "SELECT history_id, user_id, message, is_user, timestamp FROM user_history WHERE user_id = %s"
+    params = [user_id]
+    if before:
+        query += " AND (timestamp, history_id) < (%s, %s)"
+        params += [before[0], before[1]]
+    query += " ORDER BY timestamp DESC, history_id DESC LIMIT %s"
+    params.append(limit)
+    return db.run_query(query, tuple(params), fetch=True)
+
+
+writer = HistoryWriter()
+atexit.register(writer.close)
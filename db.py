@@ -1,10 +1,923 @@
-import mysql.connector, os
+import mysql.connector, os, sys, threading, time, contextvars, itertools, random, re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import metrics
 
-def get_connection():
-    return mysql.connector.connect(
+# DB_BACKEND=sqlite keeps everything in one local file (DB_SQLITE_PATH)
+# instead of a MySQL server: for a clinic without one, or quick test runs.
+# sqlite_backend.py explains what differs. Replicas are MySQL only.
+DB_BACKEND = os.getenv('DB_BACKEND', 'mysql')
+DB_SQLITE_PATH = os.getenv('DB_SQLITE_PATH', 'hospital.db')
+# what callers catch; the SQLite backend raises mysql.connector's errors too
+Error = mysql.connector.Error
+
+
+def _connect(**overrides):
+    if DB_BACKEND == 'sqlite':
+        import sqlite_backend
+        return sqlite_backend.connect(DB_SQLITE_PATH)
+    params = dict(
         host=os.getenv('DB_HOST', 'localhost'),
         user=os.getenv('DB_USER', 'root'),
         password=os.getenv('DB_PASS', 'Yash@2005'),
         database=os.getenv('DB_NAME', 'hospital_database'),
         port=int(os.getenv('DB_PORT', 3306))
-    )
\ No newline at end of file
+    )
+    if _green():
+        # the C extension's socket calls would stall every greenlet in the worker
+        params['use_pure'] = True
+    params.update(overrides)
+    return mysql.connector.connect(**params)
+
+
+def _green():
+    # True inside a gevent worker (gunicorn -k gevent patches socket before loading the app)
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket')
+
+
+# ---------- Connection Pool ----------
+# One pool per gunicorn worker process. Connections are health checked on
+# checkout, reaped when idle for too long and replaced if they were dropped.
+
+# Errors that mean "the connection is gone" rather than "the query is bad".
+_CONNECTION_LOST = {2006, 2013, 2055}
+
+
+class PoolExhausted(mysql.connector.errors.PoolError):
+    pass
+
+
+class PooledConnection:
+    """Proxy around a raw connection; close() hands it back to the pool."""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def close(self):
+        if self._raw is not None:
+            self._pool.release(self._raw)
+            self._raw = None
+
+    def discard(self):
+        if self._raw is not None:
+            self._pool.release(self._raw, discard=True)
+            self._raw = None
+
+
+class ConnectionPool:
+    def __init__(self, size=None, max_idle=None, ping_after=None, timeout=None, connect=_connect):
+        self.size = int(size or os.getenv('DB_POOL_SIZE', 5))
+        self.max_idle = float(max_idle or os.getenv('DB_POOL_MAX_IDLE', 300))
+        # only ping connections that sat idle longer than this (seconds)
+        self.ping_after = float(ping_after if ping_after is not None else os.getenv('DB_POOL_PING_AFTER', 5))
+        self.timeout = float(timeout or os.getenv('DB_POOL_TIMEOUT', 10))
+        self._connect = connect
+        self._idle = []  # (raw connection, last released at); most recent last
+        self._open = 0
+        self._cond = threading.Condition()
+        self._stats = {'created': 0, 'reused': 0, 'checkouts': 0, 'discarded': 0,
+                       'reaped': 0, 'reconnects': 0, 'waits': 0, 'timeouts': 0}
+
+    def acquire(self, timeout=None):
+        with metrics.span('db_connect'):
+            return self._acquire(timeout)
+
+    def _acquire(self, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._stats['checkouts'] += 1
+            while True:
+                self._reap_locked()
+                if self._idle:
+                    raw, released_at = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    raw = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolExhausted(f'No free database connection after {timeout:g}s (pool size {self.size}).')
+                self._stats['waits'] += 1
+                self._cond.wait(remaining)
+        # connect / health check outside the lock
+        try:
+            if raw is None:
+                raw = self._connect()
+                with self._cond:
+                    self._stats['created'] += 1
+            else:
+                raw = self._check(raw, released_at)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, raw)
+
+    def _check(self, raw, released_at):
+        # recently used sockets are trusted as-is (is_connected() is itself a
+        # round-trip); run_query retries a read once if one turns out to be dead
+        if time.monotonic() - released_at < self.ping_after:
+            with self._cond:
+                self._stats['reused'] += 1
+            return raw
+        try:
+            raw.ping(reconnect=False)
+            with self._cond:
+                self._stats['reused'] += 1
+            return raw
+        except mysql.connector.Error:
+            _close_quietly(raw)
+            raw = self._connect()
+            with self._cond:
+                self._stats['reconnects'] += 1
+            return raw
+
+    def release(self, raw, discard=False):
+        if not discard:
+            try:
+                # never hand out a connection with a half-finished transaction
+                if raw.in_transaction:
+                    raw.rollback()
+            except mysql.connector.Error:
+                discard = True
+        with self._cond:
+            if discard:
+                self._open -= 1
+                self._stats['discarded'] += 1
+            else:
+                self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+        if discard:
+            _close_quietly(raw)
+
+    def _reap_locked(self):
+        if not self._idle:
+            return
+        cutoff = time.monotonic() - self.max_idle
+        # idle list is ordered by release time, so stale ones sit at the front
+        stale = 0
+        while stale < len(self._idle) and self._idle[stale][1] < cutoff:
+            stale += 1
+        if stale:
+            for raw, _ in self._idle[:stale]:
+                _close_quietly(raw)
+            del self._idle[:stale]
+            self._open -= stale
+            self._stats['reaped'] += stale
+
+    def reap_idle(self):
+        with self._cond:
+            self._reap_locked()
+
+    def close_all(self):
+        with self._cond:
+            for raw, _ in self._idle:
+                _close_quietly(raw)
+            self._open -= len(self._idle)
+            self._idle = []
+
+    def busy(self):
+        # connections checked out right now (read without the lock; a hint for routing)
+        return self._open - len(self._idle)
+
+    def stats(self):
+        with self._cond:
+            out = dict(self._stats)
+            out.update(size=self.size, open=self._open, idle=len(self._idle),
+                       in_use=self._open - len(self._idle))
+            return out
+
+
+def _close_quietly(raw):
+    try:
+        raw.close()
+    except Exception:
+        pass
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def home_pool():
+    # gunicorn forks workers after import; each process must own its sockets
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ConnectionPool()
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def get_pool():
+    # the current hospital's database; without shards, the one database
+    if DB_SHARDS:
+        return _hospital_pool(hospital())
+    return home_pool()
+
+
+def get_connection():
+    # Same contract as before: the caller closes the connection when done,
+    # which now returns it to the pool instead of tearing down the socket.
+    return get_pool().acquire()
+
+
+def pool_stats():
+    return home_pool().stats()
+
+
+# ---------- Read replicas ----------
+# DB_REPLICAS="host[:port],..." adds read replicas of the primary (same user,
+# password and database). Plain SELECTs outside a transaction go to a
+# healthy replica picked by DB_REPLICA_POLICY (round_robin, least_busy or
+# random). Writes, transactions, locking reads and anything that must not
+# be stale (primary=True) go to the primary. A checker thread per worker
+# reads every replica's lag each DB_REPLICA_CHECK_INTERVAL seconds. It
+# ejects replicas that are unreachable, not replicating or more than
+# DB_REPLICA_MAX_LAG seconds behind, and they rejoin once they pass again.
+#
+# Read-your-writes: a scope carries the time of its session's last write
+# (app.py keeps it in a cookie). A replica only serves that session once a
+# check shows it has applied everything up to that time; until then the
+# session reads from the primary.
+DB_REPLICA_POLICY = os.getenv('DB_REPLICA_POLICY', 'round_robin')
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 5))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 2))
+# after this long every replica still in rotation has caught up with a write
+READ_YOUR_WRITES_SECONDS = DB_REPLICA_MAX_LAG + DB_REPLICA_CHECK_INTERVAL + 1
+
+# can't connect to the server at all
+_UNREACHABLE = {2003, 2005}
+_READ = re.compile(r"^\s*(?:SELECT|WITH)\b", re.I)
+_LOCKING_READ = re.compile(r"\bFOR\s+(?:UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b", re.I)
+
+
+def _is_read(query):
+    return bool(_READ.match(query)) and not _LOCKING_READ.search(query)
+
+
+def _replication_lag(conn):
+    # seconds behind the source, or None when replication isn't running
+    for statement in ("SHOW REPLICA STATUS", "SHOW SLAVE STATUS"):  # the second before MySQL 8.0.22
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute(statement)
+            rows = cursor.fetchall()
+            break
+        except mysql.connector.ProgrammingError:
+            continue
+        finally:
+            cursor.close()
+    else:
+        return None
+    lags = [r.get('Seconds_Behind_Source', r.get('Seconds_Behind_Master')) for r in rows]
+    if not lags or any(lag is None for lag in lags):
+        return None
+    return float(max(lags))
+
+
+class Replica:
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = False  # until the first check passes
+        self.lag = None
+        self.caught_up_to = 0.0  # wall-clock time up to which the replica had applied every write
+        self.checked_at = 0.0
+        self.error = None
+        self.reads = 0
+        self.ejections = 0
+        self._probe = None
+
+    def check(self):
+        started = time.time()
+        try:
+            if self._probe is None:
+                self._probe = self.pool._connect()
+            lag = _replication_lag(self._probe)
+        except mysql.connector.Error as err:
+            if self._probe is not None:
+                _close_quietly(self._probe)
+                self._probe = None
+            self.eject(str(err))
+            return
+        self.checked_at = time.time()
+        self.lag = lag
+        if lag is None:
+            self.eject('not replicating')
+        elif lag > DB_REPLICA_MAX_LAG:
+            self.eject(f'{lag:g}s behind')
+        else:
+            # the lag is reported in whole seconds, so allow one more
+            self.caught_up_to = started - lag - 1
+            self.healthy = True
+            self.error = None
+
+    def eject(self, reason):
+        if self.healthy:
+            self.ejections += 1
+        self.healthy = False
+        self.error = reason
+        self.pool.close_all()
+
+    def usable(self, since=None):
+        # a replica whose checks stopped coming in is not trusted either
+        if not self.healthy or time.time() - self.checked_at > 3 * DB_REPLICA_CHECK_INTERVAL:
+            return False
+        return since is None or self.caught_up_to >= since
+
+    def stats(self):
+        pool = self.pool.stats()
+        return {'name': self.name, 'healthy': self.healthy, 'lag': self.lag, 'reads': self.reads,
+                'ejections': self.ejections, 'error': self.error, 'open': pool['open'], 'in_use': pool['in_use']}
+
+
+_replicas = None
+_replicas_pid = None
+_checker_pid = None
+_round_robin = itertools.count()
+
+
+def _replica_hosts():
+    if DB_BACKEND == 'sqlite' or DB_SHARDS:
+        return []
+    out = []
+    for entry in filter(None, (e.strip() for e in os.getenv('DB_REPLICAS', '').split(','))):
+        host, _, port = entry.partition(':')
+        out.append((host, int(port or 3306)))
+    return out
+
+
+def get_replicas():
+    global _replicas, _replicas_pid, _checker_pid
+    if _replicas is None or _replicas_pid != os.getpid():
+        with _pool_lock:
+            if _replicas is None or _replicas_pid != os.getpid():
+                _replicas = [Replica(f"{host}:{port}",
+                                     ConnectionPool(connect=lambda host=host, port=port: _connect(host=host, port=port)))
+                             for host, port in _replica_hosts()]
+                _replicas_pid = os.getpid()
+    if _replicas and _checker_pid != os.getpid():
+        with _pool_lock:
+            if _checker_pid != os.getpid():
+                _checker_pid = os.getpid()
+                threading.Thread(target=_check_replicas, args=(_replicas,), name='replica-check', daemon=True).start()
+    return _replicas
+
+
+def _check_replicas(replicas):
+    while True:
+        for replica in replicas:
+            replica.check()
+        time.sleep(DB_REPLICA_CHECK_INTERVAL)
+
+
+def pick_replica(since=None):
+    """A replica fit to serve a read for a session whose last write was at `since`, or None for the primary."""
+    candidates = [r for r in get_replicas() if r.usable(since)]
+    if not candidates:
+        return None
+    if DB_REPLICA_POLICY == 'least_busy':
+        return min(candidates, key=lambda r: r.pool.busy())
+    if DB_REPLICA_POLICY == 'random':
+        return random.choice(candidates)
+    return candidates[next(_round_robin) % len(candidates)]
+
+
+def replica_stats():
+    return [r.stats() for r in get_replicas()]
+
+
+# ---------- Shards ----------
+# DB_SHARDS="name=host[:port],..." spreads hospitals over several MySQL
+# servers (with DB_BACKEND=sqlite, "name=directory"). Each hospital keeps its
+# own database, DB_NAME_<hospital id>, on one shard, so everything a request
+# for that hospital runs (joins, transactions, batches) stays on one server.
+# Which shard holds which hospital is the shard_map table in the home
+# database, the one DB_HOST/DB_NAME (or DB_SQLITE_PATH) names. Every worker
+# re-reads it each DB_SHARD_MAP_TTL seconds. tools/rebalance.py adds
+# hospitals and moves them between shards while the app runs; a hospital is
+# 'frozen' (reads only) for the last pass of its move. Reads that span
+# hospitals go through scatter_query(), which asks each hospital's database
+# in parallel. Without DB_SHARDS there is the one database and it belongs to
+# hospital DB_HOSPITAL_ID. Read replicas are for unsharded deployments.
+DB_SHARDS = os.getenv('DB_SHARDS', '')
+DB_HOSPITAL_ID = int(os.getenv('DB_HOSPITAL_ID', 1))
+DB_SHARD_MAP_TTL = float(os.getenv('DB_SHARD_MAP_TTL', 5))
+# past TTL + grace without a successful re-read, a worker stops writing
+DB_SHARD_MAP_GRACE = float(os.getenv('DB_SHARD_MAP_GRACE', 2))
+DB_SCATTER_THREADS = int(os.getenv('DB_SCATTER_THREADS', 8))
+ACTIVE, FROZEN = 'active', 'frozen'
+
+SHARD_MAP_TABLE = """CREATE TABLE IF NOT EXISTS shard_map (
+    hospital_id INT PRIMARY KEY,
+    shard VARCHAR(50) NOT NULL,
+    state VARCHAR(10) NOT NULL DEFAULT 'active',
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP)"""
+
+
+class HospitalUnavailable(mysql.connector.errors.DatabaseError):
+    pass
+
+
+def shards():
+    """{name: (host, port)} from DB_SHARDS, or {name: directory} with the SQLite backend."""
+    out = {}
+    for entry in filter(None, (e.strip() for e in DB_SHARDS.split(','))):
+        name, _, where = entry.partition('=')
+        if DB_BACKEND == 'sqlite':
+            out[name] = where
+        else:
+            host, _, port = where.partition(':')
+            out[name] = (host, int(port or 3306))
+    return out
+
+
+def hospital_database(hospital):
+    return f"{os.getenv('DB_NAME', 'hospital_database')}_{int(hospital)}"
+
+
+def connect_hospital(shard, hospital, **overrides):
+    # a raw connection to a hospital's database on a shard (database=None: the server)
+    where = shards()[shard]
+    if DB_BACKEND == 'sqlite':
+        import sqlite_backend
+        return sqlite_backend.connect(os.path.join(where, hospital_database(hospital) + '.db'), hospital)
+    host, port = where
+    params = dict(host=host, port=port, database=hospital_database(hospital))
+    params.update(overrides)
+    return _connect(**params)
+
+
+def read_shard_map(conn, create=False):
+    """{hospital: (shard, state)} as the home database has it."""
+    cursor = conn.cursor()
+    try:
+        if create:
+            cursor.execute(SHARD_MAP_TABLE)
+        cursor.execute("SELECT hospital_id, shard, state FROM shard_map")
+        return {h: (shard, state) for h, shard, state in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+_shard_map = {}
+_shard_map_at = None  # when the map was last read successfully
+_shard_map_tried = 0.0
+_shard_map_lock = threading.Lock()
+
+
+def _shard_map_due():
+    now = time.monotonic()
+    return _shard_map_at is None or (now - _shard_map_at > DB_SHARD_MAP_TTL and now - _shard_map_tried > 1)
+
+
+def shard_map():
+    """The cached shard map, re-read once it is DB_SHARD_MAP_TTL seconds old."""
+    global _shard_map, _shard_map_at, _shard_map_tried
+    if _shard_map_due():
+        with _shard_map_lock:
+            if _shard_map_due():
+                _shard_map_tried = time.monotonic()
+                try:
+                    conn = home_pool().acquire()
+                    try:
+                        _shard_map = read_shard_map(conn, create=_shard_map_at is None)
+                    finally:
+                        conn.close()
+                    _shard_map_at = time.monotonic()
+                except mysql.connector.Error:
+                    # keep routing reads with the map we have while the home
+                    # database is away (retrying at most once a second);
+                    # _check_writable stops writes once the map is too old
+                    if _shard_map_at is None:
+                        raise
+    return _shard_map
+
+
+def locate(hospital):
+    """(shard, state) of a hospital; raises HospitalUnavailable for one not in the map."""
+    entry = shard_map().get(int(hospital))
+    if entry is None:
+        raise HospitalUnavailable(msg=f"Hospital {hospital} is not in the shard map.")
+    return entry
+
+
+def _check_writable():
+    if not DB_SHARDS:
+        return
+    state = locate(hospital())[1]
+    # a map that could not be re-read may be hiding a freeze or a move, and
+    # writes to an abandoned copy would be lost
+    if time.monotonic() - _shard_map_at > DB_SHARD_MAP_TTL + DB_SHARD_MAP_GRACE:
+        raise HospitalUnavailable(msg="The shard map could not be refreshed; changes are paused.")
+    if state != ACTIVE:
+        raise HospitalUnavailable(msg=f"Hospital {hospital()} is moving to another shard; "
+                                      "changes are paused for a minute.")
+
+
+_hospital_pools = {}  # (hospital, shard) -> ConnectionPool
+_hospital_pools_pid = None
+
+
+def _hospital_pool(hospital):
+    global _hospital_pools, _hospital_pools_pid
+    shard, _ = locate(hospital)
+    key = (hospital, shard)
+    pool = _hospital_pools.get(key) if _hospital_pools_pid == os.getpid() else None
+    if pool is None:
+        with _pool_lock:
+            if _hospital_pools_pid != os.getpid():
+                _hospital_pools, _hospital_pools_pid = {}, os.getpid()
+            pool = _hospital_pools.get(key)
+            if pool is None:
+                # a hospital that moved leaves its old shard's pool behind
+                for old in [k for k in _hospital_pools if k[0] == hospital]:
+                    _hospital_pools.pop(old).close_all()
+                pool = _hospital_pools[key] = ConnectionPool(
+                    connect=lambda: connect_hospital(shard, hospital))
+    return pool
+
+
+def shard_stats():
+    if not DB_SHARDS:
+        return []
+    pools = dict(_hospital_pools) if _hospital_pools_pid == os.getpid() else {}
+    out = []
+    for h, (shard, state) in sorted(_shard_map.items()):
+        pool = pools.get((h, shard))
+        stats = pool.stats() if pool else {'open': 0, 'in_use': 0}
+        out.append({'hospital': h, 'shard': shard, 'state': state, 'open': stats['open'], 'in_use': stats['in_use']})
+    return out
+
+
+_scatter = None
+_scatter_pid = None
+
+
+def scatter_query(query, params=None, hospitals=None):
+    """{hospital: rows} for one read run in every hospital's database, or an error string.
+
+    The hospitals (every one in the shard map by default) are asked in
+    parallel, each on a connection of its own. params may be a function of
+    the hospital id for reads whose parameters differ per hospital.
+    """
+    global _scatter, _scatter_pid
+    if not DB_SHARDS:
+        rows = run_query(query, params(DB_HOSPITAL_ID) if callable(params) else params, fetch=True)
+        return rows if isinstance(rows, str) else {DB_HOSPITAL_ID: rows}
+    try:
+        hospitals = sorted(shard_map()) if hospitals is None else list(hospitals)
+    except mysql.connector.Error as err:
+        return str(err)
+    if _scatter is None or _scatter_pid != os.getpid():
+        with _pool_lock:
+            if _scatter is None or _scatter_pid != os.getpid():
+                _scatter = ThreadPoolExecutor(DB_SCATTER_THREADS, thread_name_prefix='scatter')
+                _scatter_pid = os.getpid()
+
+    def ask(h):
+        with request_scope(hospital=h):
+            return run_query(query, params(h) if callable(params) else params, fetch=True)
+
+    found = {}
+    for h, rows in zip(hospitals, _scatter.map(ask, hospitals)):
+        if isinstance(rows, str):
+            return f"hospital {h}: {rows}"
+        found[h] = rows
+    return found
+
+
+# ---------- Request scope ----------
+# Inside a scope every run_query call shares one borrowed connection, which
+# goes back to the pool when the scope ends.
+_scope = contextvars.ContextVar('db_scope', default=None)
+
+
+class _Scope:
+    def __init__(self, last_write=None, hospital=None):
+        self.hospital = hospital  # whose database the scope works in (None: DB_HOSPITAL_ID)
+        self.conn = None
+        self.replica = None  # the replica this request reads from, once picked
+        self.replica_conn = None
+        self.batch = None  # the open Batch, if any
+        self.last_write = last_write  # the session's last write (epoch seconds), for read-your-writes
+        self.wrote = False
+
+    def connection(self, replica=None):
+        if replica is not None:
+            if replica is not self.replica:
+                self.close_replica()
+                self.replica = replica
+            if self.replica_conn is None:
+                self.replica_conn = replica.pool.acquire()
+            return self.replica_conn
+        if self.conn is None:
+            self.conn = get_connection()
+        return self.conn
+
+    def drop(self, replica=None):
+        if replica is not None:
+            if self.replica_conn is not None:
+                self.replica_conn.discard()
+                self.replica_conn = None
+        elif self.conn is not None:
+            self.conn.discard()
+            self.conn = None
+
+    def close_replica(self):
+        if self.replica_conn is not None:
+            self.replica_conn.close()
+            self.replica_conn = None
+
+    def close(self):
+        self.close_replica()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def _wrote(scope):
+    # later reads in this scope (and session) must see the write
+    if scope is not None:
+        scope.last_write = time.time()
+        scope.wrote = True
+
+
+def _read_replica(scope):
+    # requests keep reading from the replica they started on while it stays fit
+    since = scope.last_write if scope is not None else None
+    if scope is not None and scope.replica is not None and scope.replica.usable(since):
+        return scope.replica
+    return pick_replica(since)
+
+
+def hospital():
+    """The hospital the current request (or request_scope) works for."""
+    scope = _scope.get()
+    if DB_SHARDS and scope is not None and scope.hospital is not None:
+        return scope.hospital
+    return DB_HOSPITAL_ID
+
+
+@contextmanager
+def request_scope(last_write=None, hospital=None):
+    scope = _Scope(last_write, hospital)
+    token = _scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope.reset(token)
+        scope.close()
+
+
+def begin_scope(last_write=None, hospital=None):
+    scope = _Scope(last_write, hospital)
+    return scope, _scope.set(scope)
+
+
+def end_scope(scope, token):
+    _scope.reset(token)
+    scope.close()
+
+
+# ---------- Batches ----------
+# Inside batch() nothing commits on its own: run_query leaves its writes
+# open, transaction() nests as a savepoint, and work registered with
+# after_commit() (cache invalidation and the like) waits until the whole
+# batch commits. Savepoints let a caller undo one part of the batch;
+# after_commit work registered since the savepoint is dropped with it.
+class Batch:
+    def __init__(self, conn):
+        self.conn = conn
+        self.hooks = []
+        self._marks = []
+
+    def _execute(self, stmt):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(stmt)
+        finally:
+            cursor.close()
+
+    def savepoint(self, name='batch_item'):
+        self._execute(f"SAVEPOINT {name}")
+        self._marks.append((name, len(self.hooks)))
+
+    def rollback_to(self, name='batch_item'):
+        self._execute(f"ROLLBACK TO SAVEPOINT {name}")
+        while self._marks:
+            mark, hooks = self._marks.pop()
+            if mark == name:
+                del self.hooks[hooks:]
+                break
+
+    def release(self, name='batch_item'):
+        self._execute(f"RELEASE SAVEPOINT {name}")
+        for i in range(len(self._marks) - 1, -1, -1):
+            if self._marks[i][0] == name:
+                del self._marks[i:]
+                break
+
+
+@contextmanager
+def batch():
+    # One transaction for everything run in the block on this request's scope;
+    # commits when the block exits, rolls back if it raises.
+    scope = _scope.get()
+    if scope is None or scope.batch is not None:
+        raise RuntimeError('batch() needs a request scope and does not nest')
+    _check_writable()
+    conn = scope.connection()
+    tx = scope.batch = Batch(conn)
+    try:
+        yield tx
+        with metrics.span('db_query', 'COMMIT'):
+            conn.commit()
+        _wrote(scope)
+    except Exception:
+        try:
+            conn.rollback()
+        except mysql.connector.Error:
+            # the connection is gone or unusable; don't hand it out again
+            scope.drop()
+        raise
+    finally:
+        scope.batch = None
+    for hook in tx.hooks:
+        hook()
+
+
+def in_batch():
+    scope = _scope.get()
+    return scope is not None and scope.batch is not None
+
+
+def after_commit(fn):
+    # run fn once the current batch commits, or straight away outside one
+    scope = _scope.get()
+    if scope is not None and scope.batch is not None:
+        scope.batch.hooks.append(fn)
+    else:
+        fn()
+
+
+# ---------- Query helper ----------
+_last_insert_id = contextvars.ContextVar('last_insert_id', default=None)
+
+
+def last_insert_id():
+    # AUTO_INCREMENT id generated by the most recent run_query INSERT in this context
+    return _last_insert_id.get()
+
+
+def run_query(query, params=None, fetch=False, primary=False):
+    # primary=True keeps a read off the replicas (e.g. to fill a cache)
+    scope = _scope.get()
+    in_tx = scope is not None and scope.batch is not None
+    replica = None
+    if fetch and not primary and not in_tx and _is_read(query):
+        replica = _read_replica(scope)
+    for attempt in (1, 2):
+        conn = None
+        sent = False
+        try:
+            if DB_SHARDS and not (fetch and _is_read(query)):
+                _check_writable()
+            if scope:
+                conn = scope.connection(replica)
+            else:
+                conn = replica.pool.acquire() if replica else get_connection()
+            cursor = conn.cursor(dictionary=True)
+            try:
+                sent = True
+                with metrics.span('db_query', query):
+                    cursor.execute(query, params or ())
+                    if fetch:
+                        rows = cursor.fetchall()
+                        if replica is not None:
+                            replica.reads += 1
+                        return rows
+                    if not in_tx:
+                        conn.commit()
+                _last_insert_id.set(cursor.lastrowid)
+                _wrote(scope)
+                return True
+            finally:
+                cursor.close()
+                if not scope:
+                    conn.close()
+        except mysql.connector.Error as err:
+            errno = getattr(err, 'errno', None)
+            if replica is not None and attempt == 1:
+                # a replica never fails a read: the primary answers instead
+                if errno in _CONNECTION_LOST or errno in _UNREACHABLE:
+                    replica.eject(str(err))
+                    if scope:
+                        scope.drop(replica)
+                    elif conn is not None:
+                        conn.discard()
+                replica = None
+                continue
+            # a retry would run outside the batch's lost transaction, and a
+            # write the server may already have applied must not run twice
+            if errno in _CONNECTION_LOST and attempt == 1 and not in_tx and (not sent or (fetch and _is_read(query))):
+                # server dropped us: throw the connection away and retry once
+                if scope:
+                    scope.drop()
+                elif conn is not None:
+                    conn.discard()
+                continue
+            return str(err)
+
+
+@contextmanager
+def transaction():
+    # Cursor on the scope's (or a freshly borrowed) connection; everything run
+    # through it commits together when the block exits, or rolls back on error.
+    scope = _scope.get()
+    if scope is not None and scope.batch is not None:
+        with _nested(scope.batch) as cursor:
+            yield cursor
+        return
+    _check_writable()
+    conn = scope.connection() if scope else get_connection()
+    cursor = conn.cursor()
+    try:
+        with metrics.span('db_query', 'TRANSACTION'):
+            yield cursor
+            conn.commit()
+        _wrote(scope)
+    except Exception:
+        try:
+            conn.rollback()
+        except mysql.connector.Error:
+            pass
+        raise
+    finally:
+        cursor.close()
+        if not scope:
+            conn.close()
+
+
+@contextmanager
+def _nested(tx):
+    # transaction() inside a batch: a savepoint instead of a commit
+    tx.savepoint('nested_tx')
+    cursor = tx.conn.cursor()
+    try:
+        with metrics.span('db_query', 'TRANSACTION'):
+            yield cursor
+    except Exception:
+        try:
+            tx.rollback_to('nested_tx')
+        except mysql.connector.Error:
+            pass
+        raise
+    else:
+        tx.release('nested_tx')
+    finally:
+        cursor.close()
+
+
+def stream_query(query, params=None, batch_size=1000):
+    # Yields rows from an unbuffered cursor, batch_size at a time off the
+    # socket, so memory stays flat however many rows the query returns. Uses
+    # its own pooled connection (a replica's when one is fit) for the
+    # lifetime of the generator. The route is picked now, while the request's
+    # scope is still current.
+    scope = _scope.get()
+    replica = pick_replica(scope.last_write if scope else None) if _is_read(query) else None
+    return _stream(replica.pool if replica else get_pool(), query, params, batch_size)
+
+
+def _stream(pool, query, params, batch_size):
+    conn = pool.acquire()
+    finished = False
+    try:
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        cursor.execute(query, params or ())
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+        cursor.close()
+        finished = True
+    finally:
+        if finished:
+            conn.close()
+        else:
+            # unread rows are still on the wire; the connection can't be reused
+            conn.discard()
@@ -0,0 +1,36 @@
+# Picked up automatically by gunicorn when started from the project directory.
+import glob, os, tempfile
+
+# workers share metrics through snapshot files here (see metrics.py)
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'hms-metrics'))
+
+# ---------- Worker mode ----------
+# sync (default): one request at a time per worker process.
+# gevent: each worker runs its requests as greenlets on an event loop. A
+# request waiting on MySQL or the LLM yields instead of holding the worker,
+# so one process keeps up to GUNICORN_WORKER_CONNECTIONS chats in flight.
+# The handlers stay as they are; gevent makes their sockets cooperative.
+# It does not patch sqlite3: the change-feed log and a sqlite:/// record
+# cache block the whole worker while they wait on a lock. Needs
+# requirements-gevent.txt.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 500))
+
+
+def on_starting(server):
+    # snapshots left by a previous run belong to workers that no longer exist
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+        os.remove(path)
+    if 'gevent' in server.cfg.worker_class_str:
+        # many more requests in flight per worker need more connections and
+        # LLM slots than the sync defaults; explicit settings still win
+        os.environ.setdefault('DB_POOL_SIZE', '20')
+        os.environ.setdefault('LLM_MAX_CONCURRENCY', '64')
+        # open change-feed streams park a greenlet each, not a worker
+        os.environ.setdefault('CHANGE_FEED', '1')
+
+
+def worker_exit(server, worker):
+    # write out any chat history still queued in this worker
+    import chat_history
+    chat_history.writer.close()
@@ -0,0 +1,183 @@
+"""Hospital statistics kept as counters next to the data they count.
+
+    python hospital_stats.py --reconcile             recount every metric once and fix drift
+    python hospital_stats.py --reconcile --every 3600   keep doing that (for a sidecar or cron)
+
+Uses the same DB_* environment variables as the app.
+"""
+import argparse, collections, datetime, sys, time
+import db
+
+# ---------- Counters ----------
+# hospital_stats holds one row per (metric, bucket): patients per doctor,
+# per disease, appointments per day and per staff member, plus the totals.
+# Every chat write moves the counters in the same transaction as the row it
+# changes, so a question like "patients per doctor" reads a few counter rows
+# instead of grouping the whole table. Writes that bypass the app (manual
+# SQL, restores) make the counters drift; reconcile() recounts from the base
+# tables and puts them right.
+
+# kind -> (table, id column, [(metric, column or None for the total), ...])
+TRACKED = {
+    'patient': ('patients', 'patient_id', [('patients', None), ('doctor', 'doctor_assigned'),
+                                           ('disease', 'disease')]),
+    'appointment': ('appointments', 'appointment_id', [('appointments', None), ('day', 'appointment_date'),
+                                                       ('staff', 'staff_id')]),
+}
+METRICS = {metric: kind for kind, (_, _, metrics) in TRACKED.items() for metric, _ in metrics}
+
+_ADD = ("INSERT INTO hospital_stats (metric, bucket, n) VALUES (%s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE n = n + VALUES(n)")
+_SET = ("INSERT INTO hospital_stats (metric, bucket, n) VALUES (%s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE n = VALUES(n)")
+
+
+def _bucket(value):
+    # NULL counts under ''; dates as YYYY-MM-DD, like the day buckets are queried
+    if value is None:
+        return ''
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)[:100]
+
+
+def _columns(kind):
+    _, _, metrics = TRACKED[kind]
+    return [column for _, column in metrics if column]
+
+
+def rows(cursor, kind, first_id, count=1, lock=False):
+    """The tracked columns of records first_id .. first_id+count-1 as dicts.
+
+    Takes a cursor inside the caller's transaction; lock=True reads with FOR
+    UPDATE so the values can't change before the counters are moved.
+    """
+    table, idcol, _ = TRACKED[kind]
+    cols = _columns(kind)
+    cursor.execute(f"SELECT {', '.join(cols)} FROM {table} WHERE {idcol} BETWEEN %s AND %s"
+                   + (" FOR UPDATE" if lock else ""), (first_id, first_id + count - 1))
+    return [dict(zip(cols, r)) for r in cursor.fetchall()]
+
+
+def deltas(kind, before, after):
+    """[(metric, bucket, change), ...] for records going from `before` to `after` rows."""
+    _, _, metrics = TRACKED[kind]
+    change = collections.Counter()
+    for group, sign in ((before, -1), (after, 1)):
+        for row in group:
+            for metric, column in metrics:
+                change[(metric, _bucket(row[column]) if column else '')] += sign
+    # sorted, so concurrent writers lock counter rows in the same order
+    return [(m, b, n) for (m, b), n in sorted(change.items()) if n]
+
+
+def changed(cursor, kind, first_id, count=1, before=()):
+    """Move the counters for records that now look like the database says.
+
+    Call after the INSERT/UPDATE, in the same transaction. `before` is what
+    rows() returned before an update (empty for inserts). Kinds without
+    statistics are ignored.
+    """
+    if kind not in TRACKED or not first_id:
+        return
+    change = deltas(kind, before, rows(cursor, kind, first_id, count))
+    if change:
+        cursor.executemany(_ADD, change)
+
+
+def counts(metric, start=None, end=None):
+    """[(bucket, n), ...] for one metric (day buckets optionally between two dates), or an error string."""
+    query = "SELECT bucket, n FROM hospital_stats WHERE metric = %s AND n <> 0"
+    params = [metric]
+    if start is not None:
+        query += " AND bucket BETWEEN %s AND %s"
+        params += [_bucket(start), _bucket(end)]
+    found = db.run_query(query, tuple(params), fetch=True)
+    if isinstance(found, str):
+        return found
+    return [(r['bucket'], r['n']) for r in found]
+
+
+def total(metric):
+    """The count of a total metric ('patients', 'appointments'), or an error string."""
+    found = counts(metric)
+    if isinstance(found, str):
+        return found
+    return sum(n for _, n in found)
+
+
+# ---------- Reconciliation ----------
+def recount(cursor, metric):
+    """{bucket: n} for a metric, counted from the base table."""
+    table, _, metrics = TRACKED[METRICS[metric]]
+    column = dict(metrics)[metric]
+    if column is None:
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        return {'': cursor.fetchone()[0]}
+    cursor.execute(f"SELECT {column}, COUNT(*) FROM {table} GROUP BY {column}")
+    truth = collections.Counter()
+    for value, n in cursor.fetchall():
+        truth[_bucket(value)] += n
+    return truth
+
+
+def reconcile_metric(metric):
+    """Recount one metric and rewrite the counters that differ; returns how many were wrong."""
+    with db.transaction() as cursor:
+        # locking the metric's counters first makes writers wait for the
+        # recount, so an increment can't land between the count and the fix
+        cursor.execute("SELECT bucket, n FROM hospital_stats WHERE metric = %s FOR UPDATE", (metric,))
+        stored = dict(cursor.fetchall())
+        truth = recount(cursor, metric)
+        stale = [(metric, b) for b in stored if b not in truth]
+        wrong = [(metric, b, n) for b, n in truth.items() if stored.get(b) != n]
+        if stale:
+            cursor.executemany("DELETE FROM hospital_stats WHERE metric = %s AND bucket = %s", stale)
+        if wrong:
+            cursor.executemany(_SET, wrong)
+    return len(stale) + len(wrong)
+
+
+def reconcile(out=print):
+    """Recount every metric. Returns the number of counter rows that had drifted."""
+    fixed = 0
+    for metric in METRICS:
+        drift = reconcile_metric(metric)
+        fixed += drift
+        out(f"{metric:<14} {drift} counters fixed" if drift else f"{metric:<14} ok")
+    return fixed
+
+
+def reconcile_all(out=print):
+    """reconcile() in every hospital's database (with shards; otherwise the one database)."""
+    if not db.DB_SHARDS:
+        return reconcile(out)
+    fixed = 0
+    for hospital in sorted(db.shard_map()):
+        with db.request_scope(hospital=hospital):
+            fixed += reconcile(lambda line: out(f"hospital {hospital}: {line}"))
+    return fixed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--reconcile', action='store_true', help='recount the statistics and fix drift')
+    ap.add_argument('--every', type=float, help='repeat every this many seconds')
+    args = ap.parse_args()
+    if not args.reconcile:
+        ap.print_help()
+        return 2
+    while True:
+        try:
+            reconcile_all()
+        except db.Error as err:
+            print(f"reconcile failed: {err}", file=sys.stderr)
+            if not args.every:
+                return 1
+        if not args.every:
+            return 0
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+import re, os
+from collections import namedtuple
+from functools import lru_cache
+
+# ---------- Intent routing ----------
+# All chat patterns are compiled once at import. classify() checks the
+# message for its trigger words, runs only the extractors whose trigger
+# fired and returns a Route naming the candidate intents in the order
+# chat_api has always tried them. Handlers may still decline (return None)
+# and let the next candidate run.
+
+# Candidate intents, in dispatch priority order.
+UPDATE_FIELDS = 'update_fields'          # multi-field / name based update
+UPDATE_FIELD = 'update_field'            # "update the age of patient 1 to 45"
+LLM = 'llm'                              # OpenAI parsing (handler checks the key)
+ADD_PATIENT = 'add_patient'
+ADD_STAFF = 'add_staff'
+SCHEDULE_APPOINTMENT = 'schedule_appointment'
+FREE_SLOTS = 'free_slots'              # "free slots for staff 3 between <date> and <date>"
+STATS = 'stats'                        # "patients per doctor", "appointments per day", "census"
+SHOW_PATIENTS = 'show_patients'
+SHOW_STAFF = 'show_staff'
+SHOW_APPOINTMENTS = 'show_appointments'
+PATIENT_BY_ID = 'patient_by_id'
+STAFF_BY_ID = 'staff_by_id'
+NAME_LOOKUP = 'name_lookup'
+
+Route = namedtuple('Route', [
+    'intents',        # tuple of candidate intents, highest priority first
+    'patient_id',     # "patient 5" / "patient_id 5"
+    'staff_id',       # "staff 3"
+    'update_name',    # name mentioned in an update with no explicit id
+    'update_pairs',   # ((field, value), ...) for multi-field updates
+    'field_update',   # (role, id, field, value) from the single-field patterns
+    'lookup_name',    # name after "tell me about" / "who is" ...
+])
+
+# Triggers are plain substrings, tested with `in` (a C-level scan per word),
+# in priority order within each group. Only the statistics phrases need a
+# regex, and it runs only when one of its hint words is present.
+_TRIGGERS = (
+    ('add_patient', 'add patient'),
+    ('add_staff', 'add staff'),
+    ('schedule_appointment', 'schedule appointment'),
+    ('free_slots', 'free slot'), ('free_slots', 'open slot'), ('free_slots', 'available slot'),
+    ('show_patients', 'show patients'),
+    ('show_staff', 'show staff'),
+    ('show_appointments', 'show appointments'),
+    ('update', 'update'), ('update', 'change'), ('update', 'set'),
+    ('patient', 'patient'),
+    ('staff', 'staff'),
+    ('lookup', 'tell me about'), ('lookup', 'who is'), ('lookup', 'info on'),
+    ('lookup', 'information about'), ('lookup', 'details for'), ('lookup', 'details of'),
+)
+_STATS_HINTS = ('stat', 'census', 'breakdown', 'how many', 'per ', 'by ', ' load', 'daily bookings')
+_STATS = re.compile(r"\b(?:stats|statistics|census|breakdown|how many|(?:per|by) (?:doctor|disease|day|date|staff)"
+                    r"|(?:doctor|staff) load|daily bookings)\b")
+# These handlers always answer, so nothing after them needs extracting.
+# STATS comes after the listings: its triggers are broad, and "show
+# appointments by day" has always been the appointments listing.
+_TERMINAL = (ADD_PATIENT, ADD_STAFF, SCHEDULE_APPOINTMENT, FREE_SLOTS,
+             SHOW_PATIENTS, SHOW_STAFF, SHOW_APPOINTMENTS, STATS)
+# two common patterns: field before role/id, or role/id before field
+_FIELD_FIRST = re.compile(r"(?:update|change|set)\s+(?:the\s+)?(?P<field>[a-zA-Z _]+?)\s+(?:of\s+)?(?P<role>patient|staff)(?:_?id)?\s*(?:id\s*)?(?:#|:)?\s*(?P<id>\d+)\s*(?:to|=|as|become)?\s*(?P<value>.+)", re.I)
+_ROLE_FIRST = re.compile(r"(?:update|change|set)\s+(?P<role>patient|staff)(?:_?id)?\s*(?:id\s*)?(?:#|:)?\s*(?P<id>\d+)\s*(?:set\s+)?(?P<field>[a-zA-Z _]+?)\s*(?:to|=|as|become)?\s*(?P<value>.+)", re.I)
+
+_ID_FOR_ROLE = {
+    role: re.compile(rf"{role}[^0-9\n\r]*(?:id\s*)?(?:#|:)?\s*(\d+)")
+    for role in ('patient', 'staff')
+}
+_PAIR_SPLIT = re.compile(r"\band\b|,|;")
+_PAIR = re.compile(r"(?:set|change|update)?\s*(?P<field>[a-zA-Z ]{2,30}?)\s*(?:to|=|as)?\s*(?P<value>.+)$", re.I)
+_NAME_POSSESSIVE = re.compile(r"([a-z]+(?:\s+[a-z]+){0,2})'s", re.I)
+_NAME_AFTER_PREP = re.compile(r"(?:for|of|named|called|about)\s+([a-z][a-z\s]{1,80})", re.I)
+_NAME_AFTER_VERB = re.compile(r"(?:change|update|set)\s+([a-z][a-z\s]{1,80})\s+(?:'s|\b)", re.I)
+_NAME_AFTER_KEYWORDS = re.compile(r"(?:tell me about|who is|info on|information about|details for|details of)\s+([a-zA-Z.\- ]{2,80})")
+_FIELD_CHARS = re.compile(r"[^a-z0-9 _]")
+
+FIELD_SYNONYMS = {
+    'phone': 'contact', 'phone number': 'contact', 'mobile': 'contact',
+    'contact number': 'contact', 'doc': 'doctor_assigned', 'doctor': 'doctor_assigned',
+    'assigned doctor': 'doctor_assigned', 'admitted date': 'admitted_date', 'discharge date': 'discharge_date',
+    'age': 'age', 'name': 'name', 'disease': 'disease', 'gender': 'gender', 'role': 'role'
+}
+
+
+def normalize_field_name(name):
+    n = _FIELD_CHARS.sub('', name.lower().strip())
+    return FIELD_SYNONYMS.get(n, n.replace(' ', '_'))
+
+
+def extract_id_for_role(text, role):
+    # look for 'patient 5' or 'patient id 5' or 'staff 3'
+    m = _ID_FOR_ROLE[role].search(text)
+    if m:
+        return int(m.group(1))
+    return None
+
+
+def extract_field_value_pairs(text):
+    # field->value pairs from a sentence (handles 'and' / commas)
+    pairs = {}
+    for p in _PAIR_SPLIT.split(text):
+        # look for patterns like 'age to 45', 'set age to 45', 'contact +91...'
+        m = _PAIR.search(p.strip())
+        if m:
+            f = m.group('field').strip()
+            v = m.group('value').strip()
+            if f and v:
+                pairs[normalize_field_name(f)] = v
+    return pairs
+
+
+def find_name_in_msg(text):
+    # possessive: "john doe's", then 'for john doe' / 'named john doe', then 'change john doe'
+    for pattern in (_NAME_POSSESSIVE, _NAME_AFTER_PREP, _NAME_AFTER_VERB):
+        m = pattern.search(text)
+        if m:
+            return m.group(1).strip()
+    return None
+
+
+def extract_name_after_keywords(text):
+    m = _NAME_AFTER_KEYWORDS.search(text)
+    if m:
+        return m.group(1).strip()
+    return None
+
+
+def _field_update(text):
+    for pattern in (_FIELD_FIRST, _ROLE_FIRST):
+        m = pattern.search(text)
+        if m:
+            return (m.group('role').lower(), int(m.group('id')),
+                    (m.group('field') or '').strip(), (m.group('value') or '').strip())
+    return None
+
+
+def _classify(msg):
+    found = {group for group, word in _TRIGGERS if word in msg}
+    if any(hint in msg for hint in _STATS_HINTS) and _STATS.search(msg):
+        found.add('stats')
+
+    patient_id = staff_id = None
+    update_name = update_pairs = field_update = lookup_name = None
+    intents = []
+    if 'update' in found:
+        patient_id = extract_id_for_role(msg, 'patient') if 'patient' in found else None
+        staff_id = extract_id_for_role(msg, 'staff') if 'staff' in found else None
+        intents.append(UPDATE_FIELDS)
+        if not (patient_id or staff_id):
+            update_name = find_name_in_msg(msg)
+        update_pairs = tuple(extract_field_value_pairs(msg).items())
+        field_update = _field_update(msg)
+        if field_update:
+            intents.append(UPDATE_FIELD)
+    intents.append(LLM)
+    for intent in _TERMINAL:
+        if intent in found:
+            intents.append(intent)
+            return Route(tuple(intents), patient_id, staff_id, update_name,
+                         update_pairs, field_update, lookup_name)
+
+    if 'update' not in found:
+        patient_id = extract_id_for_role(msg, 'patient') if 'patient' in found else None
+        staff_id = extract_id_for_role(msg, 'staff') if 'staff' in found else None
+    if patient_id:
+        intents.append(PATIENT_BY_ID)
+    if staff_id:
+        intents.append(STAFF_BY_ID)
+    if 'lookup' in found:
+        lookup_name = extract_name_after_keywords(msg)
+        if lookup_name:
+            intents.append(NAME_LOOKUP)
+
+    return Route(tuple(intents), patient_id, staff_id, update_name,
+                 update_pairs, field_update, lookup_name)
+
+
+# Recent normalized messages -> parsed Route. Routes are immutable tuples so
+# cached entries can be shared between requests safely.
+classify = lru_cache(maxsize=int(os.getenv('INTENT_CACHE_SIZE', 1024)))(_classify)
+
+
+def primary_intent(route):
+    # the intent that will most likely answer, for reports and metrics
+    for intent in route.intents:
+        if intent != LLM:
+            return intent
+    return 'fallback'
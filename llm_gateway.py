@@ -0,0 +1,208 @@
+import hashlib, json, os, re, threading, time
+from record_cache import MemoryStore
+import metrics
+
+# ---------- LLM gateway ----------
+# Every OpenAI call made by the chat handlers goes through here. Calls are
+# bounded by a per-call timeout and a per-process concurrency cap, answers
+# are cached (by normalized message for parsing, by record contents for
+# summaries), and a circuit breaker stops calling a failing upstream so the
+# regex handlers answer straight away. Any failure returns None, which the
+# handlers already treat as "no LLM answer".
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 8))
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 2))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', 0.5))
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', 5))
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', 30))
+LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', 2000))
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', 600))
+
+PARSE_SYSTEM_PROMPT = (
+    "You are a strict JSON-only parser for a hospital chatbot. "
+    "When given a user message, output valid JSON with one of the following structures (no extra text):\n"
+    "1) {\"action\": \"show\", \"target\": \"patient\"|\"staff\", \"id\": <int>|null, \"name\": <string>|null }\n"
+    "2) {\"action\": \"update\", \"target\": \"patient\"|\"staff\", \"id\": <int>|null, \"fields\": {<field>: <value>, ...} }\n"
+    "3) {\"action\": \"add\", \"target\": \"patient\"|\"staff\", \"fields\": {<field>: <value>, ...} }\n"
+    "4) {\"action\": \"text\", \"response\": <string> }\n"
+    "Only output JSON. If the user asks for an update but no id is provided, try to extract a name and set id to null. Do not include any explanatory text.")
+
+_JSON_BLOCK = re.compile(r"\{[\s\S]*\}")
+_WHITESPACE = re.compile(r"\s+")
+# cached "the model answered but not with usable JSON"
+_UNPARSED = ('unparsed',)
+
+
+class CircuitBreaker:
+    # closed -> open after `failures` consecutive errors; after `cooldown`
+    # seconds one trial call is let through (half-open) to probe recovery.
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self._errors = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = 'half_open'
+                self._trial = False
+            if self.state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = 'closed'
+            self._errors = 0
+
+    def failure(self):
+        with self._lock:
+            self._errors += 1
+            if self.state == 'half_open' or self._errors >= self.failures:
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+
+def _record_key(kind, record):
+    raw = json.dumps(record, sort_keys=True, default=str)
+    return f"{kind}:{hashlib.sha1(raw.encode()).hexdigest()}"
+
+
+class LLMGateway:
+    def __init__(self):
+        self.cache = MemoryStore(LLM_CACHE_SIZE)
+        self.breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN)
+        self._slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+        self._stats = {'calls': 0, 'cache_hits': 0, 'errors': 0, 'rejected_busy': 0, 'rejected_open': 0}
+
+    def enabled(self):
+        return bool(os.getenv('OPENAI_API_KEY'))
+
+    def _openai(self):
+        import openai
+        openai.api_key = os.getenv('OPENAI_API_KEY')
+        if os.getenv('OPENAI_API_BASE'):
+            openai.api_base = os.getenv('OPENAI_API_BASE')
+        return openai
+
+    def _call(self, api, **kwargs):
+        if not self._slots.acquire(timeout=LLM_QUEUE_TIMEOUT):
+            # all slots busy: answer from the regex handlers instead of queueing
+            self._stats['rejected_busy'] += 1
+            return None
+        # the breaker is asked only once a slot is held: a half-open trial
+        # handed out here always ends in success() or failure()
+        if not self.breaker.allow():
+            self._slots.release()
+            self._stats['rejected_open'] += 1
+            return None
+        try:
+            self._stats['calls'] += 1
+            # openai missing or misconfigured counts as a failure like any other
+            with metrics.span('llm'):
+                resp = getattr(self._openai(), api).create(request_timeout=LLM_TIMEOUT, **kwargs)
+        except Exception:
+            self._stats['errors'] += 1
+            self.breaker.failure()
+            return None
+        finally:
+            self._slots.release()
+        self.breaker.success()
+        return resp
+
+    def _cached(self, key, compute):
+        hit = self.cache.get(key)
+        if hit is not None:
+            self._stats['cache_hits'] += 1
+            return hit
+        value = compute()
+        if value is not None:
+            self.cache.set(key, value, LLM_CACHE_TTL)
+        return value
+
+    def parse(self, msg):
+        """Structured action for a chat message, or None."""
+        if not self.enabled():
+            return None
+        key = 'parse:' + _WHITESPACE.sub(' ', msg.strip().lower())
+
+        def compute():
+            resp = self._call('ChatCompletion', model='gpt-3.5-turbo', messages=[
+                {"role": "system", "content": PARSE_SYSTEM_PROMPT},
+                {"role": "user", "content": msg},
+            ], max_tokens=300, temperature=0.0)
+            out = _content(resp)
+            if out is None:
+                return None
+            parsed = _parse_json(out)
+            return parsed if isinstance(parsed, dict) else _UNPARSED
+
+        parsed = self._cached(key, compute)
+        return None if parsed is None or parsed == _UNPARSED else parsed
+
+    def summarize(self, record):
+        """Short factual summary of a record, or None."""
+        if not self.enabled():
+            return None
+
+        def compute():
+            prompt = f"Produce a concise, factual summary for this record: {record}"
+            resp = self._call('ChatCompletion', model='gpt-3.5-turbo',
+                              messages=[{"role": "user", "content": prompt}], max_tokens=200, temperature=0.3)
+            return _content(resp)
+
+        return self._cached(_record_key('summary', record), compute)
+
+    def describe_patient(self, record):
+        """Friendly paragraph about a patient record, or None."""
+        if not self.enabled():
+            return None
+
+        def compute():
+            prompt = f"Convert this patient record into a clear, friendly paragraph for a doctor or staff member:\n{str(record)}"
+            resp = self._call('Completion', engine='text-davinci-003', prompt=prompt,
+                              max_tokens=180, temperature=0.3)
+            return _content(resp, chat=False)
+
+        return self._cached(_record_key('describe', record), compute)
+
+    def stats(self):
+        out = dict(self._stats)
+        out.update(enabled=self.enabled(), breaker=self.breaker.state, cached=len(self.cache))
+        return out
+
+
+def _content(resp, chat=True):
+    # text of the first choice, or None for a missing / malformed response
+    if resp is None:
+        return None
+    try:
+        choice = resp.choices[0]
+        text = (choice.message.content if chat else choice.text).strip()
+    except (AttributeError, IndexError, KeyError, TypeError):
+        return None
+    return text or None
+
+
+def _parse_json(out):
+    # Attempt to extract JSON block
+    try:
+        return json.loads(out)
+    except Exception:
+        # Try to find first {...}
+        m = _JSON_BLOCK.search(out)
+        if m:
+            try:
+                return json.loads(m.group(0))
+            except Exception:
+                return None
+        return None
+
+
+gateway = LLMGateway()
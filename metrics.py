@@ -0,0 +1,230 @@
+import atexit, bisect, contextvars, glob, json, logging, os, re, threading, time
+from contextlib import contextmanager
+
+# ---------- Metrics ----------
+# Each request carries a small trace (a dict in a contextvar). span() adds
+# the time spent in a phase to it: intent routing, db_connect (pool checkout,
+# including waits), db_query, llm and serialize. When the request ends, every
+# phase total goes into a histogram, along with the request duration, and
+# a counter ticks. Outside a request span() does nothing but one contextvar
+# lookup.
+#
+# /metrics renders Prometheus text. With METRICS_DIR set, each worker writes
+# its totals to METRICS_DIR/<pid>.json at most every METRICS_FLUSH_INTERVAL
+# seconds, and /metrics adds up the files of all live workers. Totals from an
+# exited worker disappear with it, which Prometheus treats as a counter reset.
+#
+# SLOW_REQUEST_MS > 0 logs requests slower than that to the 'hms.slow' logger
+# with their phase breakdown and the SQL they issued (statements only, never
+# parameters).
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') != '0'
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 1))
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 0))
+
+PHASES = ('intent', 'db_connect', 'db_query', 'llm', 'serialize')
+# seconds; fine at the low end where most chat requests land
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_SLOW_SQL_MAX = 50
+_WHITESPACE = re.compile(r'\s+')
+
+slow_log = logging.getLogger('hms.slow')
+_trace = contextvars.ContextVar('metrics_trace', default=None)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            h[bisect.bisect_left(BUCKETS, seconds)] += 1
+            h[-1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': [[n, list(l), v] for (n, l), v in self.counters.items()],
+                    'histograms': [[n, list(l), list(h)] for (n, l), h in self.histograms.items()]}
+
+
+registry = Registry()
+
+
+# ---------- Tracing ----------
+def start_request():
+    if not METRICS_ENABLED:
+        return None
+    trace = {'start': time.perf_counter(), 'phases': {}, 'intent': None,
+             'sql': [] if SLOW_REQUEST_MS > 0 else None}
+    _trace.set(trace)
+    return trace
+
+
+def set_intent(intent):
+    trace = _trace.get()
+    if trace is not None:
+        trace['intent'] = intent
+
+
+@contextmanager
+def span(phase, sql=None):
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        phases = trace['phases']
+        phases[phase] = phases.get(phase, 0.0) + elapsed
+        if sql is not None and trace['sql'] is not None and len(trace['sql']) < _SLOW_SQL_MAX:
+            trace['sql'].append((round(elapsed * 1000, 3), sql))
+
+
+def finish_request(endpoint, status):
+    trace = _trace.get()
+    if trace is None:
+        return
+    _trace.set(None)
+    elapsed = time.perf_counter() - trace['start']
+    endpoint = endpoint or 'unknown'
+    intent = trace['intent'] or ''
+    registry.inc('hms_requests_total', (('endpoint', endpoint), ('intent', intent), ('status', str(status))))
+    registry.observe('hms_request_seconds', (('endpoint', endpoint), ('intent', intent)), elapsed)
+    for phase, seconds in trace['phases'].items():
+        registry.observe('hms_phase_seconds', (('phase', phase), ('intent', intent)), seconds)
+    if SLOW_REQUEST_MS > 0 and elapsed * 1000 >= SLOW_REQUEST_MS:
+        registry.inc('hms_slow_requests_total', (('endpoint', endpoint),))
+        slow_log.warning(json.dumps({
+            'endpoint': endpoint, 'intent': intent, 'status': status, 'ms': round(elapsed * 1000, 3),
+            'phases': {p: round(s * 1000, 3) for p, s in trace['phases'].items()},
+            'sql': [[ms, _WHITESPACE.sub(' ', q).strip()[:500]] for ms, q in trace['sql']],
+        }))
+    _maybe_flush()
+
+
+# ---------- Cross-worker aggregation ----------
+_last_flush = [0.0]
+
+
+def _snapshot_path(pid=None):
+    return os.path.join(METRICS_DIR, f"{pid or os.getpid()}.json")
+
+
+def flush():
+    if not METRICS_DIR:
+        return
+    _last_flush[0] = time.monotonic()
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        tmp = _snapshot_path() + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(registry.snapshot(), fh)
+        os.replace(tmp, _snapshot_path())
+    except OSError:
+        pass
+
+
+def _maybe_flush():
+    if METRICS_DIR and time.monotonic() - _last_flush[0] >= METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _collect():
+    # this worker's live numbers plus the latest snapshot of every other live worker
+    snaps = [registry.snapshot()]
+    if METRICS_DIR:
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            try:
+                pid = int(os.path.basename(path)[:-len('.json')])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            if not _alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as fh:
+                    snaps.append(json.load(fh))
+            except (OSError, ValueError):
+                continue
+    counters = {}; histograms = {}
+    for snap in snaps:
+        for name, labels, value in snap['counters']:
+            key = (name, tuple(tuple(l) for l in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, h in snap['histograms']:
+            key = (name, tuple(tuple(l) for l in labels))
+            acc = histograms.setdefault(key, [0] * len(h))
+            for i, v in enumerate(h):
+                acc[i] += v
+    return counters, histograms
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+    return '{' + body + '}'
+
+
+def render(gauges=None):
+    """Prometheus text exposition of all workers' metrics, plus this worker's gauges."""
+    counters, histograms = _collect()
+    lines = []
+    for name in sorted({n for n, _ in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f"{name}{_labels(labels)} {value:g}")
+    for name in sorted({n for n, _ in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (n, labels), h in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, h):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+            cumulative += h[len(BUCKETS)]
+            lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {h[-1]:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    for name, values in sorted((gauges or {}).items()):
+        lines.append(f"# TYPE {name} gauge")
+        for stat, value in sorted(values.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines.append(f"{name}{_labels([('stat', stat), ('pid', os.getpid())])} {value:g}")
+    return '\n'.join(lines) + '\n'
+
+
+atexit.register(flush)
@@ -0,0 +1,216 @@
+"""Apply the versioned schema migrations in migrations/ and check index usage.
+
+    python migrate.py              create DB_NAME if needed and apply pending migrations
+    python migrate.py --status     list applied and pending versions
+    python migrate.py --dry-run    print the statements that would run
+    python migrate.py --verify     EXPLAIN the app's hot queries against the live schema
+
+Uses the same DB_* environment variables as the app. With DB_SHARDS every
+hospital database in the shard map is migrated in turn. With DB_BACKEND=sqlite
+there is nothing to migrate: the SQLite file gets the whole schema when it is
+first opened, and --status and --verify only apply to MySQL.
+"""
+import argparse, functools, glob, hashlib, os, re, sys
+import db
+import name_search
+
+# ---------- Migrations ----------
+# Files are named NNNN_description.sql and run in version order. Applied
+# versions are recorded in schema_migrations with a checksum, so an edited
+# migration is reported instead of silently skipped. MySQL commits DDL
+# implicitly, so each statement stands alone. A statement that fails
+# because its column or index already exists (or, for a drop, is already
+# gone) is treated as applied. That lets the runner adopt databases built
+# from older copies of schema.sql, and re-run a file that stopped halfway.
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+_FILENAME = re.compile(r'^(\d{4})_(\w+)\.sql$')
+# duplicate column name, duplicate key name, can't drop a missing key
+_ALREADY_THERE = {1060, 1061, 1091}
+
+
+def discover():
+    """[(version, name, path), ...] in the order they apply."""
+    out = []
+    for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, '*.sql'))):
+        m = _FILENAME.match(os.path.basename(path))
+        if m:
+            out.append((m.group(1), m.group(2), path))
+    return out
+
+
+def statements(sql):
+    body = '\n'.join(line for line in sql.splitlines() if not line.strip().startswith('--'))
+    return [s.strip() for s in body.split(';') if s.strip()]
+
+
+def _checksum(sql):
+    return hashlib.sha1(sql.encode()).hexdigest()
+
+
+def ensure_database(connect=db._connect, name=None):
+    name = name or os.getenv('DB_NAME', 'hospital_database')
+    conn = connect(database=None)
+    try:
+        conn.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{name}`")
+    finally:
+        conn.close()
+
+
+def _applied(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+        version CHAR(4) PRIMARY KEY,
+        name VARCHAR(200) NOT NULL,
+        checksum CHAR(40) NOT NULL,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP)""")
+    cursor.execute("SELECT version, checksum FROM schema_migrations")
+    return dict(cursor.fetchall())
+
+
+def migrate(dry_run=False, out=print, connect=db._connect, database=None):
+    """Apply pending migrations; returns the versions applied.
+
+    connect/database pick another database than DB_NAME (a hospital's on a shard).
+    """
+    if not dry_run:
+        ensure_database(connect, database)
+    conn = connect()
+    cursor = conn.cursor()
+    done = []
+    try:
+        applied = _applied(cursor)
+        for version, name, path in discover():
+            sql = open(path).read()
+            if version in applied:
+                if applied[version] != _checksum(sql):
+                    out(f"warning: {version}_{name} changed after it was applied")
+                continue
+            out(f"{'would apply' if dry_run else 'applying'} {version}_{name}")
+            for stmt in statements(sql):
+                if dry_run:
+                    out(f"  {stmt};")
+                    continue
+                try:
+                    cursor.execute(stmt)
+                except db.Error as err:
+                    if err.errno not in _ALREADY_THERE:
+                        raise
+                    out(f"  already there: {err.msg}")
+            if not dry_run:
+                cursor.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                               (version, name, _checksum(sql)))
+                conn.commit()
+                done.append(version)
+    finally:
+        cursor.close()
+        conn.close()
+    return done
+
+
+def status(out=print, connect=db._connect):
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        applied = _applied(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+    for version, name, _ in discover():
+        out(f"{version}_{name}: {'applied' if version in applied else 'pending'}")
+
+
+# ---------- Index verification ----------
+# (what, query, params, indexes that count as a pass). Queries are the ones
+# the app runs on its hot paths, with representative parameters.
+HOT_QUERIES = [
+    ('record by id', "SELECT * FROM patients WHERE patient_id = %s", (1,), {'PRIMARY'}),
+    ('patient name search', name_search._branch('patient', True),
+     ('"john"', '"john"', '%john%', 100), {'ft_patients_name'}),
+    ('staff name search', name_search._branch('staff', True),
+     ('"john"', '"john"', '%john%', 100), {'ft_staff_name'}),
+    ('patients by exact name', "SELECT patient_id FROM patients WHERE name = %s", ('john doe',), {'idx_patients_name'}),
+    ('patients by doctor', "SELECT patient_id FROM patients WHERE doctor_assigned = %s",
+     ('dr rao',), {'idx_patients_doctor'}),
+    ('appointments of a patient', "SELECT * FROM appointments WHERE patient_id = %s", (1,), {'patient_id'}),
+    ('appointments between dates', "SELECT appointment_id FROM appointments WHERE appointment_date BETWEEN %s AND %s",
+     ('2026-01-01', '2026-01-07'), {'idx_appointments_date', 'idx_appointments_staff_slot'}),
+    ('booking clash check', "SELECT appointment_time FROM appointments WHERE staff_id = %s AND appointment_date = %s "
+     "AND appointment_time > %s AND appointment_time < %s LIMIT 1",
+     (1, '2026-01-05', '09:30:00', '10:30:00'), {'idx_appointments_staff_slot'}),
+    ('free slots', "SELECT appointment_date, appointment_time FROM appointments WHERE staff_id = %s "
+     "AND appointment_date BETWEEN %s AND %s ORDER BY appointment_date, appointment_time",
+     (1, '2026-01-01', '2026-01-07'), {'idx_appointments_staff_slot'}),
+    ('statistics counters', "SELECT bucket, n FROM hospital_stats WHERE metric = %s AND n <> 0", ('doctor',),
+     {'PRIMARY'}),
+    ('chat history page', "SELECT history_id, user_id, message, is_user, timestamp FROM user_history "
+     "WHERE user_id = %s ORDER BY timestamp DESC, history_id DESC LIMIT %s",
+     ('anonymous', 50), {'idx_user_history_user_ts'}),
+]
+
+
+def verify(out=print, connect=db._connect):
+    """EXPLAIN each hot query. Returns the number of queries that can't use their index.
+
+    A query whose index is possible but not chosen (usually a near-empty
+    table) is a warning, not a failure; run this on representative data.
+    """
+    conn = connect()
+    cursor = conn.cursor(dictionary=True)
+    failures = 0
+    try:
+        for what, query, params, wanted in HOT_QUERIES:
+            cursor.execute("EXPLAIN " + query, params)
+            plan = cursor.fetchall()
+            chosen = {k for r in plan for k in (r.get('key') or '').split(',') if k}
+            possible = {k for r in plan for k in (r.get('possible_keys') or '').split(',') if k}
+            if chosen & wanted:
+                verdict = 'ok'
+            elif possible & wanted:
+                verdict = 'warn (index possible, not chosen)'
+            else:
+                verdict = 'FAIL'
+                failures += 1
+            out(f"{verdict:<36} {what}: key={','.join(sorted(chosen)) or '-'}")
+    finally:
+        cursor.close()
+        conn.close()
+    return failures
+
+
+def targets():
+    """[(label, connect, database name), ...]: DB_NAME, or each hospital's database with shards."""
+    if not db.DB_SHARDS:
+        return [('', db._connect, None)]
+    return [(f"hospital {h} on {shard}: ", functools.partial(db.connect_hospital, shard, h), db.hospital_database(h))
+            for h, (shard, _) in sorted(db.shard_map().items())]
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Apply schema migrations.')
+    ap.add_argument('--status', action='store_true')
+    ap.add_argument('--dry-run', action='store_true')
+    ap.add_argument('--verify', action='store_true')
+    args = ap.parse_args()
+    failures = 0
+    for label, connect, database in targets():
+        out = functools.partial(lambda label, line: print(label + line), label)
+        if db.DB_BACKEND == 'sqlite':
+            if args.status or args.verify:
+                sys.exit("--status and --verify are for MySQL; the SQLite schema is created whole")
+            if args.dry_run:
+                out("would create the schema where missing")
+            else:
+                connect().close()
+                out("SQLite database has the current schema")
+        elif args.status:
+            status(out, connect)
+        elif args.verify:
+            failures += verify(out, connect)
+        else:
+            applied = migrate(args.dry_run, out, connect, database)
+            if not args.dry_run:
+                out(f"{len(applied)} migration(s) applied")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
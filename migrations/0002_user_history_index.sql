@@ -0,0 +1,2 @@
+-- Chat history pages (chat_history.read_history) seek on (user_id, timestamp).
+ALTER TABLE user_history ADD KEY idx_user_history_user_ts (user_id, timestamp);
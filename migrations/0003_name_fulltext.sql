@@ -0,0 +1,3 @@
+-- Name search (name_search.py) answers fragments from ngram full-text indexes.
+ALTER TABLE patients ADD FULLTEXT KEY ft_patients_name (name) WITH PARSER ngram;
+ALTER TABLE staff ADD FULLTEXT KEY ft_staff_name (name) WITH PARSER ngram;
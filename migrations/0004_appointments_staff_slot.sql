@@ -0,0 +1,2 @@
+-- Double-booking checks and free-slot search (scheduling.py) range-scan this index.
+ALTER TABLE appointments ADD KEY idx_appointments_staff_slot (staff_id, appointment_date, appointment_time);
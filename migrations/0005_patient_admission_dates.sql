@@ -0,0 +1,3 @@
+-- The chat update commands have always accepted these fields.
+ALTER TABLE patients ADD COLUMN admitted_date DATE;
+ALTER TABLE patients ADD COLUMN discharge_date DATE;
@@ -0,0 +1,6 @@
+-- Exact name and doctor lookups, and appointments by day (exports, daily lists).
+-- appointments(patient_id) is already indexed by its foreign key.
+ALTER TABLE patients ADD KEY idx_patients_name (name);
+ALTER TABLE patients ADD KEY idx_patients_doctor (doctor_assigned);
+ALTER TABLE staff ADD KEY idx_staff_name (name);
+ALTER TABLE appointments ADD KEY idx_appointments_date (appointment_date);
@@ -0,0 +1,30 @@
+-- Counters behind the chat's statistics answers (see hospital_stats.py).
+-- The write paths keep them current; the INSERTs fill them from the rows
+-- already there, overwriting earlier counts so the file can be re-run after
+-- a partial failure. `python hospital_stats.py --reconcile` recounts them.
+CREATE TABLE IF NOT EXISTS hospital_stats (
+    metric VARCHAR(20) NOT NULL,
+    bucket VARCHAR(100) NOT NULL,
+    n INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (metric, bucket)
+);
+INSERT INTO hospital_stats (metric, bucket, n)
+    SELECT 'patients', '', COUNT(*) FROM patients
+    ON DUPLICATE KEY UPDATE n = VALUES(n);
+INSERT INTO hospital_stats (metric, bucket, n)
+    SELECT 'doctor', COALESCE(doctor_assigned, ''), COUNT(*) FROM patients GROUP BY COALESCE(doctor_assigned, '')
+    ON DUPLICATE KEY UPDATE n = VALUES(n);
+INSERT INTO hospital_stats (metric, bucket, n)
+    SELECT 'disease', COALESCE(disease, ''), COUNT(*) FROM patients GROUP BY COALESCE(disease, '')
+    ON DUPLICATE KEY UPDATE n = VALUES(n);
+INSERT INTO hospital_stats (metric, bucket, n)
+    SELECT 'appointments', '', COUNT(*) FROM appointments
+    ON DUPLICATE KEY UPDATE n = VALUES(n);
+INSERT INTO hospital_stats (metric, bucket, n)
+    SELECT 'day', COALESCE(DATE_FORMAT(appointment_date, '%Y-%m-%d'), ''), COUNT(*) FROM appointments
+    GROUP BY COALESCE(DATE_FORMAT(appointment_date, '%Y-%m-%d'), '')
+    ON DUPLICATE KEY UPDATE n = VALUES(n);
+INSERT INTO hospital_stats (metric, bucket, n)
+    SELECT 'staff', COALESCE(CAST(staff_id AS CHAR), ''), COUNT(*) FROM appointments
+    GROUP BY COALESCE(CAST(staff_id AS CHAR), '')
+    ON DUPLICATE KEY UPDATE n = VALUES(n);
@@ -0,0 +1,7 @@
+-- The hospital (tenant) key on patients, staff and appointments. With
+-- DB_SHARDS each hospital has a database of its own, and tools/rebalance.py
+-- sets these defaults to that hospital's id when it adds the hospital, so
+-- every insert is stamped. A single-database deployment keeps hospital 1.
+ALTER TABLE patients ADD COLUMN hospital_id INT NOT NULL DEFAULT 1;
+ALTER TABLE staff ADD COLUMN hospital_id INT NOT NULL DEFAULT 1;
+ALTER TABLE appointments ADD COLUMN hospital_id INT NOT NULL DEFAULT 1;
@@ -0,0 +1,8 @@
+-- Rebuilds the name indexes from 0003 without a stopword list. The default
+-- InnoDB list holds single letters such as "a" and "i", and ngram drops every
+-- token containing a stopword, so "priya" or "amit" were never indexed.
+SET SESSION innodb_ft_enable_stopword = 0;
+ALTER TABLE patients DROP INDEX ft_patients_name;
+ALTER TABLE patients ADD FULLTEXT KEY ft_patients_name (name) WITH PARSER ngram;
+ALTER TABLE staff DROP INDEX ft_staff_name;
+ALTER TABLE staff ADD FULLTEXT KEY ft_staff_name (name) WITH PARSER ngram;
@@ -0,0 +1,87 @@
+from db import run_query
+import os, re
+
+# ---------- Name search ----------
+# Patient and staff names carry a FULLTEXT index built with the ngram parser
+# (see migrations/), so a name fragment is answered from the index instead of
+# a LIKE '%name%' full scan. Both tables are searched in one round-trip.
+# The LIKE stays in the WHERE clause to re-check the rows the index
+# returns. A table the index finds nothing in is scanned with the LIKE
+# alone, so a name the index misses (indexes built with the stopword list,
+# before migration 0009) is still found as the old substring search found it.
+NAME_SEARCH_LIMIT = int(os.getenv('NAME_SEARCH_LIMIT', 100))
+
+_TABLES = {'patient': ('patients', 'patient_id'), 'staff': ('staff', 'staff_id')}
+# characters with a meaning in boolean-mode full-text queries
+_BOOLEAN_OPS = re.compile(r'[+\-<>()~*"@]')
+# ngram_token_size defaults to 2; shorter input has no tokens to look up
+_MIN_TOKEN = 2
+# (kinds, use_index) -> the search statement, built once
+_QUERIES = {}
+
+
+def _branch(kind, use_index):
+    # each side is a derived table so it can carry its own ORDER BY / LIMIT
+    table, idcol = _TABLES[kind]
+    if use_index:
+        return (f"SELECT * FROM (SELECT '{kind}' AS kind, {idcol} AS id, name, "
+                f"MATCH(name) AGAINST (%s IN BOOLEAN MODE) AS score FROM {table} "
+                f"WHERE MATCH(name) AGAINST (%s IN BOOLEAN MODE) AND name LIKE %s "
+                f"ORDER BY score DESC LIMIT %s) AS {kind}_hits")
+    return (f"SELECT * FROM (SELECT '{kind}' AS kind, {idcol} AS id, name, 0 AS score FROM {table} "
+            f"WHERE name LIKE %s LIMIT %s) AS {kind}_hits")
+
+
+def search_names(name, kinds=('patient', 'staff'), limit=None):
+    """Ranked candidates per kind: {'patient': [{'id', 'name', 'score'}, ...], 'staff': [...]}.
+
+    Exact (case-insensitive) name matches rank first, then full-text relevance.
+    Returns an error string if the query failed, like run_query.
+    """
+    limit = limit or NAME_SEARCH_LIMIT
+    phrase = _BOOLEAN_OPS.sub(' ', name).strip()
+    use_index = len(phrase.replace(' ', '')) >= _MIN_TOKEN
+    rows = _search(kinds, use_index, phrase, name, limit)
+    missed = [] if isinstance(rows, str) or not use_index else [k for k in kinds if k not in {r['kind'] for r in rows}]
+    if missed:
+        more = _search(missed, False, phrase, name, limit)
+        rows = more if isinstance(more, str) else rows + more
+    if isinstance(rows, str):
+        return rows
+
+    out = {kind: [] for kind in kinds}
+    for r in rows:
+        out[r['kind']].append({'id': r['id'], 'name': r['name'], 'score': float(r['score'] or 0)})
+    needle = name.strip().lower()
+    for cands in out.values():
+        cands.sort(key=lambda c: ((c['name'] or '').lower() != needle, -c['score']))
+    return out
+
+
+def _search(kinds, use_index, phrase, name, limit):
+    like = f"%{name}%"
+    params = []
+    for kind in kinds:
+        if use_index:
+            params += [f'"{phrase}"', f'"{phrase}"', like, limit]
+        else:
+            params += [like, limit]
+    key = (tuple(kinds), use_index)
+    query = _QUERIES.get(key)
+    if query is None:
+        query = _QUERIES[key] = ' UNION ALL '.join(_branch(k, use_index) for k in kinds)
+    rows = run_query(query, tuple(params), fetch=True)
+    return rows if isinstance(rows, str) else rows or []
+
+
+def fetch_by_ids(kind, ids):
+    # full rows for the chosen candidates, in candidate order
+    if not ids:
+        return []
+    table, idcol = _TABLES[kind]
+    marks = ', '.join(['%s'] * len(ids))
+    rows = run_query(f"SELECT * FROM {table} WHERE {idcol} IN ({marks})", tuple(ids), fetch=True)
+    if isinstance(rows, str):
+        return rows
+    order = {i: n for n, i in enumerate(ids)}
+    return sorted(rows or [], key=lambda r: order.get(r[idcol], 0))
@@ -0,0 +1,225 @@
+import os, pickle, sqlite3, threading, time
+from collections import OrderedDict
+import db
+from db import run_query
+
+# ---------- Record cache ----------
+# Read-through cache for by-id lookups of patients, staff and appointments.
+# Write paths call invalidate() for the exact record they touched; inside a
+# batch the invalidation waits for the commit, and reads skip the cache so
+# they see the batch's own uncommitted writes. An invalidation leaves a
+# tombstone stamped with its time, and a read only stores the row it loaded
+# if no tombstone newer than the start of its load is there: otherwise a
+# write landing between the load and the store would be hidden by the old
+# row until the TTL ran out. The
+# backing store is chosen with RECORD_CACHE:
+#   memory (default)        per-process LRU
+#   sqlite:///cache.db      one store shared by every worker on the host
+#                           (sqlite:////abs/path.db for an absolute path)
+#   off                     no caching
+RECORD_CACHE = os.getenv('RECORD_CACHE', 'memory')
+RECORD_CACHE_SIZE = int(os.getenv('RECORD_CACHE_SIZE', 5000))
+RECORD_CACHE_TTL = float(os.getenv('RECORD_CACHE_TTL', 60))
+
+TABLES = {
+    'patient': ('patients', 'patient_id'),
+    'staff': ('staff', 'staff_id'),
+    'appointment': ('appointments', 'appointment_id'),
+}
+_BY_ID = {kind: f"SELECT * FROM {table} WHERE {idcol} = %s" for kind, (table, idcol) in TABLES.items()}
+
+# cached "no such record", so repeated misses don't reach MySQL either
+_MISSING = ('missing',)
+
+
+class MemoryStore:
+    name = 'memory'
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        # key -> (expires, value, invalidated at or None); least recently used first
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl, since=None):
+        # since: when the caller began loading value; skipped if the key was
+        # invalidated after that
+        with self._lock:
+            item = self._data.get(key)
+            if since is not None and item is not None and item[2] is not None and item[2] >= since:
+                return
+            self._put(key, (time.monotonic() + ttl, value, None))
+
+    def invalidate(self, key, ttl):
+        with self._lock:
+            self._put(key, (time.monotonic() + ttl, None, time.time()))
+
+    def _put(self, key, item):
+        self._data[key] = item
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SqliteStore:
+    # A local stand-in for a shared cache server: one WAL-mode SQLite file
+    # that every gunicorn worker on the host reads and writes. Size is
+    # enforced every 100 writes, so it may briefly run over max_entries.
+    # A tombstone is a row with a NULL value, touched when it was invalidated.
+    name = 'sqlite'
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._sets = 0
+        self.evictions = 0
+        self._conn().execute("""CREATE TABLE IF NOT EXISTS record_cache (
+            key TEXT PRIMARY KEY, value BLOB, expires REAL, touched REAL)""")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS record_cache_touched ON record_cache (touched)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        row = self._conn().execute("SELECT value, expires, touched FROM record_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        if row[1] < now:
+            self.delete(key)
+            return None
+        # approximate LRU: refresh the access time at most once a second
+        if row[2] < now - 1:
+            self._conn().execute("UPDATE record_cache SET touched = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl, since=None):
+        now = time.time()
+        conn = self._conn()
+        # one statement, so a tombstone written by another worker in between counts
+        conn.execute("INSERT INTO record_cache (key, value, expires, touched) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires, "
+                     "touched = excluded.touched WHERE record_cache.value IS NOT NULL OR record_cache.touched < ?",
+                     (key, pickle.dumps(value), now + ttl, now, now if since is None else since))
+        self._sets += 1
+        if self._sets % 100 == 0:
+            conn.execute("DELETE FROM record_cache WHERE expires < ?", (now,))
+            excess = conn.execute("SELECT COUNT(*) FROM record_cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM record_cache WHERE key IN "
+                             "(SELECT key FROM record_cache ORDER BY touched LIMIT ?)", (excess,))
+                self.evictions += excess
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM record_cache WHERE key = ?", (key,))
+
+    def invalidate(self, key, ttl):
+        now = time.time()
+        self._conn().execute("INSERT OR REPLACE INTO record_cache (key, value, expires, touched) VALUES (?, NULL, ?, ?)",
+                             (key, now + ttl, now))
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM record_cache").fetchone()[0]
+
+
+def _make_store(spec):
+    if spec == 'off':
+        return None
+    if spec.startswith('sqlite:///'):
+        return SqliteStore(spec[len('sqlite:///'):], RECORD_CACHE_SIZE)
+    return MemoryStore(RECORD_CACHE_SIZE)
+
+
+class RecordCache:
+    def __init__(self, store, ttl=RECORD_CACHE_TTL):
+        self.store = store
+        self.ttl = ttl
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'errors': 0}
+
+    def _count(self, name):
+        self._stats[name] += 1
+
+    def _key(self, kind, rec_id):
+        # ids are per hospital
+        return f"{db.hospital()}:{kind}:{int(rec_id)}"
+
+    def get(self, kind, rec_id):
+        """The row for kind/rec_id, None if it doesn't exist, or an error string."""
+        key = self._key(kind, rec_id)
+        store = None if db.in_batch() else self.store
+        if store is not None:
+            try:
+                cached = store.get(key)
+            except (sqlite3.Error, pickle.PickleError):
+                self._count('errors'); cached = None
+            if cached is not None:
+                self._count('hits')
+                return None if cached == _MISSING else cached
+        self._count('misses')
+        started = time.time()
+        # from the primary: a lagging replica could refill the cache with a row
+        # that was just invalidated
+        rows = run_query(_BY_ID[kind], (int(rec_id),), fetch=True, primary=True)
+        if isinstance(rows, str):
+            return rows
+        row = rows[0] if rows else None
+        if store is not None:
+            try:
+                store.set(key, row if row is not None else _MISSING, self.ttl, since=started)
+            except sqlite3.Error:
+                self._count('errors')
+        return row
+
+    def invalidate(self, kind, rec_id):
+        if self.store is None or rec_id is None:
+            return
+        key = self._key(kind, rec_id)
+        db.after_commit(lambda: self._delete(key))
+
+    def _delete(self, key):
+        self._count('invalidations')
+        try:
+            self.store.invalidate(key, self.ttl)
+        except sqlite3.Error:
+            self._count('errors')
+
+    def stats(self):
+        out = dict(self._stats)
+        out['backend'] = self.store.name if self.store is not None else 'off'
+        if self.store is not None:
+            out['evictions'] = self.store.evictions
+            try:
+                out['entries'] = len(self.store)
+            except sqlite3.Error:
+                pass
+        return out
+
+
+records = RecordCache(_make_store(RECORD_CACHE))
@@ -0,0 +1,136 @@
+import datetime, decimal, gzip, os
+import metrics
+
+try:
+    import orjson
+except ImportError:  # optional: the stdlib json encoder is used instead
+    orjson = None
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+# ---------- Response format ----------
+# Table replies can go out in two shapes:
+#   rows     (default) {"data": [{"col": value, ...}, ...]}, as always
+#   columns  {"columns": [...], "types": [...], "rows": [[...], ...]}
+# The columnar shape names each column once and decides once per column
+# whether its values need converting (dates, times and decimals become
+# strings, exactly as in the rows shape). JSON bodies are written with
+# orjson when it is installed and compressed with brotli or gzip when the
+# client accepts it.
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 4))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 4))
+RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', '1') != '0'
+
+FORMATS = ('rows', 'columns')
+_COMPRESSIBLE = {'application/json', 'text/plain', 'text/csv'}
+_NATIVE = {int: 'int', float: 'float', str: 'str', bool: 'bool'}
+_CONVERTED = {datetime.datetime: 'datetime', datetime.date: 'date', datetime.timedelta: 'time',
+              datetime.time: 'time', decimal.Decimal: 'decimal'}
+
+
+def _sample(rows, name):
+    return next((r[name] for r in rows if r.get(name) is not None), None)
+
+
+def safe_rows(rows):
+    # the rows shape: one dict per row, non-JSON values as strings. As in
+    # columns(), a column's values all share one type, so whether it needs
+    # converting is decided once per column instead of once per value.
+    if not rows:
+        return []
+    convert = []
+    for name in rows[0]:
+        sample = _sample(rows, name)
+        if sample is not None and not isinstance(sample, (int, float, str)):
+            convert.append(name)
+    if not convert:
+        return list(rows)
+    out = []
+    for r in rows:
+        r = dict(r)
+        for name in convert:
+            if r.get(name) is not None:
+                r[name] = str(r[name])
+        out.append(r)
+    return out
+
+
+def columns(rows):
+    """The columnar shape of a list of same-keyed row dicts."""
+    if not rows:
+        return {'columns': [], 'types': [], 'rows': []}
+    names = list(rows[0])
+    types = []; convert = []
+    for i, name in enumerate(names):
+        sample = next((r[name] for r in rows if r[name] is not None), None)
+        kind = type(sample)
+        if sample is None or kind in _NATIVE:
+            types.append(_NATIVE.get(kind, 'null'))
+        else:
+            types.append(_CONVERTED.get(kind, 'str'))
+            convert.append(i)
+    if not convert:
+        out = [list(r.values()) for r in rows]
+    else:
+        out = []
+        for r in rows:
+            vals = list(r.values())
+            for i in convert:
+                if vals[i] is not None:
+                    vals[i] = str(vals[i])
+            out.append(vals)
+    return {'columns': names, 'types': types, 'rows': out}
+
+
+def shape_table(body, fmt):
+    # handlers return raw rows under 'data'; shape them for the wire once here
+    body = dict(body)
+    rows = body.pop('data', None) or []
+    if fmt == 'columns':
+        body.update(columns(rows))
+    else:
+        body['data'] = safe_rows(rows)
+    return body
+
+
+def dumps(obj, default, sort_keys=True, indent=None):
+    # orjson writes dates through `default` too, so output matches Flask's encoder
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=default, option=option).decode()
+
+
+def negotiate(accept_encodings):
+    # accept_encodings: werkzeug's parsed Accept-Encoding header
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return accept_encodings.best_match(offered)
+
+
+def compress_response(response, accept_encodings):
+    if not RESPONSE_COMPRESSION or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 304) or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in _COMPRESSIBLE:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    encoding = negotiate(accept_encodings)
+    if encoding is None:
+        return response
+    with metrics.span('serialize'):
+        if encoding == 'br':
+            data = brotli.compress(data, quality=BROTLI_QUALITY)
+        else:
+            data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,100 @@
+import bisect, datetime, os
+import db
+import hospital_stats
+
+# ---------- Appointment scheduling ----------
+# Every appointment occupies APPOINTMENT_SLOT_MINUTES for its staff member.
+# Booking locks the staff row, so two requests for the same staff member
+# queue behind each other. It then looks for a clash in the
+# (staff_id, appointment_date, appointment_time) index and inserts, all in
+# one transaction. Free-slot search reads the same index range for the staff
+# member and the requested days only.
+APPOINTMENT_SLOT_MINUTES = int(os.getenv('APPOINTMENT_SLOT_MINUTES', 30))
+CLINIC_OPEN = os.getenv('CLINIC_OPEN', '09:00')
+CLINIC_CLOSE = os.getenv('CLINIC_CLOSE', '17:00')
+FREE_SLOTS_MAX_DAYS = int(os.getenv('FREE_SLOTS_MAX_DAYS', 31))
+
+_DAY_MINUTES = 24 * 60
+
+
+def minutes(value):
+    # TIME comes back as timedelta from MySQL, as 'HH:MM[:SS]' text elsewhere
+    if isinstance(value, datetime.timedelta):
+        return int(value.total_seconds()) // 60
+    if isinstance(value, datetime.time):
+        return value.hour * 60 + value.minute
+    parts = str(value).split(':')
+    return int(parts[0]) * 60 + int(parts[1])
+
+
+def clock(mins):
+    return f"{mins // 60:02d}:{mins % 60:02d}"
+
+
+def _day(value):
+    return value if isinstance(value, datetime.date) else datetime.date.fromisoformat(str(value)[:10])
+
+
+def book_appointment(patient_id, staff_id, date, time):
+    """Insert an appointment unless it overlaps one the staff member already has.
+
+    Returns ('booked', appointment_id), ('conflict', 'HH:MM' of the clashing
+    appointment), ('no_staff', None) or ('error', message).
+    """
+    start = minutes(time)
+    slot = APPOINTMENT_SLOT_MINUTES
+    # anything starting less than one slot before or after overlaps
+    lower, upper = start - slot, start + slot
+    lower_sql, lower_op = (clock(lower) + ':00', '>') if lower >= 0 else ('00:00:00', '>=')
+    upper_sql, upper_op = (clock(upper) + ':00', '<') if upper < _DAY_MINUTES else ('23:59:59', '<=')
+    try:
+        with db.transaction() as cursor:
+            cursor.execute("SELECT staff_id FROM staff WHERE staff_id = %s FOR UPDATE", (staff_id,))
+            if cursor.fetchone() is None:
+                return 'no_staff', None
+            # a locking read sees the latest commit even if this connection
+            # already holds an older snapshot
+            cursor.execute(
+                f"SELECT appointment_time FROM appointments WHERE staff_id = %s AND appointment_date = %s "
+                f"AND appointment_time {lower_op} %s AND appointment_time {upper_op} %s LIMIT 1 FOR UPDATE",
+                (staff_id, date, lower_sql, upper_sql))
+            clash = cursor.fetchone()
+            if clash is not None:
+                return 'conflict', clock(minutes(clash[0]))
+            cursor.execute("INSERT INTO appointments (patient_id, staff_id, appointment_date, appointment_time) "
+                           "VALUES (%s, %s, %s, %s)", (patient_id, staff_id, date, clock(start) + ':00'))
+            new_id = cursor.lastrowid
+            hospital_stats.changed(cursor, 'appointment', new_id)
+    except db.Error as err:
+        return 'error', str(err)
+    return 'booked', new_id
+
+
+def free_slots(staff_id, start_date, end_date):
+    """[(date, ['HH:MM', ...]), ...] of open slot starts within clinic hours, or an error string."""
+    start_date, end_date = _day(start_date), _day(end_date)
+    slot = APPOINTMENT_SLOT_MINUTES
+    opens, closes = minutes(CLINIC_OPEN), minutes(CLINIC_CLOSE)
+    rows = db.run_query(
+        "SELECT appointment_date, appointment_time FROM appointments "
+        "WHERE staff_id = %s AND appointment_date BETWEEN %s AND %s "
+        "ORDER BY appointment_date, appointment_time",
+        (staff_id, start_date.isoformat(), end_date.isoformat()), fetch=True)
+    if isinstance(rows, str):
+        return rows
+    booked = {}
+    for r in rows:
+        booked.setdefault(_day(r['appointment_date']), []).append(minutes(r['appointment_time']))
+    out = []
+    day = start_date
+    while day <= end_date:
+        taken = booked.get(day, [])  # already sorted by the index order
+        open_slots = []
+        for t in range(opens, closes - slot + 1, slot):
+            # free when no booking starts within one slot length either side
+            i = bisect.bisect_right(taken, t - slot)
+            if i == len(taken) or taken[i] >= t + slot:
+                open_slots.append(clock(t))
+        out.append((day, open_slots))
+        day += datetime.timedelta(days=1)
+    return out
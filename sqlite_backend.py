@@ -0,0 +1,246 @@
+"""Embedded SQLite storage: DB_BACKEND=sqlite runs the app without a database server.
+
+Connections look enough like mysql.connector's for db.py: %s placeholders,
+dictionary and prepared cursors, in_transaction, ping(), and
+mysql.connector errors, so callers keep catching db.Error. The database is
+one file in WAL mode (readers never wait for the writer) holding the same
+tables and indexes as the MySQL migrations. The schema is created on first
+connect. The MySQL-only SQL the app sends is rewritten on the way in:
+
+    MATCH(name) AGAINST (%s IN BOOLEAN MODE)   a substring test (no FULLTEXT: the LIKE scans)
+    SELECT ... FOR UPDATE                      BEGIN IMMEDIATE first: SQLite locks the
+                                               database for writing, not single rows
+    SAVEPOINT outside a transaction            BEGIN IMMEDIATE first: on its own SQLite's
+                                               SAVEPOINT opens a transaction that its
+                                               RELEASE commits
+    ON DUPLICATE KEY UPDATE c = VALUES(c)      ON CONFLICT DO UPDATE SET c = excluded.c
+
+DATE, TIME and DATETIME columns come back as date, timedelta and datetime,
+as they do from MySQL. Names compare case-insensitively, as under MySQL's
+default collation.
+"""
+import datetime, decimal, re, sqlite3
+import mysql.connector
+
+# The SQLite form of migrations/ as a whole; keep the two in step. New rows
+# belong to the hospital the file was created for (see db.connect_hospital).
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS user_history (
+        history_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id VARCHAR(100), message TEXT,
+        is_user BOOLEAN, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)""",
+    "CREATE INDEX IF NOT EXISTS idx_user_history_user_ts ON user_history (user_id, timestamp)",
+    """CREATE TABLE IF NOT EXISTS patients (
+        patient_id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(100) COLLATE NOCASE, age INT,
+        gender VARCHAR(10), contact VARCHAR(20), disease VARCHAR(100) COLLATE NOCASE,
+        doctor_assigned VARCHAR(100) COLLATE NOCASE, admitted_date DATE, discharge_date DATE,
+        hospital_id INT NOT NULL DEFAULT {hospital})""",
+    "CREATE INDEX IF NOT EXISTS idx_patients_name ON patients (name)",
+    "CREATE INDEX IF NOT EXISTS idx_patients_doctor ON patients (doctor_assigned)",
+    """CREATE TABLE IF NOT EXISTS staff (
+        staff_id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(100) COLLATE NOCASE,
+        role VARCHAR(50) COLLATE NOCASE, contact VARCHAR(20), hospital_id INT NOT NULL DEFAULT {hospital})""",
+    "CREATE INDEX IF NOT EXISTS idx_staff_name ON staff (name)",
+    """CREATE TABLE IF NOT EXISTS appointments (
+        appointment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INT REFERENCES patients(patient_id) ON DELETE CASCADE,
+        staff_id INT REFERENCES staff(staff_id) ON DELETE SET NULL,
+        appointment_date DATE, appointment_time TIME, hospital_id INT NOT NULL DEFAULT {hospital})""",
+    "CREATE INDEX IF NOT EXISTS idx_appointments_staff_slot ON appointments (staff_id, appointment_date, appointment_time)",
+    "CREATE INDEX IF NOT EXISTS idx_appointments_patient ON appointments (patient_id)",
+    "CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments (appointment_date)",
+    """CREATE TABLE IF NOT EXISTS hospital_stats (
+        metric VARCHAR(20) NOT NULL, bucket VARCHAR(100) NOT NULL COLLATE NOCASE, n INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (metric, bucket))""",
+]
+
+# columns added since SCHEMA first shipped: (table, column, definition)
+ADDED_COLUMNS = [
+    ('patients', 'hospital_id', 'INT NOT NULL DEFAULT {hospital}'),
+    ('staff', 'hospital_id', 'INT NOT NULL DEFAULT {hospital}'),
+    ('appointments', 'hospital_id', 'INT NOT NULL DEFAULT {hospital}'),
+]
+
+_PLACEHOLDER = re.compile(r"%s")
+_MATCH = re.compile(r"MATCH\s*\((\w+)\)\s*AGAINST\s*\(\s*\?\s+IN\s+BOOLEAN\s+MODE\s*\)", re.I)
+_FOR_UPDATE = re.compile(r"\s+FOR\s+UPDATE\b", re.I)
+_SAVEPOINT = re.compile(r"\s*SAVEPOINT\b", re.I)
+_UPSERT = re.compile(r"\s+ON\s+DUPLICATE\s+KEY\s+UPDATE\s+(.*)$", re.I | re.S)
+_VALUES_OF = re.compile(r"\bVALUES\((\w+)\)", re.I)
+# SQLite error text -> the MySQL errno callers already handle
+_LOCKED = 1205
+
+
+def _translate(query):
+    query = _PLACEHOLDER.sub('?', query)
+    query = _MATCH.sub(r"hms_match(\1, ?)", query)
+    # ON DUPLICATE KEY UPDATE col = VALUES(col) -> ON CONFLICT DO UPDATE SET col = excluded.col
+    query = _UPSERT.sub(lambda m: " ON CONFLICT DO UPDATE SET " + _VALUES_OF.sub(r"excluded.\1", m.group(1)), query)
+    return _FOR_UPDATE.sub('', query)
+
+
+def _match(value, phrase):
+    # boolean-mode phrase '"john doe"' -> 1.0 when the name contains it
+    needle = (phrase or '').strip('"').lower()
+    return 1.0 if needle and needle in (value or '').lower() else 0.0
+
+
+def _error(exc):
+    if isinstance(exc, sqlite3.IntegrityError):
+        return mysql.connector.errors.IntegrityError(msg=str(exc))
+    if 'locked' in str(exc) or 'busy' in str(exc):
+        return mysql.connector.errors.DatabaseError(msg=str(exc), errno=_LOCKED)
+    return mysql.connector.errors.DatabaseError(msg=str(exc))
+
+
+# ---------- Types ----------
+# Values go in as ISO text and come back typed by the declared column type.
+def _parsed(parse):
+    def convert(raw):
+        text = raw.decode()
+        try:
+            return parse(text)
+        except ValueError:
+            return text  # SQLite stores whatever it was given; show it as is
+    return convert
+
+
+def _time(text):
+    h, m, s = (text.split(':') + ['0', '0'])[:3]
+    return datetime.timedelta(hours=int(h), minutes=int(m), seconds=float(s))
+
+
+def _clock(delta):
+    seconds = int(delta.total_seconds())
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+sqlite3.register_converter('DATE', _parsed(lambda t: datetime.date.fromisoformat(t[:10])))
+sqlite3.register_converter('DATETIME', _parsed(datetime.datetime.fromisoformat))
+sqlite3.register_converter('TIME', _parsed(_time))
+sqlite3.register_adapter(datetime.date, datetime.date.isoformat)
+sqlite3.register_adapter(datetime.datetime, lambda v: v.isoformat(' '))
+sqlite3.register_adapter(datetime.timedelta, _clock)
+sqlite3.register_adapter(decimal.Decimal, str)
+
+
+# ---------- Connections ----------
+class Cursor:
+    def __init__(self, conn, dictionary):
+        self._conn = conn
+        self._cur = conn._raw.cursor()
+        self._dictionary = dictionary
+        self._first_id = None
+
+    def _rows(self, rows):
+        if not self._dictionary:
+            return rows
+        names = self.column_names
+        return [dict(zip(names, r)) for r in rows]
+
+    def execute(self, query, params=()):
+        self._first_id = None
+        try:
+            if not self._conn.in_transaction and (_FOR_UPDATE.search(query) or _SAVEPOINT.match(query)):
+                # the locking read and the writes after it must not interleave
+                # with another writer's: take the write lock now. A savepoint
+                # opens a batch, which writes; and like MySQL's it must sit
+                # inside the transaction, not become one RELEASE commits
+                self._conn._raw.execute('BEGIN IMMEDIATE')
+            self._cur.execute(_translate(query), tuple(params or ()))
+        except sqlite3.Error as exc:
+            raise _error(exc) from exc
+
+    def executemany(self, query, seq):
+        seq = [tuple(p) for p in seq]
+        try:
+            self._cur.executemany(_translate(query), seq)
+        except sqlite3.Error as exc:
+            raise _error(exc) from exc
+        # like a multi-row INSERT in MySQL, lastrowid is the first new id
+        self._first_id = None
+        if seq and query.lstrip()[:6].upper() == 'INSERT':
+            self._first_id = self._cur.execute("SELECT last_insert_rowid()").fetchone()[0] - len(seq) + 1
+
+    def fetchall(self):
+        return self._rows(self._cur.fetchall())
+
+    def fetchmany(self, size=1):
+        return self._rows(self._cur.fetchmany(size))
+
+    def fetchone(self):
+        rows = self._rows(self._cur.fetchmany(1))
+        return rows[0] if rows else None
+
+    @property
+    def column_names(self):
+        return tuple(d[0] for d in self._cur.description or ())
+
+    @property
+    def lastrowid(self):
+        return self._first_id if self._first_id is not None else self._cur.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    def close(self):
+        self._cur.close()
+
+
+class Connection:
+    cursor_class = Cursor
+
+    def __init__(self, path):
+        # pooled connections move between threads, so sqlite's check is off
+        self._raw = sqlite3.connect(path, timeout=10, check_same_thread=False,
+                                    detect_types=sqlite3.PARSE_DECLTYPES)
+        self._raw.execute('PRAGMA journal_mode=WAL')
+        self._raw.execute('PRAGMA synchronous=NORMAL')
+        self._raw.execute('PRAGMA foreign_keys=ON')
+        self._raw.create_function('hms_match', 2, _match, deterministic=True)
+
+    def cursor(self, dictionary=False, buffered=None, prepared=None):
+        # SQLite caches its compiled statements itself; prepared needs nothing extra
+        return self.cursor_class(self, dictionary)
+
+    @property
+    def in_transaction(self):
+        return self._raw.in_transaction
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def ping(self, reconnect=False):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        self._raw.close()
+
+
+_created = set()
+
+
+def connect(path, hospital=1):
+    conn = Connection(path)
+    if path not in _created:
+        create_schema(conn, hospital)
+        _created.add(path)
+    return conn
+
+
+def create_schema(conn, hospital=1):
+    cur = conn.cursor()
+    for stmt in SCHEMA:
+        cur.execute(stmt.format(hospital=int(hospital)))
+    for table, column, definition in ADDED_COLUMNS:
+        cur.execute(f"SELECT 1 FROM pragma_table_info('{table}') WHERE name = %s", (column,))
+        if cur.fetchone() is None:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition.format(hospital=int(hospital))}")
+    cur.close()
+    conn.commit()
@@ -0,0 +1,323 @@
+"""Add hospitals to the shard map and move them between shards while the app runs.
+
+    python tools/rebalance.py --list                       each hospital's shard, state and size
+    python tools/rebalance.py --add 7 --shard a            create (or adopt) hospital 7's database on shard a
+    python tools/rebalance.py --move 7 --to b [--drop-source]
+    python tools/rebalance.py --balance [--dry-run]        move hospitals until the shards hold similar row counts
+
+Uses the app's DB_* settings, DB_SHARDS included. The shards are the MySQL
+servers (or, with DB_BACKEND=sqlite, the directories) named there, so
+several local instances are enough to try it out. A move first copies the
+hospital's database table by table, in key order, while the app keeps
+using the source, then copies whatever changed in the meantime. Next it
+freezes the hospital in the shard map: the app refuses the hospital's writes
+but still serves its reads. Once every worker has re-read the map, a last
+pass copies the final changes, the map points at the new shard and the
+hospital is writable again, so writes pause only for that last pass. The
+source copy stays behind as a fallback unless --drop-source is given.
+"""
+import argparse, functools, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db
+import migrate
+
+# (table, key columns), parents before children; single-column keys are
+# compared in CHUNK-row slices, the others whole
+TABLES = [
+    ('patients', ('patient_id',)),
+    ('staff', ('staff_id',)),
+    ('appointments', ('appointment_id',)),
+    ('user_history', ('history_id',)),
+    ('hospital_stats', ('metric', 'bucket')),
+]
+HOSPITAL_TABLES = ('patients', 'staff', 'appointments')  # the ones with a hospital_id column
+CHUNK = int(os.getenv('REBALANCE_CHUNK', 2000))
+LIVE_PASSES = 2
+# on top of DB_SHARD_MAP_TTL + DB_SHARD_MAP_GRACE (after which a worker that
+# could not re-read the map stops writing): time for writes begun under the
+# old map to finish
+GRACE = float(os.getenv('REBALANCE_GRACE', 2))
+
+
+# ---------- Databases ----------
+def _fetch(conn, query, params=()):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.commit()  # end the read so the next one sees newer rows
+
+
+def _write(conn, statements):
+    cursor = conn.cursor()
+    try:
+        for query, params in statements:
+            cursor.execute(query, params)
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def _home():
+    conn = db._connect()
+    db.read_shard_map(conn, create=True)
+    conn.commit()
+    return conn
+
+
+def _shard_map(home):
+    out = db.read_shard_map(home)
+    home.commit()
+    return out
+
+
+def _set(home, hospital, shard, state):
+    _write(home, [("UPDATE shard_map SET shard = %s, state = %s, updated_at = CURRENT_TIMESTAMP "
+                   "WHERE hospital_id = %s", (shard, state, hospital))])
+
+
+def _check_shard(shard):
+    if shard not in db.shards():
+        raise SystemExit(f"no shard {shard!r} in DB_SHARDS ({', '.join(db.shards()) or 'empty'})")
+
+
+def create_database(shard, hospital):
+    """Make sure the hospital's database exists on the shard with the current schema."""
+    connect = functools.partial(db.connect_hospital, shard, hospital)
+    if db.DB_BACKEND == 'sqlite':
+        os.makedirs(db.shards()[shard], exist_ok=True)
+        connect().close()  # created with the schema, hospital_id defaulting to this hospital
+        return
+    migrate.migrate(out=lambda line: None, connect=connect, database=db.hospital_database(hospital))
+    conn = connect()
+    try:
+        # rows the app inserts carry the hospital without naming it
+        _write(conn, [(f"ALTER TABLE {table} ALTER COLUMN hospital_id SET DEFAULT {int(hospital)}", ())
+                      for table in HOSPITAL_TABLES])
+    finally:
+        conn.close()
+
+
+def drop_database(shard, hospital):
+    if db.DB_BACKEND == 'sqlite':
+        path = os.path.join(db.shards()[shard], db.hospital_database(hospital) + '.db')
+        for name in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(name):
+                os.remove(name)
+        return
+    conn = db.connect_hospital(shard, hospital, database=None)
+    try:
+        _write(conn, [(f"DROP DATABASE IF EXISTS `{db.hospital_database(hospital)}`", ())])
+    finally:
+        conn.close()
+
+
+def size(shard, hospital):
+    """Patients plus appointments: the tables that grow."""
+    conn = db.connect_hospital(shard, hospital)
+    try:
+        return sum(_fetch(conn, f"SELECT COUNT(*) FROM {table}")[0][0] for table in ('patients', 'appointments'))
+    finally:
+        conn.close()
+
+
+# ---------- Copying ----------
+def _columns(conn, table):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT * FROM {table} WHERE 1 = 0")
+        cursor.fetchall()
+        return list(cursor.column_names)
+    finally:
+        cursor.close()
+
+
+def sync_table(src, dst, table, keys):
+    """Make dst's copy of the table match src's; returns the rows written plus the rows deleted."""
+    cols = _columns(src, table)
+    at = [cols.index(k) for k in keys]
+    select = f"SELECT {', '.join(cols)} FROM {table}"
+    upsert = (f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))}) "
+              "ON DUPLICATE KEY UPDATE " + ', '.join(f"{c} = VALUES({c})" for c in cols if c not in keys))
+    delete = f"DELETE FROM {table} WHERE " + ' AND '.join(f"{k} = %s" for k in keys)
+    changed, last = 0, None
+    while True:
+        if len(keys) > 1:
+            theirs, mine, done = _fetch(src, select), _fetch(dst, select), True
+        else:
+            key = keys[0]
+            after, params = ('', ()) if last is None else (f" WHERE {key} > %s", (last,))
+            theirs = _fetch(src, f"{select}{after} ORDER BY {key} LIMIT %s", params + (CHUNK,))
+            done = len(theirs) < CHUNK
+            if done:
+                # the last slice also takes whatever dst holds past src's end
+                mine = _fetch(dst, f"{select}{after}", params)
+            else:
+                upto = f"{' AND' if after else ' WHERE'} {key} <= %s"
+                mine = _fetch(dst, f"{select}{after}{upto}", params + (theirs[-1][at[0]],))
+        mine = {tuple(r[i] for i in at): tuple(r) for r in mine}
+        theirs = {tuple(r[i] for i in at): tuple(r) for r in theirs}
+        statements = [(delete, pk) for pk in mine.keys() - theirs.keys()]
+        statements += [(upsert, row) for pk, row in theirs.items() if mine.get(pk) != row]
+        _write(dst, statements)
+        changed += len(statements)
+        if done:
+            return changed
+        last = max(theirs)[0]
+
+
+def sync(src, dst):
+    return sum(sync_table(src, dst, table, keys) for table, keys in TABLES)
+
+
+# ---------- Commands ----------
+def list_hospitals(out=print):
+    home = _home()
+    try:
+        hospitals = _shard_map(home)
+    finally:
+        home.close()
+    totals = dict.fromkeys(db.shards(), 0)
+    out(f"{'hospital':>8}  {'shard':<12}{'state':<8}{'rows':>10}")
+    for h, (shard, state) in sorted(hospitals.items()):
+        rows = size(shard, h)
+        totals[shard] = totals.get(shard, 0) + rows
+        out(f"{h:>8}  {shard:<12}{state:<8}{rows:>10}")
+    for shard, rows in totals.items():
+        out(f"shard {shard}: {rows} rows")
+
+
+def add(hospital, shard, out=print):
+    _check_shard(shard)
+    home = _home()
+    try:
+        current = _shard_map(home).get(hospital)
+        if current:
+            raise SystemExit(f"hospital {hospital} is already on shard {current[0]}; use --move")
+        create_database(shard, hospital)
+        # rows from before the hospital was in the map (an unsharded database
+        # copied into place) take its id
+        conn = db.connect_hospital(shard, hospital)
+        try:
+            _write(conn, [(f"UPDATE {table} SET hospital_id = %s WHERE hospital_id <> %s", (hospital, hospital))
+                          for table in HOSPITAL_TABLES])
+        finally:
+            conn.close()
+        _write(home, [("INSERT INTO shard_map (hospital_id, shard, state) VALUES (%s, %s, %s)",
+                       (hospital, shard, db.ACTIVE))])
+    finally:
+        home.close()
+    out(f"hospital {hospital} added on shard {shard}")
+
+
+def move(hospital, to, drop_source=False, out=print):
+    _check_shard(to)
+    home = _home()
+    try:
+        entry = _shard_map(home).get(hospital)
+        if entry is None:
+            raise SystemExit(f"hospital {hospital} is not in the shard map; use --add")
+        source = entry[0]
+        if source == to:
+            out(f"hospital {hospital} is already on shard {to}")
+            return
+        create_database(to, hospital)
+        src, dst = db.connect_hospital(source, hospital), db.connect_hospital(to, hospital)
+        # rows arrive table by table, children possibly before their parents' updates
+        _write(dst, [("PRAGMA foreign_keys = OFF" if db.DB_BACKEND == 'sqlite' else "SET FOREIGN_KEY_CHECKS = 0", ())])
+        wait = db.DB_SHARD_MAP_TTL + db.DB_SHARD_MAP_GRACE + GRACE
+        try:
+            for n in range(LIVE_PASSES):
+                out(f"pass {n + 1}: {sync(src, dst)} rows copied or removed")
+            _set(home, hospital, source, db.FROZEN)
+            out(f"hospital {hospital} frozen; waiting {wait:g}s for every worker to see it")
+            time.sleep(wait)
+            out(f"final pass: {sync(src, dst)} rows copied or removed")
+            _set(home, hospital, to, db.ACTIVE)
+        except BaseException:
+            # leave it where it was, writable
+            _set(home, hospital, source, db.ACTIVE)
+            raise
+        finally:
+            src.close()
+            dst.close()
+    finally:
+        home.close()
+    out(f"hospital {hospital} moved from shard {source} to {to}")
+    if drop_source:
+        time.sleep(wait)  # workers on the old map may still be reading the source
+        drop_database(source, hospital)
+        out(f"dropped hospital {hospital}'s database on shard {source}")
+    else:
+        out(f"the copy on shard {source} stays; --drop-source removes it")
+
+
+def plan(hospitals, shard_names):
+    """Moves [(hospital, from, to)] that even out the shards.
+
+    hospitals is {hospital: (shard, rows)}. Greedily move the largest hospital
+    on the fullest shard that still narrows its gap to the emptiest one.
+    """
+    where = {h: shard for h, (shard, _) in hospitals.items()}
+    rows = {h: n for h, (_, n) in hospitals.items()}
+    while True:
+        load = dict.fromkeys(shard_names, 0)
+        for h, shard in where.items():
+            load[shard] = load.get(shard, 0) + rows[h]
+        full, empty = max(load, key=load.get), min(load, key=load.get)
+        fits = [h for h, shard in where.items() if shard == full and 0 < rows[h] < load[full] - load[empty]]
+        if not fits:
+            break
+        where[max(fits, key=rows.get)] = empty
+    return [(h, hospitals[h][0], shard) for h, shard in sorted(where.items()) if shard != hospitals[h][0]]
+
+
+def balance(dry_run=False, out=print):
+    home = _home()
+    try:
+        hospitals = {h: (shard, size(shard, h)) for h, (shard, _) in _shard_map(home).items()}
+    finally:
+        home.close()
+    moves = plan(hospitals, list(db.shards()))
+    if not moves:
+        out("shards are balanced")
+    for h, source, to in moves:
+        out(f"hospital {h} ({hospitals[h][1]} rows): {source} -> {to}")
+        if not dry_run:
+            move(h, to, out=out)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    command = ap.add_mutually_exclusive_group(required=True)
+    command.add_argument('--list', action='store_true')
+    command.add_argument('--add', type=int, metavar='HOSPITAL')
+    command.add_argument('--move', type=int, metavar='HOSPITAL')
+    command.add_argument('--balance', action='store_true')
+    ap.add_argument('--shard', help='for --add')
+    ap.add_argument('--to', help='for --move')
+    ap.add_argument('--drop-source', action='store_true')
+    ap.add_argument('--dry-run', action='store_true', help='--balance: print the moves only')
+    args = ap.parse_args()
+    if not db.DB_SHARDS:
+        raise SystemExit("DB_SHARDS is not set")
+    if args.list:
+        list_hospitals()
+    elif args.add is not None:
+        if not args.shard:
+            ap.error('--add needs --shard')
+        add(args.add, args.shard)
+    elif args.move is not None:
+        if not args.to:
+            ap.error('--move needs --to')
+        move(args.move, args.to, args.drop_source)
+    else:
+        balance(args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
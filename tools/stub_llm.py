@@ -0,0 +1,82 @@
+"""Local stand-in for the OpenAI HTTP API, for tests and benchmarks.
+
+    python tools/stub_llm.py [--port 8089] [--delay-ms 300] [--fail-rate 0.0]
+    OPENAI_API_KEY=stub OPENAI_API_BASE=http://127.0.0.1:8089/v1 python app.py
+
+Serves /v1/chat/completions and /v1/completions with deterministic answers.
+Parsing requests get the JSON the real model is asked for ("show patient 5"
+-> show action); anything else gets {"action": "none"}, so the regex
+handlers answer as usual. --delay-ms and --fail-rate simulate a slow or
+flaky upstream for timeout and circuit-breaker checks.
+"""
+import argparse, json, random, re, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_SHOW = re.compile(r"\b(?:show|who is|details of)\s+(patient|staff)\s*(?:id\s*)?#?(\d+)")
+
+
+def parse_reply(text):
+    m = _SHOW.search(text.lower())
+    if m:
+        return {"action": "show", "target": m.group(1), "id": int(m.group(2)), "name": None}
+    return {"action": "none"}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+    fail_rate = 0.0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            return self._send(503, {"error": {"message": "stub: simulated upstream failure", "type": "server_error"}})
+
+        if self.path.endswith('/chat/completions'):
+            messages = body.get('messages') or []
+            if messages and messages[0].get('role') == 'system':
+                content = json.dumps(parse_reply(messages[-1].get('content', '')))
+            else:
+                content = 'Summary: ' + messages[-1].get('content', '')[:200] if messages else ''
+            choice = {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+            return self._send(200, {"id": "stub", "object": "chat.completion", "model": body.get('model'),
+                                    "choices": [choice], "usage": {}})
+        if self.path.endswith('/completions'):
+            text = 'Patient summary: ' + str(body.get('prompt', ''))[-200:]
+            return self._send(200, {"id": "stub", "object": "text_completion", "model": body.get('model'),
+                                    "choices": [{"index": 0, "text": text, "finish_reason": "stop"}], "usage": {}})
+        self._send(404, {"error": {"message": f"stub: no route {self.path}"}})
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def serve(port=8089, delay_ms=0, fail_rate=0.0):
+    StubHandler.delay = delay_ms / 1000.0
+    StubHandler.fail_rate = fail_rate
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--port', type=int, default=8089)
+    ap.add_argument('--delay-ms', type=float, default=0)
+    ap.add_argument('--fail-rate', type=float, default=0.0)
+    args = ap.parse_args()
+    server = serve(args.port, args.delay_ms, args.fail_rate)
+    print(f"stub LLM listening on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()